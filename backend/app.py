@@ -1,559 +1,665 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List, Literal, Union
-import openai
-import os
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
 import json
+import time
+from collections import Counter
 from dotenv import load_dotenv
+from pydantic import ValidationError
+
+import llm
+from models import (
+    DocumentRequest, DeltaChange, DeltaResponse, FormatRequest, WriteRequest, AutocompleteRequest,
+    TextSegment, SimplifiedBlock, SimplifiedDocument, LexicalDocumentRequest, LexicalFormatRequest,
+    SessionCreateRequest, SessionPatchRequest, SessionCommandRequest, BatchItem, BatchRequest, DiffRequest,
+)
+from doc_encoding import get_encoder, encoding_stats, minimal_block_dict
+from cache import response_cache, format_key, command_key, command_v2_key, make_key
+from chunking import (
+    CHUNK_NOTE, CHUNK_PARALLELISM, DEFAULT_EXECUTION, should_chunk, split_document, merge_chunk_changes,
+)
+from jobs import job_queue, report_progress, QueueFull, FINISHED, JOB_POLL_SECONDS
+from edit_engine import (
+    VALIDATION_ENABLED, BlockValidator, validate_text_changes, validate_block_changes, apply_block_changes,
+    editor_block_changes,
+)
+from format_rules import (
+    use_format_mode, use_format_output, style_rules, model_instruction, markdown_rule_changes, block_rule_changes, merge_text_changes,
+    merge_block_changes, needs_model, document_text, markdown_title_missing, document_title_missing,
+)
+from repair import REPAIR_MAX_FOLLOW_UP, use_repair, repair_text_changes, repair_block_changes, BlockRepairer, follow_up_block_fixes
+from prompts import (
+    V1_SYSTEM_PROMPT, V1_TOOLS, EDITOR_SYSTEM_PROMPT_V2, V2_TOOLS, V2_TOOLS_SINGLE_PASS, FORMAT_INSTRUCTIONS,
+    layout_messages,
+)
+from prompt_budget import PromptBudget, V1_OUTPUT, V2_OUTPUT
+from routing import (
+    ROUTE_STATS, ROUTING_ENABLED, MODEL_TIERS, TruncatedResponse, InvalidOutput, choose_route, call_routed, routing_signature,
+)
+from resilience import UpstreamError, stats as upstream_stats
+from metrics import REGISTRY, MetricsMiddleware, annotate, exporter, record_document, record_error, record_stream, stage
+import autocomplete
+from retrieval import window_document, window_markdown, WINDOW_NOTE_V1, WINDOW_NOTE_V2
+from sessions import session_store, PatchRejected, SessionConflict
+from singleflight import inflight
+from markdown_blocks import markdown_to_document, document_to_markdown
+from batch import BATCH_CONCURRENCY, BATCH_MAX_ITEMS, BATCH_WARM_PREFIX, BATCH_ENDPOINTS, find_conflicts
+from ratelimit import LIMITED_ROUTES, RateLimitMiddleware, Rejected, rate_limiter, request_cost, user_key
+from doc_diff import DIFF_CHANGES, minimize_block_changes, diff_documents, text_diff, stats as diff_stats
+from streaming import ChangeStreamParser, sse_event, SSE_HEADERS
+from edit_summary import (
+    SINGLE_PASS_V1_NOTE, SINGLE_PASS_V2_NOTE, SUMMARY_FOLLOW_UP, MODE_STATS, UsageTally,
+    use_single_pass, parse_inline_summary, local_text_summary, local_block_summary,
+)
 
 load_dotenv()
 
-app = FastAPI(title="Vrite AI Backend", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app):
+    async with llm.lifespan(app):
+        await job_queue.start()
+        try:
+            yield
+        finally:
+            await job_queue.stop()
+            if exporter is not None:
+                await exporter.close()
+
+app = FastAPI(title="Vrite AI Backend", version="1.0.0", lifespan=lifespan)
 
+app.add_middleware(RateLimitMiddleware)  # inside CORS, so 429s carry the CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://localhost:3001"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Retry-After"],
 )
+app.add_middleware(MetricsMiddleware)
 
-class DocumentRequest(BaseModel):
-    content: str
-    instruction: str
-    conversation_history: Optional[list] = None
-    context_snippets: Optional[List[str]] = None
-
-class DeltaChange(BaseModel):
-    operation: str  # "insert" | "delete" | "replace"
-    position: int
-    old_text: Optional[str] = None
-    new_text: Optional[str] = None
-    context_before: Optional[str] = None
-    context_after: Optional[str] = None
-
-class DeltaResponse(BaseModel):
-    type: str  # "delta" | "full"
-    reasoning: Optional[str] = None
-    changes: Optional[List[DeltaChange]] = None
-    summary: str
-    processed_content: Optional[str] = None
-
-class FormatRequest(BaseModel):
-    content: str
-    format_type: str = "APA"
-
-class WriteRequest(BaseModel):
-    prompt: str
-    context: Optional[str] = None
-
-# ============== Lexical JSON Models (V2 API) ==============
-
-class TextSegment(BaseModel):
-    text: str
-    format: int = 0  # Bitmask: 0=normal, 1=bold, 2=italic, 4=underline, etc.
-
-class SimplifiedBlock(BaseModel):
-    id: str
-    type: Literal['paragraph', 'heading', 'list-item']
-    tag: Optional[Literal['h1', 'h2', 'h3']] = None
-    listType: Optional[Literal['bullet', 'number']] = None
-    indent: Optional[int] = None
-    segments: List[TextSegment]
-
-class SimplifiedDocument(BaseModel):
-    blocks: List[SimplifiedBlock]
-
-class LexicalDocumentRequest(BaseModel):
-    document: SimplifiedDocument
-    instruction: str
-    conversation_history: Optional[list] = None
-    context_snippets: Optional[List[str]] = None
-
-# ============== System prompts for AI agent ==============
-EDITOR_SYSTEM_PROMPT = """You are a professional document editing agent. Your role is to apply precise edits to documents efficiently.
-
-CRITICAL RULES:
-1. NO conversational fluff (no "Certainly!", "I'd be happy to", etc.)
-2. Documents are provided in MARKDOWN format
-3. Use the replace_text tool to make changes
-4. ALWAYS use markdown syntax for formatting: **bold**, *italic*, # headings
-5. Be surgical and precise - change only what's necessary
-
-MARKDOWN FORMAT:
-The document uses markdown formatting:
-- **bold text** for bold
-- *italic text* for italic
-- # Heading 1, ## Heading 2, ### Heading 3 for headings
-- Blank lines separate paragraphs
-
-HOW TO USE replace_text TOOL:
-- Find the EXACT text that needs to be changed (old_text including markdown syntax)
-- Specify what it should be replaced with (new_text with proper markdown)
-- The tool will find and replace the text automatically
-- You can call the tool multiple times for multiple changes
-
-EXAMPLES:
-- To make "Education" bold: replace_text("Education", "**Education**")
-- To change "WORK EXPERIENCE" to bold heading: replace_text("WORK EXPERIENCE", "## Work Experience")
-- To italicize a book title: replace_text("The Great Gatsby", "*The Great Gatsby*")
-- To fix capitalization AND make bold: replace_text("education", "**Education**")
-
-EDITING PRINCIPLES:
-- Preserve the author's voice and style
-- Make minimal necessary changes
-- Maintain existing markdown formatting unless explicitly asked to change
-- Preserve paragraph breaks (double newlines)
-
-AFTER using tools, provide:
-- "reasoning": Brief analysis of what changes were made and why (1-3 sentences)
-- "summary": Concise statement of what was changed (no pleasantries)
-"""
 
-FORMATTING_STANDARDS = """
-APA 7th: Title page (bold title), running head, Level 1-2 headings (centered/left bold), double-space, 0.5" indent
-MLA 9th: Header (last name + page), first page heading, centered title, double-space, 0.5" indent
-Chicago 17th: Title page (title 1/3 down), footnotes/endnotes, bibliography hanging indent
-IEEE: Section numbering, column format, citation brackets
-"""
+async def summarize_tool_calls(messages, assistant_message: dict, tool_call_ids, *, temperature, default_summary, tally):
+    """
+    Two-pass fallback: feed the tool calls back and ask for reasoning/summary
+    in a second json_object completion.
+    """
+    messages.append(assistant_message)
+    for tool_call_id in tool_call_ids:
+        messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call_id,
+            "content": "Applied successfully"
+        })
 
-# ============== V2 System Prompt (Lexical JSON) ==============
-
-EDITOR_SYSTEM_PROMPT_V2 = """Document editing assistant. Use edit_document tool for ALL changes.
-
-RULES:
-- Be surgical - only change what's requested
-- One block = one paragraph/heading/list-item
-- NEVER use markdown (**, *) - use format bitmask
-- For new content: insert_block for EACH block separately
-
-FORMAT: {"blocks":[{"id":"block-0","type":"paragraph","segments":[{"text":"Hello","format":0}]}]}
-Types: paragraph, heading (tag:h1/h2/h3), list-item (listType:bullet/number)
-Format: 0=normal, 1=bold, 2=italic, 3=bold+italic
-
-OPERATIONS:
-- modify_segments: Edit text/format in block
-- replace_block: Change block type
-- insert_block: Add block (afterBlockId=null for start)
-- delete_block: Remove block
-
-LISTS: type="list-item" + listType. NEVER put "1." or "-" in text.
-
-EDITING PRINCIPLES:
-- Preserve the author's voice and style
-- Make minimal necessary changes
-- Only modify blocks that actually need changing
-- Do NOT regenerate unchanged content
-
-AFTER using tools, provide:
-- "reasoning": Brief analysis of what changes were made and why (1-3 sentences)
-- "summary": Concise statement of what was changed (no pleasantries)"""
-
-# ============== V2 Tool Definition ==============
-
-EDIT_DOCUMENT_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "edit_document",
-        "description": """Edit the document using block-level operations. Each block has an 'id' for reference.
-
-Operations:
-- replace_block: Replace entire block with new content/type
-- insert_block: Insert new block (use afterBlockId=null for start of document)
-- delete_block: Remove a block
-- modify_segments: Change text/formatting within a block
-
-Format bitmask: 0=normal, 1=bold, 2=italic, 3=bold+italic, 4=underline""",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "changes": {
-                    "type": "array",
-                    "description": "List of changes to apply to the document",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "operation": {
-                                "type": "string",
-                                "enum": ["replace_block", "insert_block", "delete_block", "modify_segments"],
-                                "description": "The type of operation to perform"
-                            },
-                            "blockId": {
-                                "type": "string",
-                                "description": "ID of the block to modify (for replace/delete/modify operations)"
-                            },
-                            "afterBlockId": {
-                                "type": ["string", "null"],
-                                "description": "ID of block to insert after. Use null to insert at the beginning (for insert_block only)"
-                            },
-                            "newBlock": {
-                                "type": "object",
-                                "description": "The new block content (for replace_block and insert_block)",
-                                "properties": {
-                                    "id": {"type": "string", "description": "Unique ID for the block"},
-                                    "type": {"type": "string", "enum": ["paragraph", "heading", "list-item"]},
-                                    "tag": {"type": "string", "enum": ["h1", "h2", "h3"], "description": "Heading level (for headings only)"},
-                                    "listType": {"type": "string", "enum": ["bullet", "number"], "description": "List type (for list-items only)"},
-                                    "segments": {
-                                        "type": "array",
-                                        "items": {
-                                            "type": "object",
-                                            "properties": {
-                                                "text": {"type": "string"},
-                                                "format": {"type": "integer", "description": "Format bitmask: 0=normal, 1=bold, 2=italic, 4=underline"}
-                                            },
-                                            "required": ["text", "format"]
-                                        }
-                                    }
-                                },
-                                "required": ["id", "type", "segments"]
-                            },
-                            "newSegments": {
-                                "type": "array",
-                                "description": "New text segments (for modify_segments only)",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "text": {"type": "string"},
-                                        "format": {"type": "integer"}
-                                    },
-                                    "required": ["text", "format"]
-                                }
-                            }
-                        },
-                        "required": ["operation"]
-                    }
-                }
-            },
-            "required": ["changes"]
-        }
-    }
-}
+    messages.append({
+        "role": "user",
+        "content": SUMMARY_FOLLOW_UP
+    })
+
+    route = choose_route("json", fixed="summary")
+    with stage("summary_call"):
+        final_response = await llm.chat_completion(
+            model=route.model,
+            messages=messages,
+            max_tokens=route.max_tokens,
+            temperature=temperature,
+            response_format={"type": "json_object"}
+        )
+        tally.add(final_response)
+
+        result = json.loads(final_response.choices[0].message.content)
+    return result.get("reasoning", ""), result.get("summary", default_summary)
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
-@app.post("/api/format")
-async def format_document(request: FormatRequest):
-    try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        # Formatting-specific system prompts
-        format_instructions = {
-            "APA": """Apply APA 7th Edition formatting using MARKDOWN:
-- Title: Use **Title** for bold title (Title Case)
-- Headings: ## Level 1 Heading (Bold Title Case), ### Level 2 Heading
-- References: Use "## References" for the heading
-- Emphasis: Use **bold** for emphasis
-
-Examples:
-- Title: replace_text("my document title", "**My Document Title**")
-- Section heading: replace_text("EDUCATION", "## Education")
-- Bold text: replace_text("Bachelor of Science", "**Bachelor of Science**")
-
-Use replace_text tool with proper markdown syntax.""",
-
-            "MLA": """Apply MLA 9th Edition formatting using MARKDOWN:
-- Title: Use # Title (standard capitalization, not bold)
-- Works Cited: Use "# Works Cited" for the heading
-- No bold/italic in title
-- Book titles in text: Use *italic* for book titles
-
-Examples:
-- Title: replace_text("the great gatsby", "# The Great Gatsby")
-- Works Cited heading: replace_text("works cited", "# Works Cited")
-- Book title in text: replace_text("The Great Gatsby", "*The Great Gatsby*")
-
-Use replace_text tool with proper markdown syntax.""",
-
-            "Chicago": """Apply Chicago 17th Edition formatting using MARKDOWN:
-- Title: Use # Title for title page
-- Bibliography: Use "# Bibliography" for the heading
-- Book titles in text: Use *italic* for book titles
-- Emphasis: Use *italic* for foreign phrases
-
-Examples:
-- Title: replace_text("my thesis", "# My Thesis")
-- Bibliography heading: replace_text("bibliography", "# Bibliography")
-- Book title in text: replace_text("The Great Gatsby", "*The Great Gatsby*")
-
-Use replace_text tool with proper markdown syntax."""
-        }
-
-        instruction = format_instructions.get(request.format_type, f"Apply {request.format_type} formatting standards")
+@app.get("/api/stats/edit-modes")
+async def edit_mode_stats():
+    return {"modes": MODE_STATS.snapshot()}
 
-        messages = [
-            {"role": "system", "content": EDITOR_SYSTEM_PROMPT + "\n\n" + FORMATTING_STANDARDS},
-            {"role": "user", "content": f"""Document content:
-{request.content}
+@app.get("/api/stats/routes")
+async def route_stats():
+    return {"enabled": ROUTING_ENABLED, "tiers": MODEL_TIERS, "routes": ROUTE_STATS.snapshot()}
 
-{instruction}
+@app.get("/api/stats/upstream")
+async def upstream_stats_endpoint():
+    return upstream_stats()
 
-Use the replace_text tool to make formatting changes, then provide reasoning and summary."""}
-        ]
+@app.get("/api/stats/ratelimit")
+async def ratelimit_stats():
+    return rate_limiter.stats()
 
-        # Make API call with replace_text tool
-        response = client.chat.completions.create(
-            model="gpt-5-mini",
-            messages=messages,
-            tools=[REPLACE_TEXT_TOOL],
-            tool_choice="auto",
-            max_tokens=2000,
-            temperature=0.1
-        )
+@app.get("/api/stats/diff")
+async def diff_stats_endpoint():
+    return diff_stats()
 
-        message = response.choices[0].message
-        tool_calls = message.tool_calls if message.tool_calls else []
+def upstream_http_error(e: UpstreamError) -> HTTPException:
+    """502 (failed after retries), 503 (circuit open) or 504 (timed out), with Retry-After when known."""
+    record_error(e)
+    headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+    return HTTPException(status_code=e.status, detail=f"Upstream error: {str(e)}", headers=headers)
 
-        # Convert tool calls to changes
-        changes = []
-        for tool_call in tool_calls:
-            import json
-            args = json.loads(tool_call.function.arguments)
+# Fields of a change that survive validation (where it came from, how it was fixed)
+CHANGE_TAGS = ("source", "rule", "repaired")
 
-            if tool_call.function.name == "replace_text":
-                changes.append({
-                    "old_text": args.get("old_text", ""),
-                    "new_text": args.get("new_text", "")
-                })
-
-        # Get final response
-        reasoning = ""
-        summary = ""
+async def attach_text_validation(result: dict, content: str, apply: bool, repair: bool, tally: UsageTally) -> dict:
+    """
+    Resolve replace_text changes against the document: positions, context and
+    issues. Changes whose old_text is missing are repaired first (see repair.py).
+    """
+    if not (VALIDATION_ENABLED or apply) or not result.get("changes"):
+        return result
+    with stage("validate", changes=len(result["changes"])):
+        changes = result["changes"]
+        validation = validate_text_changes(content, changes)
+        if repair and any(issue["status"] == "missing" for issue in validation["issues"]):
+            changes, result["repair"] = await repair_text_changes(content, changes, validation["issues"], tally)
+        validation = validate_text_changes(content, changes, apply=apply)
+    for change, entry in zip(changes, validation["changes"]):
+        for tag in CHANGE_TAGS:
+            if change.get(tag):
+                entry[tag] = change[tag]
+    result["changes"] = validation["changes"]
+    result["issues"] = validation["issues"]
+    if apply:
+        result["applied_content"] = validation["applied_content"]
+    return result
+
+async def attach_block_validation(result: dict, document: SimplifiedDocument, apply: bool, repair: bool, tally: UsageTally) -> dict:
+    """
+    Drop edit_document ops that can't apply to `document` and report them.
+    Ops on nonexistent block ids are retargeted first (see repair.py).
+    """
+    if not (VALIDATION_ENABLED or apply) or not result.get("changes"):
+        return result
+    with stage("validate", changes=len(result["changes"])):
+        changes = result["changes"]
+        validation = validate_block_changes(document, changes)
+        if repair and validation["rejected"]:
+            changes, result["repair"] = await repair_block_changes(document, changes, validation["rejected"], tally)
+        validation = validate_block_changes(document, changes, apply=apply)
+    attach_block_changes(result, document, validation, apply)
+    return result
+
+def attach_block_changes(result: dict, document: SimplifiedDocument, validation: dict, apply: bool):
+    """
+    The validated ops, minimized by diffing `document` against their result
+    (see doc_diff.py) when DIFF_CHANGES is on, in the order the editor
+    applies them (edit_engine.editor_block_changes).
+    """
+    changes = validation["changes"]
+    if DIFF_CHANGES and changes:
+        with stage("diff_changes", changes=len(changes)) as span:
+            changes = minimize_block_changes(document, changes)
+            span["minimized"] = len(changes)
+    if apply and changes is not validation["changes"]:
+        # Same content; block ids follow the minimized ops (replace_block keeps the old id)
+        result["applied_document"] = apply_block_changes(document, changes).model_dump(exclude_none=True)
+    elif apply:
+        result["applied_document"] = validation["applied_document"]
+    result["changes"] = editor_block_changes(document, changes)
+    result["rejected"] = validation["rejected"]
+    if not result["changes"]:
+        result["type"] = "no_changes"
+
+async def cached_call(key: str, compute, bypass: bool = False) -> dict:
+    """
+    Response cache lookup plus in-flight dedup: concurrent requests with the
+    same key share one cache lookup and at most one upstream computation.
+    Requests that bypass the cache only share with each other, so they never
+    get a cached answer through a normal request's lookup.
+    """
+    return await inflight.do(f"{key}:bypass" if bypass else key, lambda: response_cache.get_or_compute(key, compute, bypass=bypass))
 
-        if tool_calls:
-            messages.append(message.model_dump())
-            for tool_call in tool_calls:
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": "Applied successfully"
-                })
-
-            # Add final instruction to get JSON response
-            messages.append({
-                "role": "user",
-                "content": "Now provide your reasoning and summary in JSON format with fields: reasoning, summary"
-            })
+@app.get("/api/stats/cache")
+async def cache_stats():
+    return {**response_cache.stats(), "dedup": inflight.stats()}
 
-            final_response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.1,
-                response_format={"type": "json_object"}
-            )
+@app.post("/api/format")
+async def format_document(request: FormatRequest):
+    params = {
+        "model": routing_signature(),
+        "temperature": 0.1,
+        "single_pass": use_single_pass(request.single_pass),
+        "apply_changes": request.apply_changes,
+        "repair": use_repair(request.repair),
+        "format_mode": use_format_mode(request.format_mode),
+        "output": use_format_output(request.output),
+    }
+    run = run_format_blocks if params["output"] == "blocks" else run_format
+    return await cached_call(
+        format_key(request, params), lambda: run(request), bypass=request.bypass_cache
+    )
 
-            import json
-            result = json.loads(final_response.choices[0].message.content)
-            reasoning = result.get("reasoning", "")
-            summary = result.get("summary", "Formatting applied.")
+async def run_format_blocks(request: FormatRequest) -> dict:
+    """
+    /api/format with output "blocks": the markdown is read as a
+    SimplifiedDocument and formatted by /api/format/v2 in compact encoding.
+    The changes are edit_document ops against `document`, the blocks (and
+    ids) the markdown was read as; with apply_changes, `applied_content` is
+    the result written back as markdown.
+    """
+    with stage("markdown_to_blocks") as span:
+        document = markdown_to_document(request.content)
+        span["blocks"] = len(document.blocks)
+    options = request.model_dump(include={"format_type", "format_mode", "single_pass", "bypass_cache", "apply_changes", "repair"})
+    result = await format_document_v2(LexicalFormatRequest(document=document, document_encoding="compact", **options))
+    result["document"] = {"blocks": [minimal_block_dict(block) for block in document.blocks]}
+    if request.apply_changes:
+        result["applied_content"] = document_to_markdown(result["applied_document"])
+    return result
+
+async def run_format(request: FormatRequest) -> dict:
+    try:
+        single_pass = use_single_pass(request.single_pass)
+        mode = use_format_mode(request.format_mode)
+        rules = style_rules(request.format_type) if mode != "model" else None
+        tally = UsageTally()
+
+        rule_changes = []
+        model_called = False
+        record_document(len(request.content))
+        if rules is None:
+            instruction = FORMAT_INSTRUCTIONS.get(request.format_type, f"Apply {request.format_type} formatting standards")
+            route = choose_route("replace_text", fixed="style")
+            result = await complete_format(request, request.content, instruction, single_pass, tally, route)
+            model_called = True
+        else:
+            # Mechanical rules locally; the model only sees the formatted text and the rest of the style
+            with stage("format_rules") as span:
+                rule_changes = markdown_rule_changes(request.content, request.format_type)
+                formatted = validate_text_changes(request.content, rule_changes, apply=True)["applied_content"]
+                span["rule_changes"] = len(rule_changes)
+            titled = not markdown_title_missing(request.content)
+            instruction = model_instruction(rules, title=titled)
+            if mode == "hybrid" and instruction and (not titled or needs_model(formatted, request.format_type)):
+                route = choose_route("replace_text", instruction, len(formatted), fixed="format")
+                result = await complete_format(request, formatted, instruction, single_pass, tally, route)
+                result["changes"] = merge_text_changes(rule_changes, result["changes"], request.content)
+                model_called = True
+            else:
+                result = {
+                    "type": "tool_based",
+                    "reasoning": f"Applied {request.format_type} title, heading and reference rules.",
+                    "changes": rule_changes,
+                    "summary": local_text_summary(rule_changes),
+                    "format_type": request.format_type,
+                }
 
-        return {
-            "type": "tool_based",
-            "reasoning": reasoning,
-            "changes": changes,
-            "summary": summary,
-            "format_type": request.format_type
+        sources = Counter(change.get("source", "model") for change in result["changes"])
+        result["format_rules"] = {
+            "mode": mode,
+            "rule_changes": sources["rules"],
+            "model_changes": sources["model"],
+            "merged_changes": sources["rules+model"],
+            "model_called": model_called,
         }
+        result = await attach_text_validation(
+            result, request.content, request.apply_changes, use_repair(request.repair), tally
+        )
+        annotate(**tally.finish("/api/format", single_pass))
+        return result
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
         import traceback
+        record_error(e)
         print(f"Formatting error: {str(e)}")
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Formatting error: {str(e)}")
 
-@app.post("/api/enhance")
-async def enhance_writing(request: WriteRequest):
+async def complete_format(request: FormatRequest, content: str, instruction: str, single_pass: bool, tally: UsageTally, route) -> dict:
+    """One replace_text call applying `instruction` to `content`; changes are tagged "source": "model"."""
+    summary_note = f"\n\n{SINGLE_PASS_V1_NOTE}" if single_pass else ""
+
+    with stage("build_prompt"):
+        budget = PromptBudget(V1_OUTPUT)
+        budget.limit_output(route.max_tokens)
+        budget.add("system", V1_SYSTEM_PROMPT, instruction)
+        budget.add_tools(V1_TOOLS)
+        budget.add("instruction", summary_note)
+        budget.add("document", content)
+
+        # Shared V1 system prompt, then the (per-style, static) format instructions
+        messages = layout_messages(
+            [V1_SYSTEM_PROMPT, instruction],
+            f"Document content:\n{content}",
+            [],
+            f"Use the replace_text tool to make {request.format_type} formatting changes, then provide reasoning and summary.{summary_note}"
+        )
+
+    # Make API call with replace_text tool
+    (message, changes), route = await call_routed(
+        route, lambda route: request_replace_text(messages, budget, route, tally)
+    )
+    tool_calls = message.tool_calls if message.tool_calls else []
+    for change in changes:
+        change["source"] = "model"
+
+    # Get final response
+    reasoning = ""
+    summary = ""
+
+    if tool_calls and single_pass:
+        inline = parse_inline_summary(message.content)
+        reasoning = inline.get("reasoning", "")
+        summary = inline.get("summary") or local_text_summary(changes)
+    elif tool_calls:
+        reasoning, summary = await summarize_tool_calls(
+            messages, message.model_dump(), [tool_call.id for tool_call in tool_calls],
+            temperature=route.temperature, default_summary="Formatting applied.", tally=tally
+        )
+
+    return {
+        "type": "tool_based",
+        "reasoning": reasoning,
+        "changes": changes,
+        "summary": summary,
+        "format_type": request.format_type,
+        "prompt_budget": budget.stats(),
+        "route": route.describe()
+    }
+
+async def request_replace_text(messages: list, budget: PromptBudget, route, tally: UsageTally):
+    """
+    One replace_text completion on `route`. Returns (message, changes); raises
+    TruncatedResponse / InvalidOutput so call_routed can escalate (on the last
+    tier a truncated answer is used as it is).
+    """
+    budget.limit_output(route.max_tokens)
+    response = await llm.chat_completion(
+        model=route.model,
+        messages=messages,
+        tools=V1_TOOLS,
+        tool_choice="auto",
+        max_tokens=budget.max_tokens(),
+        temperature=route.temperature
+    )
+    tally.add(response)
+
+    message = response.choices[0].message
+    if response.choices[0].finish_reason == "length" and route.can_escalate:
+        raise TruncatedResponse("Response was truncated due to length.")
+
+    # Convert tool calls to changes
+    changes = []
+    with stage("parse_tool_calls", tool_calls=len(message.tool_calls or [])):
+        for tool_call in message.tool_calls or []:
+            if tool_call.function.name != "replace_text":
+                continue
+            try:
+                args = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                raise InvalidOutput("Model returned malformed JSON. Try a simpler request or break it into smaller steps.")
+            changes.append({
+                "old_text": args.get("old_text", ""),
+                "new_text": args.get("new_text", "")
+            })
+    return message, changes
+
+@app.post("/api/format/v2")
+async def format_document_v2(request: LexicalFormatRequest):
+    """
+    Citation-style formatting of a Lexical document. Title, headings and the
+    references heading are formatted by rules (format_rules.py); the model
+    runs, through /api/command/v2, only for what is left of the style.
+    """
     try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        context_text = f"Context: {request.context}\n\n" if request.context else ""
-        
-        prompt = f"""
+        mode = use_format_mode(request.format_mode)
+        rules = style_rules(request.format_type) if mode != "model" else None
+        options = request.model_dump(include={"single_pass", "bypass_cache", "repair", "document_encoding"})
+
+        rule_changes = []
+        formatted = request.document
+        instruction = None
+        if rules is None:
+            style = FORMAT_INSTRUCTIONS.get(request.format_type, f"Apply {request.format_type} formatting standards")
+            instruction = f"Apply {request.format_type} formatting. Express markdown headings as heading blocks (tag h1-h3) and bold/italic as segment formats 1/2.\n\n{style}"
+        else:
+            rule_changes = block_rule_changes(request.document, request.format_type)
+            formatted = apply_block_changes(request.document, rule_changes)
+            titled = not document_title_missing(request.document)
+            if mode == "hybrid" and (not titled or needs_model(document_text(formatted), request.format_type)):
+                instruction = model_instruction(rules, blocks=True, title=titled)
+
+        if instruction:
+            model_result = await process_ai_command_v2(
+                LexicalDocumentRequest(document=formatted, instruction=instruction, **options)
+            )
+            model_changes = [{**change, "source": "model"} for change in model_result.get("changes", [])]
+            result = {**model_result, "changes": merge_block_changes(rule_changes, model_changes)}
+        else:
+            result = {
+                "type": "lexical_changes" if rule_changes else "no_changes",
+                "reasoning": f"Applied {request.format_type} title, heading and reference rules.",
+                "changes": rule_changes,
+                "summary": local_block_summary(rule_changes),
+            }
+        result.pop("rejected", None)
+        result.pop("applied_document", None)
+
+        sources = Counter(change.get("source", "model") for change in result["changes"])
+        result["format_type"] = request.format_type
+        result["format_rules"] = {
+            "mode": mode,
+            "rule_changes": sources["rules"],
+            "model_changes": sources["model"],
+            "merged_changes": sources["rules+model"],
+            "model_called": instruction is not None,
+        }
+        # Rule and model ops together, against the document the client sent
+        validation = validate_block_changes(request.document, result["changes"], apply=request.apply_changes)
+        attach_block_changes(result, request.document, validation, request.apply_changes)
+        return result
+    except HTTPException:
+        raise
+    except UpstreamError as e:
+        raise upstream_http_error(e)
+    except Exception as e:
+        import traceback
+        record_error(e)
+        print(f"Formatting V2 error: {str(e)}")
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Formatting error: {str(e)}")
+
+def enhance_prompt(request: WriteRequest) -> str:
+    context_text = f"Context: {request.context}\n\n" if request.context else ""
+
+    return f"""
         {context_text}Generate or enhance the following writing request:
         {request.prompt}
         
         Provide clear, well-structured content that flows naturally with any existing context.
         """
-        
-        response = client.chat.completions.create(
-            model="gpt-5-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1500,
-            temperature=0.7
-        )
-        
+
+@app.post("/api/enhance")
+async def enhance_writing(request: WriteRequest):
+    try:
+        prompt = enhance_prompt(request)
+
+        async def attempt(route):
+            response = await llm.chat_completion(
+                model=route.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=route.max_tokens,
+                temperature=route.temperature
+            )
+            if response.choices[0].finish_reason == "length" and route.can_escalate:
+                raise TruncatedResponse("Response was truncated due to length.")
+            return response
+
+        route = choose_route("text", request.prompt, len(request.context or ""))
+        response, route = await call_routed(route, attempt)
+
         return {
-            "enhanced_content": response.choices[0].message.content
+            "enhanced_content": response.choices[0].message.content,
+            "route": route.describe()
         }
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
+        record_error(e)
         raise HTTPException(status_code=500, detail=f"Enhancement error: {str(e)}")
 
-# Define tools for OpenAI function calling
-REPLACE_TEXT_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "replace_text",
-        "description": "Replace exact text in the document. Call this multiple times for multiple changes.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "old_text": {
-                    "type": "string",
-                    "description": "The exact text to find and replace in the document"
-                },
-                "new_text": {
-                    "type": "string",
-                    "description": "The replacement text"
-                }
-            },
-            "required": ["old_text", "new_text"]
-        }
-    }
-}
+@app.post("/api/enhance/stream")
+async def enhance_writing_stream(request: WriteRequest):
+    """
+    Streaming variant of /api/enhance (server-sent events): `start` with the
+    route, a `token` event per text delta as the model produces it, then `done`
+    with the full text and timings (or `error`).
+
+    If the client disconnects, the event generator is cancelled, which closes
+    the upstream stream (llm.stream_chat_completion) so no more tokens are
+    generated. Time to first token and duration go to the stream histograms,
+    the outcome and length to the request trace.
+    """
+    prompt = enhance_prompt(request)
+    route = choose_route("text", request.prompt, len(request.context or ""))  # no escalation once text is streaming
+
+    async def events():
+        started = time.perf_counter()
+        first_token = None
+        parts = []
+        finish_reason = None
+        outcome = "disconnected"  # unless the stream gets to the end
+        try:
+            yield sse_event("start", {"route": route.describe()})
+            async for chunk in llm.stream_chat_completion(
+                model=route.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=route.max_tokens,
+                temperature=route.temperature
+            ):
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    parts.append(choice.delta.content)
+                    yield sse_event("token", {"text": choice.delta.content})
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+            outcome = "completed"
+            yield sse_event("done", {
+                "enhanced_content": "".join(parts),
+                "finish_reason": finish_reason,
+                "truncated": finish_reason == "length",
+                "time_to_first_token_ms": round(first_token * 1000) if first_token is not None else None,
+                "total_ms": round((time.perf_counter() - started) * 1000),
+                "route": route.describe()
+            })
+        except UpstreamError as e:
+            outcome = "error"
+            record_error(e)
+            yield sse_event("error", {"detail": f"Upstream error: {str(e)}", "status": e.status, "retry_after": e.retry_after})
+        except Exception as e:
+            outcome = "error"
+            record_error(e)
+            yield sse_event("error", {"detail": f"Enhancement error: {str(e)}"})
+        finally:
+            total = time.perf_counter() - started
+            record_stream(first_token, total, outcome)
+            annotate(outcome=outcome, chars=sum(map(len, parts)))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/api/autocomplete")
+async def autocomplete_text(request: AutocompleteRequest):
+    """
+    Inline completion of the text before the cursor. Served from the prefix
+    cache while the user types what was suggested; otherwise one small-tier
+    call on the capped context, cancelled if the same session_id sends a newer
+    request (the older one then answers with superseded: true).
+    """
+    started = time.perf_counter()
+    if not request.context.strip():
+        raise HTTPException(status_code=400, detail="Missing required field: context")
+    route = choose_route("text", fixed="autocomplete")
+    max_tokens = max(1, min(request.max_tokens, route.max_tokens))
+
+    cached = autocomplete.suggestions.get(request.context, route.model, max_tokens)
+    if cached is not None:
+        autocomplete.record("cache", started)
+        return {"completion": cached, "source": "cache", "superseded": False}
+
+    context = autocomplete.cap_context(request.context)
+
+    async def call():
+        with stage("build_prompt", context_chars=len(context)):
+            messages = autocomplete.autocomplete_messages(context)
+        return await llm.chat_completion(
+            model=route.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=route.temperature,
+            timeout=autocomplete.AUTOCOMPLETE_TIMEOUT
+        )
 
-APPLY_BOLD_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "apply_bold",
-        "description": "Make text bold in the document. Use this instead of markdown **text**.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "text": {
-                    "type": "string",
-                    "description": "The exact text to make bold"
-                }
-            },
-            "required": ["text"]
-        }
-    }
-}
+    try:
+        if request.session_id:
+            response = await autocomplete.session_calls.run(request.session_id, call)
+        else:
+            response = await call()
+    except autocomplete.Superseded:
+        autocomplete.record("superseded", started)
+        return {"completion": "", "source": "superseded", "superseded": True}
+    except UpstreamError as e:
+        ROUTE_STATS.record(route, time.perf_counter() - started, "error")
+        raise upstream_http_error(e)
+    except Exception as e:
+        ROUTE_STATS.record(route, time.perf_counter() - started, "error")
+        print(f"Error in autocomplete: {str(e)}")
+        record_error(e)
+        raise HTTPException(status_code=500, detail=f"Autocomplete error: {str(e)}")
 
-APPLY_ITALIC_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "apply_italic",
-        "description": "Make text italic in the document. Use this instead of markdown *text*.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "text": {
-                    "type": "string",
-                    "description": "The exact text to make italic"
-                }
-            },
-            "required": ["text"]
-        }
-    }
-}
+    ROUTE_STATS.record(route, time.perf_counter() - started, "ok")
+    completion = autocomplete.normalize_completion(context, response.choices[0].message.content)
+    autocomplete.suggestions.set(context, route.model, max_tokens, completion)
+    autocomplete.record("model", started)
+    return {"completion": completion, "source": "model", "superseded": False}
 
-APPLY_HEADING_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "apply_heading",
-        "description": "Convert text to a heading with the specified level (1, 2, or 3).",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "text": {
-                    "type": "string",
-                    "description": "The exact text to convert to a heading"
-                },
-                "level": {
-                    "type": "integer",
-                    "description": "Heading level: 1 (largest), 2 (medium), or 3 (smallest)",
-                    "enum": [1, 2, 3]
-                }
-            },
-            "required": ["text", "level"]
-        }
-    }
-}
+@app.get("/api/stats/autocomplete")
+async def autocomplete_stats():
+    return autocomplete.stats()
 
-# All available tools
-ALL_FORMATTING_TOOLS = [
-    REPLACE_TEXT_TOOL,
-    APPLY_BOLD_TOOL,
-    APPLY_ITALIC_TOOL,
-    APPLY_HEADING_TOOL
-]
-
-# Formatting standards knowledge for tools
-FORMATTING_TOOLS = {
-    "apa": {
-        "type": "function",
-        "function": {
-            "name": "apply_apa_heading",
-            "description": "Apply APA 7th Edition heading format. Level 1: Centered Bold Title Case. Level 2: Left Aligned Bold Title Case.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "old_heading": {"type": "string", "description": "Current heading text"},
-                    "new_heading": {"type": "string", "description": "Heading with proper APA capitalization"},
-                    "level": {"type": "integer", "description": "Heading level (1 or 2)"}
-                },
-                "required": ["old_heading", "new_heading", "level"]
-            }
-        }
-    },
-    "mla": {
-        "type": "function",
-        "function": {
-            "name": "apply_mla_format",
-            "description": "Apply MLA 9th Edition formatting. Title: centered, standard capitalization. First page: Name, Instructor, Course, Date (top left, double-spaced).",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "old_text": {"type": "string"},
-                    "new_text": {"type": "string"}
-                },
-                "required": ["old_text", "new_text"]
-            }
-        }
-    },
-    "chicago": {
-        "type": "function",
-        "function": {
-            "name": "apply_chicago_format",
-            "description": "Apply Chicago 17th Edition formatting. Title page: title centered 1/3 down, author and course info bottom third.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "old_text": {"type": "string"},
-                    "new_text": {"type": "string"}
-                },
-                "required": ["old_text", "new_text"]
-            }
-        }
-    }
-}
 
 @app.post("/api/command")
 async def process_ai_command(request: DocumentRequest):
-    try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        # Build messages array with conversation history
-        messages = []
-
-        # Add system message with new prompts
-        messages.append({
-            "role": "system",
-            "content": EDITOR_SYSTEM_PROMPT + "\n\n" + FORMATTING_STANDARDS
-        })
+    params = {
+        "model": routing_signature(),
+        "temperature": 0.3,
+        "single_pass": use_single_pass(request.single_pass),
+        "context_window": request.context_window,
+        "apply_changes": request.apply_changes,
+        "repair": use_repair(request.repair),
+    }
+    return await cached_call(
+        command_key(request, params), lambda: run_command(request), bypass=request.bypass_cache
+    )
 
-        # Add conversation history if provided (limit to last 7 exchanges)
-        if request.conversation_history:
-            recent_history = request.conversation_history[-14:]  # Last 7 exchanges (14 messages)
-            messages.extend(recent_history)
-        
-        # Add current request
-        context_text = ""
-        if request.context_snippets:
-            cleaned_context = [snippet.strip() for snippet in request.context_snippets if snippet.strip()]
+async def run_command(request: DocumentRequest) -> dict:
+    try:
+        single_pass = use_single_pass(request.single_pass)
+        tally = UsageTally()
+        summary_note = f"\n\n{SINGLE_PASS_V1_NOTE}" if single_pass else ""
+        route = choose_route("replace_text", request.instruction, len(request.content))
+        record_document(len(request.content))
+
+        with stage("build_prompt"):
+            # Charge the prompt parts in priority order; history gets what is left
+            budget = PromptBudget(V1_OUTPUT)
+            budget.limit_output(route.max_tokens)
+            budget.add("system", V1_SYSTEM_PROMPT)
+            budget.add_tools(V1_TOOLS)
+            budget.add("instruction", request.instruction, summary_note)
+
+            context_text = ""
+            cleaned_context = budget.fit_snippets(request.context_snippets)
             if cleaned_context:
                 formatted_snippets = "\n".join(f"- {snippet}" for snippet in cleaned_context)
                 context_text = f"""Priority context from the user:
@@ -561,252 +667,911 @@ async def process_ai_command(request: DocumentRequest):
 
 """
 
-        messages.append({
-            "role": "user",
-            "content": f"""{context_text}Document content:
-{request.content}
+            # Only send the paragraphs this instruction needs (falls back to the whole document)
+            content, window = window_markdown(request.content, request.instruction, request.context_snippets, request.context_window)
+            window_note = f"{WINDOW_NOTE_V1}\n\n" if not window.is_full else ""
+            budget.add("document", window_note, content)
 
-User instruction: {request.instruction}
+            messages = layout_messages(
+                [V1_SYSTEM_PROMPT],
+                f"Document content:\n{content}",
+                budget.fit_history(request.conversation_history),
+                f"""{context_text}{window_note}User instruction: {request.instruction}
 
-Use the replace_text tool to make changes (remember to use markdown for formatting), then provide reasoning and summary."""
-        })
+Use the replace_text tool to make changes (remember to use markdown for formatting), then provide reasoning and summary.{summary_note}"""
+            )
 
-        # Make API call with tools
-        response = client.chat.completions.create(
-            model="gpt-5-mini",
-            messages=messages,
-            tools=[REPLACE_TEXT_TOOL],
-            tool_choice="auto",
-            max_tokens=2000,
-            temperature=0.3
+        # Make API call with tools (escalates on truncated or malformed output)
+        (message, changes), route = await call_routed(
+            route, lambda route: request_replace_text(messages, budget, route, tally)
         )
 
-        message = response.choices[0].message
-
         # Extract tool calls
         tool_calls = message.tool_calls if message.tool_calls else []
 
-        # Convert tool calls to our change format
-        changes = []
-        for tool_call in tool_calls:
-            import json
-            args = json.loads(tool_call.function.arguments)
-
-            if tool_call.function.name == "replace_text":
-                changes.append({
-                    "old_text": args.get("old_text", ""),
-                    "new_text": args.get("new_text", "")
-                })
-
         # If we have tool calls, we need to get the final response
         reasoning = ""
         summary = ""
 
-        if tool_calls:
+        if tool_calls and single_pass:
+            inline = parse_inline_summary(message.content)
+            reasoning = inline.get("reasoning", "")
+            summary = inline.get("summary") or local_text_summary(changes)
+        elif tool_calls:
             # Add tool responses and get final summary
-            messages.append(message.model_dump())
-
-            # Add tool responses (all successful)
-            for tool_call in tool_calls:
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": "Applied successfully"
-                })
-
-            # Get final response with reasoning and summary
-            # Add final instruction to get JSON response
-            messages.append({
-                "role": "user",
-                "content": "Now provide your reasoning and summary in JSON format with fields: reasoning, summary"
-            })
-
-            final_response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.3,
-                response_format={"type": "json_object"}
+            reasoning, summary = await summarize_tool_calls(
+                messages, message.model_dump(), [tool_call.id for tool_call in tool_calls],
+                temperature=route.temperature, default_summary="Changes applied.", tally=tally
             )
-
-            import json
-            result = json.loads(final_response.choices[0].message.content)
-            reasoning = result.get("reasoning", "")
-            summary = result.get("summary", "Changes applied.")
         else:
             # No tool calls - fallback to direct JSON response
             summary = message.content if message.content else "Changes applied."
 
         # Return changes
         if changes:
-            return {
+            result = await attach_text_validation({
                 "type": "tool_based",
                 "reasoning": reasoning,
                 "changes": changes,
-                "summary": summary
-            }
+                "summary": summary,
+                "context_window": window.stats(),
+                "prompt_budget": budget.stats(),
+                "route": route.describe()
+            }, request.content, request.apply_changes, use_repair(request.repair), tally)
+            annotate(**tally.finish("/api/command", single_pass))
+            return result
         else:
+            annotate(**tally.finish("/api/command", single_pass))
             # Fallback - no tools used
             return {
                 "type": "full",
                 "summary": summary,
                 "processed_content": request.content,
-                "reasoning": reasoning
+                "reasoning": reasoning,
+                "context_window": window.stats(),
+                "prompt_budget": budget.stats(),
+                "route": route.describe()
             }
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
+        record_error(e)
         raise HTTPException(status_code=500, detail=f"Command processing error: {str(e)}")
 
 # ============== V2 API Endpoint (Lexical JSON) ==============
 
-@app.post("/api/command/v2")
-async def process_ai_command_v2(request: LexicalDocumentRequest):
-    """
-    Process AI commands using Lexical JSON format.
-    Supports blank documents and structured block-level operations.
-    """
-    try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        messages = []
-        messages.append({
-            "role": "system",
-            "content": EDITOR_SYSTEM_PROMPT_V2
-        })
-
-        # Add conversation history if provided (limit to last 7 exchanges)
-        if request.conversation_history:
-            recent_history = request.conversation_history[-14:]
-            messages.extend(recent_history)
+def is_blank_document(document: SimplifiedDocument) -> bool:
+    return len(document.blocks) == 0 or (
+        len(document.blocks) == 1 and
+        all(s.text.strip() == '' for s in document.blocks[0].segments)
+    )
 
-        # Build document JSON representation
-        doc_dict = request.document.model_dump()
-        doc_json = json.dumps(doc_dict, indent=2)
+def route_v2(request: LexicalDocumentRequest):
+    """Model tier, max_tokens and temperature for an edit_document call (see routing.py)."""
+    chars = sum(len(segment.text) for block in request.document.blocks for segment in block.segments)
+    return choose_route("edit_document", request.instruction, chars, is_blank_document(request.document))
 
-        # Build context text from snippets
-        context_text = ""
-        if request.context_snippets:
-            cleaned_context = [snippet.strip() for snippet in request.context_snippets if snippet.strip()]
-            if cleaned_context:
-                formatted_snippets = "\n".join(f"- {snippet}" for snippet in cleaned_context)
-                context_text = f"""Priority context from the user:
+def build_v2_messages(request: LexicalDocumentRequest, single_pass: bool, extra_note: str = "", route=None):
+    """
+    Build the edit_document message list shared by the V2 endpoints.
+    Returns (messages, prompt_stats) where prompt_stats reports the document
+    encoding, the relevance window that was sent, the token budget
+    (prompt_stats["prompt_budget"]["max_tokens"] is the completion budget)
+    and the route.
+    """
+    summary_note = f"\n\n{SINGLE_PASS_V2_NOTE}" if single_pass else ""
+    route = route or route_v2(request)
+
+    # Charge the prompt parts in priority order; history gets what is left
+    budget = PromptBudget(V2_OUTPUT)
+    budget.limit_output(route.max_tokens)
+    budget.add("system", EDITOR_SYSTEM_PROMPT_V2)
+    budget.add_tools(V2_TOOLS_SINGLE_PASS if single_pass else V2_TOOLS)
+    budget.add("instruction", request.instruction, summary_note)
+
+    # Build context text from snippets
+    context_text = ""
+    cleaned_context = budget.fit_snippets(request.context_snippets)
+    if cleaned_context:
+        formatted_snippets = "\n".join(f"- {snippet}" for snippet in cleaned_context)
+        context_text = f"""Priority context from the user:
 {formatted_snippets}
 
 """
 
-        # Check if document is blank or nearly blank
-        is_blank = len(request.document.blocks) == 0 or (
-            len(request.document.blocks) == 1 and
-            all(s.text.strip() == '' for s in request.document.blocks[0].segments)
-        )
-        blank_note = "\n\nIMPORTANT: The document is BLANK. You MUST use multiple insert_block operations (one per paragraph/heading/list-item). Do NOT use modify_segments. Create each piece of content as a separate block with its own insert_block operation." if is_blank else ""
-
-        messages.append({
-            "role": "user",
-            "content": f"""{context_text}Document (Lexical JSON):
-{doc_json}
-{blank_note}
-
-User instruction: {request.instruction}
-
-Use the edit_document tool to make changes, then provide reasoning and summary."""
-        })
-
-        # DEBUG: Log input sizes
-        total_chars = sum(len(m.get('content', '')) for m in messages)
-        print(f"DEBUG: Total input chars: {total_chars}, Doc JSON chars: {len(doc_json)}")
-        print(f"DEBUG: System prompt chars: {len(EDITOR_SYSTEM_PROMPT_V2)}")
+    # Encode the document (see doc_encoding for the available modes)
+    # Only send the blocks this instruction needs (falls back to the whole document)
+    document, window = window_document(request.document, request.instruction, request.context_snippets, request.context_window)
+    notes = [] if window.is_full else [WINDOW_NOTE_V2.format(sent=len(window.indices), total=window.total)]
+    if extra_note:
+        notes.append(extra_note)
+    window_note = "\n".join(notes) + "\n\n" if notes else ""
+
+    encoder = get_encoder(request.document_encoding)
+    doc_text = encoder.encode(document)
+    doc_stats = encoding_stats(document, encoder, doc_text)
+    encoding_note = f"\n{encoder.note}" if encoder.note else ""
+    budget.charge("document", doc_stats["tokens"])
+    budget.add("document", encoding_note, window_note)
+
+    # Check if document is blank or nearly blank
+    is_blank = is_blank_document(request.document)
+    blank_note = "IMPORTANT: The document is BLANK. You MUST use multiple insert_block operations (one per paragraph/heading/list-item). Do NOT use modify_segments. Create each piece of content as a separate block with its own insert_block operation.\n\n" if is_blank else ""
+    budget.add("instruction", blank_note)
+
+    messages = layout_messages(
+        [EDITOR_SYSTEM_PROMPT_V2],
+        f"Document ({encoder.label}):{encoding_note}\n{doc_text}",
+        budget.fit_history(request.conversation_history),
+        f"""{context_text}{window_note}{blank_note}User instruction: {request.instruction}
+
+Use the edit_document tool to make changes, then provide reasoning and summary.{summary_note}"""
+    )
+
+    record_document(doc_stats["chars"])
+
+    return messages, {
+        "document_encoding": doc_stats,
+        "context_window": window.stats(),
+        "prompt_budget": budget.stats(),
+        "route": route.describe(),
+    }
 
-        # Make API call with the edit_document tool
-        response = client.chat.completions.create(
-            model="gpt-5-mini",
-            messages=messages,
-            tools=[EDIT_DOCUMENT_TOOL],
-            tool_choice="auto",
-            max_tokens=16384,
-            temperature=0.3
+def parse_edit_tool_calls(tool_calls):
+    """Collect edit_document changes plus any inline reasoning/summary from tool calls."""
+    changes = []
+    inline = {}
+    for tool_call in tool_calls:
+        try:
+            args = json.loads(tool_call.function.arguments)
+            if tool_call.function.name == "edit_document":
+                changes.extend(args.get("changes", []))
+                inline.update({key: args[key] for key in ("reasoning", "summary") if isinstance(args.get(key), str)})
+        except json.JSONDecodeError as e:
+            record_error(e)
+            annotate(tool_arguments_error=f"{e.msg} at char {e.pos} of {len(tool_call.function.arguments)}")
+            raise InvalidOutput(f"Model returned malformed JSON. Try a simpler request or break it into smaller steps.")
+    return changes, inline
+
+async def complete_command_v2(request: LexicalDocumentRequest, single_pass: bool, tally: UsageTally, extra_note: str = "", route=None) -> dict:
+    """One edit_document round trip (plus the two-pass summary call when enabled)."""
+    route = route or route_v2(request)
+    with stage("build_prompt") as span:
+        messages, prompt_stats = build_v2_messages(request, single_pass, extra_note, route)
+        span["prompt_chars"] = sum(len(message.get("content", "")) for message in messages)
+
+    # Make API call with the edit_document tool
+    response = await llm.chat_completion(
+        model=route.model,
+        messages=messages,
+        tools=V2_TOOLS_SINGLE_PASS if single_pass else V2_TOOLS,
+        tool_choice="auto",
+        max_tokens=prompt_stats["prompt_budget"]["max_tokens"],
+        temperature=route.temperature
+    )
+    tally.add(response)
+
+    message = response.choices[0].message
+    finish_reason = response.choices[0].finish_reason
+
+    # Check if response was truncated
+    if finish_reason == "length":
+        raise TruncatedResponse("Response was truncated due to length. Try a simpler request.")
+
+    tool_calls = message.tool_calls if message.tool_calls else []
+
+    # Extract changes from tool calls
+    with stage("parse_tool_calls", tool_calls=len(tool_calls)) as span:
+        span["arguments_chars"] = sum(len(tool_call.function.arguments) for tool_call in tool_calls)
+        changes, inline = parse_edit_tool_calls(tool_calls)
+
+    # Get reasoning and summary
+    reasoning = ""
+    summary = ""
+
+    if tool_calls and single_pass:
+        reasoning = inline.get("reasoning", "")
+        summary = inline.get("summary") or local_block_summary(changes)
+    elif tool_calls:
+        reasoning, summary = await summarize_tool_calls(
+            messages, message.model_dump(), [tool_call.id for tool_call in tool_calls],
+            temperature=route.temperature, default_summary="Changes applied.", tally=tally
         )
+    else:
+        summary = message.content if message.content else "No changes needed."
 
-        message = response.choices[0].message
-        finish_reason = response.choices[0].finish_reason
+    if changes:
+        return {
+            "type": "lexical_changes",
+            "reasoning": reasoning,
+            "changes": changes,
+            "summary": summary,
+            **prompt_stats
+        }
+    return {
+        "type": "no_changes",
+        "summary": summary,
+        "reasoning": reasoning,
+        **prompt_stats
+    }
 
-        # DEBUG: Log token usage
-        print(f"DEBUG: Usage: {response.usage}")
-        print(f"DEBUG: finish_reason: {finish_reason}")
-        if message.tool_calls:
-            for tc in message.tool_calls:
-                print(f"DEBUG: Tool call args length: {len(tc.function.arguments)} chars")
+async def run_command_v2_chunked(request: LexicalDocumentRequest, single_pass: bool, tally: UsageTally) -> dict:
+    """
+    Map-reduce execution: run the instruction on section-aligned chunks in
+    parallel (bounded by CHUNK_PARALLELISM) and merge the change lists.
+    """
+    chunks = split_document(request.document)
+    semaphore = asyncio.Semaphore(CHUNK_PARALLELISM)
+    route = route_v2(request)  # one route for the whole request; chunks escalate on their own
+    finished = [None] * len(chunks)
+
+    async def run_chunk(part: int, blocks) -> dict:
+        chunk_request = request.model_copy(update={
+            "document": SimplifiedDocument(blocks=blocks),
+            "context_window": False,
+        })
+        note = CHUNK_NOTE.format(part=part + 1, parts=len(chunks))
+        async with semaphore:
+            # Chunk summaries are combined locally, so each chunk is a single pass
+            result, _ = await call_routed(
+                route, lambda route: complete_command_v2(chunk_request, True, tally, extra_note=note, route=route)
+            )
+        finished[part] = result
+        # Partial result for job mode: the merged changes of the chunks done in order so far
+        done = next((i for i, r in enumerate(finished) if r is None), len(chunks))
+        partial, _ = merge_chunk_changes(chunks[:done], [r.get("changes", []) for r in finished[:done]])
+        report_progress({"chunks_done": sum(r is not None for r in finished), "chunks": len(chunks), "changes": partial})
+        return result
+
+    results = await asyncio.gather(*(run_chunk(part, blocks) for part, blocks in enumerate(chunks)))
+
+    changes, dropped = merge_chunk_changes(chunks, [result.get("changes", []) for result in results])
+    reasonings = [result["reasoning"] for result in results if result.get("reasoning")]
+
+    chunk_stats = {
+        "chunks": len(chunks),
+        "parallelism": CHUNK_PARALLELISM,
+        "dropped_changes": len(dropped),
+    }
+    if changes:
+        return {
+            "type": "lexical_changes",
+            "reasoning": " ".join(reasonings),
+            "changes": changes,
+            "summary": local_block_summary(changes),
+            "execution": chunk_stats
+        }
+    return {
+        "type": "no_changes",
+        "summary": "No changes needed.",
+        "reasoning": " ".join(reasonings),
+        "execution": chunk_stats
+    }
 
-        # Check if response was truncated
-        if finish_reason == "length":
-            raise ValueError("Response was truncated due to length. Try a simpler request.")
+@app.post("/api/command/v2")
+async def process_ai_command_v2(request: LexicalDocumentRequest):
+    """
+    Process AI commands using Lexical JSON format.
+    Supports blank documents and structured block-level operations.
+    Large documents can be processed in parallel chunks (see chunking.py).
+    """
+    params = {
+        "model": routing_signature(),
+        "temperature": 0.3,
+        "single_pass": use_single_pass(request.single_pass),
+        "document_encoding": request.document_encoding,
+        "context_window": request.context_window,
+        "execution": request.execution,
+        "apply_changes": request.apply_changes,
+        "repair": use_repair(request.repair),
+    }
+    return await cached_call(
+        command_v2_key(request, params), lambda: run_command_v2(request), bypass=request.bypass_cache
+    )
 
-        tool_calls = message.tool_calls if message.tool_calls else []
+async def run_command_v2(request: LexicalDocumentRequest) -> dict:
+    try:
+        single_pass = use_single_pass(request.single_pass)
+        tally = UsageTally()
+        execution = request.execution or DEFAULT_EXECUTION
 
-        # Extract changes from tool calls
-        changes = []
-        for tool_call in tool_calls:
+        if should_chunk(request.document, request.instruction, execution):
+            result = await run_command_v2_chunked(request, single_pass, tally)
+        else:
             try:
-                args = json.loads(tool_call.function.arguments)
-                if tool_call.function.name == "edit_document":
-                    changes.extend(args.get("changes", []))
-            except json.JSONDecodeError as e:
-                print(f"JSON parse error: {e}")
-                print(f"Raw arguments (first 500 chars): {tool_call.function.arguments[:500]}")
-                print(f"Raw arguments (last 500 chars): {tool_call.function.arguments[-500:]}")
-                raise ValueError(f"Model returned malformed JSON. Try a simpler request or break it into smaller steps.")
-
-        # Get reasoning and summary
-        reasoning = ""
-        summary = ""
+                result, _ = await call_routed(
+                    route_v2(request), lambda route: complete_command_v2(request, single_pass, tally, route=route)
+                )
+            except TruncatedResponse:
+                # Too much output even after escalating: retry as map-reduce over chunks
+                if execution != "auto" or len(request.document.blocks) < 2:
+                    raise
+                result = await run_command_v2_chunked(request, single_pass, tally)
+
+        result = await attach_block_validation(result, request.document, request.apply_changes, use_repair(request.repair), tally)
+        annotate(**tally.finish("/api/command/v2", single_pass))
+        return result
+
+    except UpstreamError as e:
+        raise upstream_http_error(e)
+    except Exception as e:
+        import traceback
+        record_error(e)
+        print(f"Command V2 error: {str(e)}")
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Command processing error: {str(e)}")
 
-        if tool_calls:
-            messages.append(message.model_dump())
-            for tool_call in tool_calls:
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": "Applied successfully"
-                })
-
-            messages.append({
-                "role": "user",
-                "content": "Now provide your reasoning and summary in JSON format with fields: reasoning, summary"
+@app.post("/api/command/v2/stream")
+async def process_ai_command_v2_stream(request: LexicalDocumentRequest):
+    """
+    Streaming variant of /api/command/v2 (server-sent events).
+    Emits one `change` event per edit_document operation as soon as its JSON
+    object is complete (ops that can't apply to the document are sent as
+    `rejected` events instead), then a final `done` event with reasoning and
+    summary. Ops on nonexistent block ids are repaired: confident fixes are
+    emitted in place, the rest after one small follow-up call before `done`.
+    When the ops as streamed would land elsewhere in the editor (inserts
+    anchored on new blocks), `done` also carries `changes`: the same edit in
+    the editor's order, to apply instead.
+    """
+    single_pass = use_single_pass(request.single_pass)
+    repair = use_repair(request.repair)
+    route = route_v2(request)  # no escalation here: changes are already on their way to the client
+    with stage("build_prompt"):
+        messages, prompt_stats = build_v2_messages(request, single_pass, route=route)
+
+    async def events():
+        tally = UsageTally()
+        started = time.perf_counter()
+        first_change_ms = None
+        changes = []
+        rejected = []
+        validator = BlockValidator(request.document) if VALIDATION_ENABLED else None
+        repairer = BlockRepairer(request.document) if validator and repair else None
+        repair_report = {"failed": 0, "auto_fixed": 0, "model_fixed": 0, "follow_up_calls": 0}
+        unrepaired = {}  # edit number -> op, for the follow-up call
+        tool_calls = {}  # index -> {"id", "name", "parser"}
+        content_parts = []
+        finish_reason = None
+        try:
+            async for chunk in llm.stream_chat_completion(
+                model=route.model,
+                messages=messages,
+                tools=V2_TOOLS_SINGLE_PASS if single_pass else V2_TOOLS,
+                tool_choice="auto",
+                max_tokens=prompt_stats["prompt_budget"]["max_tokens"],
+                temperature=route.temperature
+            ):
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                delta = choice.delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                for tool_delta in delta.tool_calls or []:
+                    entry = tool_calls.setdefault(tool_delta.index, {"id": None, "name": "", "parser": ChangeStreamParser()})
+                    if tool_delta.id:
+                        entry["id"] = tool_delta.id
+                    if tool_delta.function is None:
+                        continue
+                    if tool_delta.function.name:
+                        entry["name"] += tool_delta.function.name
+                    if tool_delta.function.arguments:
+                        for change in entry["parser"].feed(tool_delta.function.arguments):
+                            if entry["name"] != "edit_document":
+                                continue
+                            error = validator.check(change) if validator else None
+                            if error and repairer and repairer.unknown_field(change):
+                                repair_report["failed"] += 1
+                                fixed = repairer.auto_fix(change)
+                                if fixed is not None and validator.check(fixed) is None:
+                                    repair_report["auto_fixed"] += 1
+                                    change, error = fixed, None
+                                else:
+                                    unrepaired[len(changes) + len(rejected)] = change
+                            if error:
+                                rejected.append({"index": len(changes) + len(rejected), "change": change, "reason": error})
+                                yield sse_event("rejected", rejected[-1])
+                                continue
+                            if first_change_ms is None:
+                                first_change_ms = round((time.perf_counter() - started) * 1000)
+                            changes.append(change)
+                            yield sse_event("change", change)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+            tally.calls += 1
+            ROUTE_STATS.record(route, time.perf_counter() - started, "truncated" if finish_reason == "length" else "ok")
+
+            if finish_reason == "length":
+                yield sse_event("error", {"detail": "Response was truncated due to length. Try a simpler request.", "changes_emitted": len(changes)})
+                return
+
+            if unrepaired:
+                fixes = await follow_up_block_fixes(repairer, dict(list(unrepaired.items())[:REPAIR_MAX_FOLLOW_UP]), tally, repair_report)
+                for edit, fixed in fixes.items():
+                    if validator.check(fixed) is None:
+                        repair_report["model_fixed"] += 1
+                        changes.append(fixed)
+                        yield sse_event("change", fixed)
+
+            reasoning = ""
+            summary = ""
+            edit_calls = [entry for entry in tool_calls.values() if entry["name"] == "edit_document"]
+            if edit_calls and single_pass:
+                inline = {}
+                for entry in edit_calls:
+                    args = entry["parser"].final_arguments()
+                    inline.update({key: args[key] for key in ("reasoning", "summary") if isinstance(args.get(key), str)})
+                reasoning = inline.get("reasoning", "")
+                summary = inline.get("summary") or local_block_summary(changes)
+            elif edit_calls:
+                assistant_message = {
+                    "role": "assistant",
+                    "content": "".join(content_parts) or None,
+                    "tool_calls": [
+                        {"id": entry["id"], "type": "function", "function": {"name": entry["name"], "arguments": entry["parser"].buffer}}
+                        for entry in tool_calls.values()
+                    ]
+                }
+                reasoning, summary = await summarize_tool_calls(
+                    messages, assistant_message, [entry["id"] for entry in tool_calls.values()],
+                    temperature=route.temperature, default_summary="Changes applied.", tally=tally
+                )
+            else:
+                summary = "".join(content_parts) or "No changes needed."
+
+            annotate(**tally.finish("/api/command/v2/stream", single_pass))
+            # Ops anchored on new blocks reach the editor in another order; send the list to apply instead
+            ordered = editor_block_changes(request.document, changes) if validator else changes
+            yield sse_event("done", {
+                "type": "lexical_changes" if changes else "no_changes",
+                **({"changes": ordered} if ordered != changes else {}),
+                "reasoning": reasoning,
+                "summary": summary,
+                "changes_count": len(changes),
+                "rejected_count": len(rejected) - repair_report["model_fixed"],
+                "repair": repair_report,
+                "time_to_first_change_ms": first_change_ms,
+                "total_ms": round((time.perf_counter() - started) * 1000),
+                **prompt_stats
             })
+        except UpstreamError as e:
+            record_error(e)
+            yield sse_event("error", {"detail": f"Upstream error: {str(e)}", "status": e.status, "retry_after": e.retry_after})
+        except Exception as e:
+            import traceback
+            record_error(e)
+            print(f"Command V2 stream error: {str(e)}")
+            print(traceback.format_exc())
+            yield sse_event("error", {"detail": f"Command processing error: {str(e)}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# ============== Editing sessions ==============
+# Create a session once with the full document, then send only patches and
+# instructions. See sessions.py for the document hash used to detect drift.
+
+def get_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return session
+
+def session_conflict(conflict: SessionConflict) -> HTTPException:
+    session_store.counters["conflicts"] += 1
+    return HTTPException(status_code=409, detail={
+        "error": "document_hash_mismatch",
+        "message": "The server's copy of the document differs; re-upload it with PUT /api/sessions/{id}/document",
+        "document_hash": conflict.session.hash,
+        "version": conflict.session.version,
+    })
+
+def patch_rejected(error: PatchRejected) -> HTTPException:
+    session_store.counters["rejected_patches"] += 1
+    return HTTPException(status_code=409, detail={
+        "error": "patch_rejected",
+        "message": "The patch does not apply to the server's copy of the document; nothing was applied. Re-upload it with PUT /api/sessions/{id}/document",
+        "rejected": error.rejected,
+        "document_hash": error.session.hash,
+        "version": error.session.version,
+    })
+
+@app.post("/api/sessions")
+async def create_session(request: SessionCreateRequest):
+    session = session_store.create(request.document)
+    return session.state()
+
+@app.get("/api/sessions/{session_id}")
+async def session_state(session_id: str, include_document: bool = False):
+    return get_session(session_id).state(include_document)
+
+@app.put("/api/sessions/{session_id}/document")
+async def resync_session(session_id: str, request: SessionCreateRequest):
+    """Replace the session's document (after a 409); history is kept."""
+    session = get_session(session_id)
+    async with session.lock:
+        session.replace_document(request.document)
+    session_store.touch(session)
+    return session.state()
+
+@app.post("/api/sessions/{session_id}/patch")
+async def patch_session(session_id: str, request: SessionPatchRequest):
+    """
+    Apply client-side edits (edit_document ops) to the session's document,
+    all of them or none (409 patch_rejected: resync).
+    """
+    session = get_session(session_id)
+    async with session.lock:
+        try:
+            session.check_base(request.base_hash)
+            session.apply_patch(request.changes)
+        except SessionConflict as conflict:
+            raise session_conflict(conflict)
+        except PatchRejected as error:
+            raise patch_rejected(error)
+    session_store.touch(session)
+    return {**session.state(), "rejected": []}
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"deleted": session_id}
+
+@app.post("/api/sessions/{session_id}/command")
+async def session_command(session_id: str, request: SessionCommandRequest):
+    """
+    /api/command/v2 against the session's document and history. Accepted
+    changes are applied to the session (update_session=true) only if the
+    document is still the one the model saw; if a patch arrived while the
+    model was running, nothing is applied (session.applied false, reason
+    "document_changed") and the client decides what to do with the changes.
+    """
+    session = get_session(session_id)
+    async with session.lock:
+        try:
+            session.check_base(request.base_hash)
+        except SessionConflict as conflict:
+            raise session_conflict(conflict)
+        base_hash = session.hash
+        v2_request = LexicalDocumentRequest(
+            document=session.document,
+            conversation_history=list(session.history),
+            **request.model_dump(exclude={"base_hash", "update_session"}),
+        )
 
-            final_response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
+    result = await process_ai_command_v2(v2_request)
+
+    async with session.lock:
+        session.add_turn(request.instruction, result.get("summary", ""))
+        rejected = []
+        applied = False
+        reason = None
+        if request.update_session and result.get("changes"):
+            if session.hash != base_hash:
+                # The ops were written against the older text; applying them would undo the patch
+                reason = "document_changed"
+            else:
+                rejected = session.apply(result["changes"])
+                applied = True
+    session_store.touch(session)
+    result["session"] = {**session.state(), "base_hash": base_hash, "applied": applied, "rejected": rejected}
+    if reason:
+        result["session"]["reason"] = reason
+    return result
+
+@app.get("/api/stats/sessions")
+async def sessions_stats():
+    return session_store.stats()
+
+
+# ============== Batch ==============
+# Several endpoint calls in one request, streamed back as they finish. Items
+# go through the endpoints' own handlers (cache, dedup, validation); see
+# batch.py for prefix sharing and conflict detection.
+
+BATCH_HANDLERS = {
+    "command": (DocumentRequest, process_ai_command),
+    "command/v2": (LexicalDocumentRequest, process_ai_command_v2),
+    "format": (FormatRequest, format_document),
+    "format/v2": (LexicalFormatRequest, format_document_v2),
+}
 
-            result = json.loads(final_response.choices[0].message.content)
-            reasoning = result.get("reasoning", "")
-            summary = result.get("summary", "Changes applied.")
-        else:
-            summary = message.content if message.content else "No changes needed."
+def prepare_batch_item(item: BatchItem, documents: dict, shared: bool):
+    """The item's request model with its document filled in; HTTPException if it is invalid."""
+    model, _ = BATCH_HANDLERS[item.endpoint]
+    field, kind = BATCH_ENDPOINTS[item.endpoint]
+    body = dict(item.request)
+    if item.document is not None:
+        if item.document not in documents:
+            raise HTTPException(status_code=400, detail=f"Unknown document: {item.document}")
+        document = documents[item.document]
+        if isinstance(document, str) != (kind == "markdown"):
+            expected = "markdown" if kind == "markdown" else "a SimplifiedDocument"
+            raise HTTPException(status_code=400, detail=f"{item.endpoint} needs {expected}; document {item.document} is not")
+        body[field] = document
+    if shared and "context_window" in model.model_fields and body.get("context_window") is None:
+        body["context_window"] = False  # whole document: the same prompt prefix for every item
+    try:
+        return model.model_validate(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
 
-        # Return response
-        if changes:
-            return {
-                "type": "lexical_changes",
-                "reasoning": reasoning,
-                "changes": changes,
-                "summary": summary
-            }
-        else:
+@app.post("/api/diff")
+async def diff_endpoint(request: DiffRequest):
+    """
+    Smallest change between two versions of a document, e.g. a full rewrite
+    the client received. Markdown gives word-level [op, text] chunks (-1
+    removed, 0 unchanged, 1 added), or with output "blocks" edit_document ops
+    on the blocks the markdown reads as; SimplifiedDocuments give
+    edit_document ops, each modify_segments/replace_block with its word diff.
+    """
+    original, suggested = request.original, request.suggested
+    if isinstance(original, str) != isinstance(suggested, str):
+        raise HTTPException(status_code=400, detail="original and suggested must both be markdown or both SimplifiedDocuments")
+    try:
+        if isinstance(original, str) and request.output != "blocks":
+            with stage("diff_text", chars=len(original) + len(suggested)):
+                chunks = text_diff(original, suggested)
             return {
-                "type": "no_changes",
-                "summary": summary,
-                "reasoning": reasoning
+                "diff": chunks,
+                "removed": sum(len(text) for op, text in chunks if op < 0),
+                "added": sum(len(text) for op, text in chunks if op > 0),
             }
-
+        if isinstance(original, str):
+            with stage("markdown_to_blocks"):
+                original, suggested = markdown_to_document(original), markdown_to_document(suggested)
+        with stage("diff_documents", blocks=len(original.blocks) + len(suggested.blocks)):
+            changes = diff_documents(original, suggested)
+        result = {"type": "lexical_changes" if changes else "no_changes", "changes": changes}
+        if request.output == "blocks" and isinstance(request.original, str):
+            result["document"] = {"blocks": [minimal_block_dict(block) for block in original.blocks]}
+        return result
     except Exception as e:
-        import traceback
-        print(f"Command V2 error: {str(e)}")
-        print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Command processing error: {str(e)}")
+        record_error(e)
+        print(f"Diff error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Diff error: {str(e)}")
+
+@app.post("/api/batch")
+async def batch_requests(request: BatchRequest, http_request: Request):
+    """
+    Run several /api/command, /api/command/v2, /api/format and /api/format/v2
+    calls with bounded concurrency (server-sent events): `start`, one `item`
+    event per item as it finishes (status 200 with the endpoint's result, or
+    the error status and detail), a `conflicts` event for each document whose
+    items' changes overlap, then `done`. Each item is rate limited as the call
+    it stands for (429/503 in its event, with retry_after).
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items: {len(request.items)} (max {BATCH_MAX_ITEMS})")
+    concurrency = max(1, min(request.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+
+    # Items on the same document (by key, else by content) form a group
+    groups = {}
+    for index, item in enumerate(request.items):
+        field, kind = BATCH_ENDPOINTS[item.endpoint]
+        key = item.document if item.document is not None else make_key("batch-document", {"document": item.request.get(field)})
+        group = groups.setdefault((kind, key), {"kind": kind, "document": item.document, "items": [], "content": None, "results": {}})
+        group["items"].append(index)
+
+    prepared = {}
+    invalid = {}
+    group_of = {}
+    for group in groups.values():
+        for index in group["items"]:
+            group_of[index] = group
+            try:
+                prepared[index] = prepare_batch_item(request.items[index], request.documents, len(group["items"]) > 1)
+            except HTTPException as e:
+                invalid[index] = e
+        group["pending"] = sum(index in prepared for index in group["items"])
+        valid = [index for index in group["items"] if index in prepared]
+        if valid and group["kind"] == "markdown":
+            group["content"] = prepared[valid[0]].content
+        # The first item warms the provider's prefix cache for the others
+        group["leader"] = valid[0] if (BATCH_WARM_PREFIX and len(valid) > 1) else None
+        group["warm"] = asyncio.Event() if group["leader"] is not None else None
+
+    semaphore = asyncio.Semaphore(concurrency)
+    user = user_key(http_request.scope)
+
+    async def run_item(index: int):
+        group = group_of[index]
+        started = time.perf_counter()
+        endpoint = request.items[index].endpoint
+        _, handler = BATCH_HANDLERS[endpoint]
+        # Weighed like the endpoint call itself, shared documents included
+        cost = request_cost(prepared[index].model_dump_json(exclude_none=True).encode("utf-8"))
+        try:
+            if group["warm"] is not None and index != group["leader"]:
+                await group["warm"].wait()
+            async with semaphore:
+                async with rate_limiter.admitted(user, LIMITED_ROUTES[f"/api/{endpoint}"], cost):
+                    return index, 200, await handler(prepared[index]), started
+        except Rejected as e:
+            return index, e.status, {"detail": e.detail, "retry_after": round(e.retry_after, 1)}, started
+        except HTTPException as e:
+            return index, e.status_code, {"detail": e.detail}, started
+        except Exception as e:
+            record_error(e)
+            return index, 500, {"detail": f"Batch item error: {str(e)}"}, started
+        finally:
+            if index == group["leader"]:
+                group["warm"].set()
+
+    def item_event(index: int, status: int, body: dict, started: float = None):
+        item = request.items[index]
+        event = {"index": index, "id": item.id, "endpoint": item.endpoint, "status": status}
+        event["result" if status == 200 else "error"] = body
+        if started is not None:
+            event["ms"] = round((time.perf_counter() - started) * 1000)
+        return sse_event("item", event)
+
+    async def events():
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(run_item(index)) for index in sorted(prepared)]
+        counts = {"succeeded": 0, "failed": len(invalid), "conflicts": 0}
+        try:
+            yield sse_event("start", {"items": len(request.items), "documents": len(groups), "concurrency": concurrency})
+            for index, error in sorted(invalid.items()):
+                yield item_event(index, error.status_code, {"detail": error.detail})
+            for next_done in asyncio.as_completed(tasks):
+                index, status, body, item_started = await next_done
+                counts["succeeded" if status == 200 else "failed"] += 1
+                yield item_event(index, status, body, item_started)
+
+                group = group_of[index]
+                if status == 200:
+                    group["results"][index] = body
+                group["pending"] -= 1
+                if group["pending"] == 0:
+                    with stage("conflicts", items=len(group["results"])):
+                        conflicts = find_conflicts(group["kind"], group["results"], group["content"])
+                    if conflicts:
+                        counts["conflicts"] += len(conflicts)
+                        yield sse_event("conflicts", {"document": group["document"], "items": group["items"], "conflicts": conflicts})
+            yield sse_event("done", {**counts, "items": len(request.items), "total_ms": round((time.perf_counter() - started) * 1000)})
+        finally:
+            # Client gone (or done): stop whatever is still running
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# ============== Job mode ==============
+# Submit returns a job id right away; see jobs.py for scheduling and storage.
+
+job_queue.register("format", lambda payload: format_document(FormatRequest.model_validate(payload)))
+job_queue.register("command_v2", lambda payload: process_ai_command_v2(LexicalDocumentRequest.model_validate(payload)))
+
+def job_user(http_request: Request) -> str:
+    """Fairness key: the rate limiter's user (X-User-ID from a trusted proxy, else the client address)."""
+    return user_key(http_request.scope)
+
+async def submit_job(kind: str, http_request: Request, payload: dict):
+    try:
+        job = await job_queue.submit(kind, job_user(http_request), payload)
+    except QueueFull as e:
+        return JSONResponse(status_code=429, content={"detail": str(e)}, headers={"Retry-After": str(e.retry_after)})
+    return JSONResponse(status_code=202, content={**job_state(job), "poll": f"/api/jobs/{job.id}"})
+
+def job_state(job) -> dict:
+    return {**job.state(), "queue_position": job_queue.position(job)}
+
+async def get_job(job_id: str):
+    job = await job_queue.lookup(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/jobs/format")
+async def submit_format_job(request: FormatRequest, http_request: Request):
+    return await submit_job("format", http_request, request.model_dump(exclude_none=True))
+
+@app.post("/api/jobs/command/v2")
+async def submit_command_v2_job(request: LexicalDocumentRequest, http_request: Request):
+    return await submit_job("command_v2", http_request, request.model_dump(exclude_none=True))
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    return job_state(await get_job(job_id))
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-sent `status` events on every change (progress included), ending
+    when the job finishes. Jobs run by another worker are polled from the store.
+    """
+    job = await get_job(job_id)
+
+    async def events():
+        current = job
+        while True:
+            yield sse_event("status", job_state(current))
+            if current.status in FINISHED:
+                return
+            if job_queue.live(current):
+                await current.wait_changed(timeout=15)
+            else:
+                await asyncio.sleep(JOB_POLL_SECONDS)
+            current = await job_queue.lookup(job_id) or current
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a job; one run by another worker stops within JOB_HEARTBEAT seconds."""
+    job = await get_job(job_id)
+    if not await job_queue.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    return job_state(await job_queue.lookup(job_id) or job)
+
+@app.get("/api/stats/jobs")
+async def jobs_stats():
+    return job_queue.stats()
+
+
+# ============== Metrics ==============
+# Request, stage, token and document metrics are recorded in metrics.py; the
+# counters the other components already keep are read at scrape time.
+
+def _counter_family(name: str, help: str, label: str, counters: dict, keys) -> tuple:
+    return (name, "counter", help, [({label: key}, counters[key]) for key in keys])
+
+@REGISTRY.collector
+def component_metrics() -> list:
+    cache = response_cache.stats()
+    dedup = inflight.stats()
+    upstream = upstream_stats()
+    jobs = job_queue.stats()
+    sessions = session_store.stats()
+    suggestions = autocomplete.suggestions.stats()
+    limits = rate_limiter.stats()
+    diffs = diff_stats()
+    return [
+        _counter_family("vrite_cache_events_total", "Response cache lookups and stores.", "event", cache,
+                        ("hits_memory", "hits_disk", "misses", "stores", "bypassed", "disk_errors")),
+        ("vrite_cache_memory_bytes", "gauge", "Bytes held by the in-memory response cache.", [({}, cache["memory_bytes"])]),
+        _counter_family("vrite_dedup_total", "In-flight request deduplication.", "result", dedup,
+                        ("leaders", "deduplicated", "abandoned")),
+        ("vrite_dedup_in_flight", "gauge", "Distinct computations in flight.", [({}, dedup["in_flight"])]),
+        _counter_family("vrite_upstream_total", "Upstream calls, attempts, retries and hedges.", "event", upstream,
+                        ("calls", "succeeded", "failed", "attempts", "retries", "deadline_exceeded", "hedges_fired", "hedge_wins")),
+        ("vrite_upstream_errors_total", "counter", "Failed upstream attempts by error.",
+         [({"error": error}, count) for error, count in sorted(upstream["errors"].items())]),
+        ("vrite_upstream_breaker_open", "gauge", "1 while the upstream circuit breaker is not closed.",
+         [({}, int(upstream["breaker"]["state"] != "closed"))]),
+        _counter_family("vrite_upstream_breaker_total", "Circuit breaker openings and short-circuited calls.", "event",
+                        upstream["breaker"], ("opened", "short_circuited")),
+        _counter_family("vrite_jobs_total", "Jobs by outcome.", "status", jobs,
+                        ("submitted", "rejected", "succeeded", "failed", "cancelled", "recovered")),
+        ("vrite_jobs", "gauge", "Jobs queued and running.", [({"status": "queued"}, jobs["queued"]), ({"status": "running"}, jobs["running"])]),
+        _counter_family("vrite_sessions_events_total", "Editing session lifecycle events.", "event", sessions,
+                        ("created", "evicted", "expired", "conflicts", "rejected_patches")),
+        ("vrite_sessions", "gauge", "Live editing sessions.", [({}, sessions["sessions"])]),
+        ("vrite_sessions_bytes", "gauge", "Size of the documents held by editing sessions.", [({}, sessions["bytes"])]),
+        _counter_family("vrite_autocomplete_cache_total", "Autocomplete prefix cache lookups and stores.", "event", suggestions,
+                        ("hits", "prefix_hits", "misses", "stores", "evictions")),
+        _counter_family("vrite_ratelimit_total", "Rate-limited requests: admitted, limited (429), queued, rejected_busy (503).", "result", limits,
+                        ("admitted", "limited", "queued", "rejected_busy")),
+        ("vrite_ratelimit_limited_total", "counter", "429s by endpoint group.",
+         [({"group": group}, count) for group, count in sorted(limits["limited_by_group"].items())]),
+        ("vrite_ratelimit_tokens_total", "counter", "Estimated prompt tokens admitted.", [({}, limits["tokens_admitted"])]),
+        ("vrite_admission", "gauge", "Requests holding and waiting for an admission slot.",
+         [({"state": "in_flight"}, limits["in_flight"]), ({"state": "waiting"}, limits["waiting"])]),
+        ("vrite_diff_ops_total", "counter", "edit_document ops before and after minimizing by diff.",
+         [({"stage": "before"}, diffs["ops_before"]), ({"stage": "after"}, diffs["ops_after"])]),
+        ("vrite_autocomplete_superseded_total", "counter", "Autocomplete model calls cancelled by a newer request from the same session.",
+         [({}, autocomplete.session_calls.counters["superseded"])]),
+    ]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import env_float, env_int
+from metrics import record_autocomplete
+from resilience import LatencyWindow
+from tokens import CHARS_PER_TOKEN, count_tokens
+
+# ============== Inline autocomplete ==============
+# /api/autocomplete fires on nearly every pause in typing, so it is tuned for
+# tail latency rather than quality:
+#   - Context cap: only the last AUTOCOMPLETE_CONTEXT_TOKENS tokens before the
+#     cursor are sent, cut at a word boundary.
+#   - Prefix cache: a suggestion stays valid while the user types the text it
+#     predicted. "The results" -> " show a clear trend." is stored once; "The
+#     results sh" is then answered locally with "ow a clear trend." and no
+#     model call.
+#   - Superseding: each editor session has at most one model call in flight.
+#     A new request from the session cancels the previous call; the older
+#     request answers with an empty, superseded suggestion.
+#   - Latency: p50/p99 per source (cache, model) are kept apart from the
+#     editing endpoints (/api/stats/autocomplete).
+
+AUTOCOMPLETE_CONTEXT_TOKENS = env_int("AUTOCOMPLETE_CONTEXT_TOKENS", 400)
+AUTOCOMPLETE_TIMEOUT = env_float("AUTOCOMPLETE_TIMEOUT", 5.0)           # whole call, retries included
+AUTOCOMPLETE_CACHE_ENTRIES = env_int("AUTOCOMPLETE_CACHE_ENTRIES", 2000)
+AUTOCOMPLETE_CACHE_TTL = env_float("AUTOCOMPLETE_CACHE_TTL", 600.0)
+ANCHOR_CHARS = 48  # tail of the context used as the cache key
+
+SYSTEM_PROMPT = (
+    "You are an AI writing assistant. Provide concise, natural text completions. "
+    "Complete the user's sentence or thought in 1-2 sentences. Do not add explanations or meta-commentary."
+)
+
+_WORD_START_RE = re.compile(r"\s+")
+
+
+def cap_context(context: str, budget: int = AUTOCOMPLETE_CONTEXT_TOKENS) -> str:
+    """The end of `context` (the text before the cursor) within `budget` tokens."""
+    chars = int(budget * CHARS_PER_TOKEN)
+    if len(context) <= chars and count_tokens(context) <= budget:
+        return context
+    tail = context[-chars:]
+    while count_tokens(tail) > budget:
+        tail = tail[len(tail) // 10 or 1:]
+    # Don't start on half a word
+    match = _WORD_START_RE.search(tail)
+    if match and match.end() < len(tail):
+        tail = tail[match.end():]
+    return tail
+
+
+def autocomplete_messages(context: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f'Complete this text naturally: "{context}"'},
+    ]
+
+
+def normalize_completion(context: str, text: Optional[str]) -> str:
+    """
+    The text to insert at the cursor: the first paragraph of the answer, with
+    a separating space when the context ends mid-line on a word and the answer
+    starts a new one (models drop the leading space).
+    """
+    text = (text or "").split("\n\n", 1)[0].split("---", 1)[0].strip()
+    if text.count('"') % 2 or (len(text) > 1 and text[0] == text[-1] == '"'):
+        text = text.strip('"').strip()  # the model echoed the quotes around the context
+    if text and context and not context[-1].isspace() and text[0].isalnum():
+        text = " " + text
+    return text
+
+
+class _Suggestion:
+    def __init__(self, context: str, completion: str, ttl: float):
+        self.context = context
+        self.completion = completion
+        self.expires_at = time.monotonic() + ttl
+
+
+class PrefixCache:
+    """
+    Suggestions keyed by (model, max_tokens, last ANCHOR_CHARS of the context
+    the model saw). A lookup tries every split of the request context into
+    "context the model saw" + "text typed since", for typed lengths up to the
+    longest stored completion, so the cost is bounded by that length and not
+    by the size of the document.
+    """
+
+    def __init__(self, max_entries: int = AUTOCOMPLETE_CACHE_ENTRIES, ttl: float = AUTOCOMPLETE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._longest = 0
+        self.counters = {"hits": 0, "prefix_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def _key(model: str, max_tokens: int, context: str, end: int) -> tuple:
+        return model, max_tokens, context[max(0, end - ANCHOR_CHARS):end]
+
+    def get(self, context: str, model: str, max_tokens: int) -> Optional[str]:
+        """The rest of a cached suggestion that `context` is typing out, if any."""
+        now = time.monotonic()
+        for typed in range(min(self._longest, len(context)) + 1):
+            end = len(context) - typed
+            key = self._key(model, max_tokens, context, end)
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry.expires_at < now:
+                del self._entries[key]
+                continue
+            if not context.endswith(entry.context, 0, end):
+                continue
+            if typed < len(entry.completion) and entry.completion.startswith(context[end:]):
+                self._entries.move_to_end(key)
+                self.counters["prefix_hits" if typed else "hits"] += 1
+                return entry.completion[typed:]
+        self.counters["misses"] += 1
+        return None
+
+    def set(self, context: str, model: str, max_tokens: int, completion: str):
+        if not completion:
+            return
+        key = self._key(model, max_tokens, context, len(context))
+        self._entries.pop(key, None)
+        self._entries[key] = _Suggestion(context, completion, self.ttl)
+        self._longest = max(self._longest, len(completion))
+        self.counters["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._longest = 0
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["prefix_hits"] + self.counters["misses"]
+        hits = self.counters["hits"] + self.counters["prefix_hits"]
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "hit_rate_pct": round(100 * hits / lookups, 1) if lookups else 0.0,
+        }
+
+
+class Superseded(Exception):
+    """A newer request from the same session replaced this one."""
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.superseded = False
+
+
+class SessionCalls:
+    """At most one call in flight per session; starting one cancels the previous."""
+
+    def __init__(self):
+        self._calls = {}
+        self.counters = {"started": 0, "superseded": 0}
+
+    async def run(self, session_id: str, fn):
+        previous = self._calls.get(session_id)
+        if previous is not None and not previous.task.done():
+            previous.superseded = True
+            previous.task.cancel()
+            self.counters["superseded"] += 1
+        call = _Call(asyncio.ensure_future(fn()))
+        self._calls[session_id] = call
+        self.counters["started"] += 1
+        try:
+            return await call.task
+        except asyncio.CancelledError:
+            # Our own request being cancelled is not a supersede
+            if call.superseded and not asyncio.current_task().cancelling():
+                raise Superseded() from None
+            raise
+        finally:
+            if self._calls.get(session_id) is call:
+                del self._calls[session_id]
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self._calls)}
+
+
+suggestions = PrefixCache()
+session_calls = SessionCalls()
+latencies = LatencyWindow(size=1000)  # keyed by source: "cache", "model", "superseded"
+
+
+def stats() -> dict:
+    return {
+        "cache": suggestions.stats(),
+        "sessions": session_calls.stats(),
+        "latency": latencies.stats(),
+        "context_tokens": AUTOCOMPLETE_CONTEXT_TOKENS,
+    }
+
+
+def record(source: str, started: float):
+    """Latency of one request, from `started` (perf_counter), by where the suggestion came from."""
+    seconds = time.perf_counter() - started
+    latencies.add(source, seconds)
+    record_autocomplete(source, seconds)
@@ -0,0 +1,135 @@
+import os
+from typing import Dict, List, Optional
+
+from config import env_int
+from edit_engine import BLOCK_OPERATIONS, validate_text_changes
+
+# ============== Batch requests ==============
+# /api/batch runs N items (an endpoint plus its usual request body) in one
+# HTTP request, with bounded concurrency, streaming each result as it
+# finishes. Documents can be sent once in `documents` and referenced by key
+# from any number of items.
+#
+# Shared prompt prefix: the prompt layout (prompts.py) puts the static system
+# prompt first and the document second, so calls on the same document share
+# everything up to the instruction. Within a group of items on one document
+# the relevance window is turned off (unless an item sets context_window) so
+# the document message is byte-identical, and with BATCH_WARM_PREFIX the first
+# item of the group runs alone before the others, letting the provider cache
+# that prefix for the rest.
+#
+# Conflicts: once every item on a document has finished, their change lists
+# are compared. edit_document ops conflict when two items modify, replace or
+# delete the same block, insert after a block the other removes, or insert
+# at the same anchor (the order between them is undefined). replace_text
+# changes conflict when their resolved text ranges overlap. /api/format items
+# with output "blocks" answer a markdown document with edit_document ops on
+# the blocks it reads as (ids depend only on the markdown), so they are
+# compared with each other like V2 items.
+
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", 8)
+BATCH_MAX_ITEMS = env_int("BATCH_MAX_ITEMS", 500)
+BATCH_WARM_PREFIX = os.getenv("BATCH_WARM_PREFIX", "true").lower() in ("1", "true", "yes")
+
+# endpoint -> (document field of its request model, document kind)
+BATCH_ENDPOINTS = {
+    "command": ("content", "markdown"),
+    "format": ("content", "markdown"),
+    "command/v2": ("document", "lexical"),
+    "format/v2": ("document", "lexical"),
+}
+
+START_ANCHOR = None  # afterBlockId of an insert at the start of the document
+
+
+# ============== Change footprints ==============
+
+class BlockFootprint:
+    """What a list of edit_document ops touches in the original document."""
+
+    def __init__(self, changes: List[dict]):
+        self.modified = set()  # modify_segments
+        self.removed = set()   # replace_block, delete_block
+        self.anchors = set()   # afterBlockId of insert_block (None: start of the document)
+        for change in changes:
+            operation = change.get("operation")
+            if operation == "insert_block":
+                self.anchors.add(change.get("afterBlockId"))
+            elif operation == "modify_segments":
+                self.modified.add(change.get("blockId"))
+            elif operation in ("replace_block", "delete_block"):
+                self.removed.add(change.get("blockId"))
+
+    @property
+    def written(self) -> set:
+        return self.modified | self.removed
+
+
+def block_conflicts(footprints: Dict[int, BlockFootprint]) -> List[dict]:
+    """Pairwise conflicts between the items' edit_document ops, in item order."""
+    conflicts = []
+    items = sorted(footprints)
+    for n, first in enumerate(items):
+        a = footprints[first]
+        for second in items[n + 1:]:
+            b = footprints[second]
+            reasons = {
+                "same_block": a.written & b.written,
+                "anchor_removed": (a.anchors & b.removed) | (b.anchors & a.removed),
+                "same_anchor": a.anchors & b.anchors,
+            }
+            for reason, block_ids in reasons.items():
+                if block_ids:
+                    conflicts.append({
+                        "items": [first, second],
+                        "reason": reason,
+                        "block_ids": sorted(block_ids, key=lambda block_id: (block_id is not None, block_id or "")),
+                    })
+    return conflicts
+
+
+def text_spans(content: str, changes: List[dict]) -> List[tuple]:
+    """(start, end) of every replace_text change that resolves in `content`."""
+    if changes and all("position" in change for change in changes):
+        resolved = changes  # already validated by the endpoint
+    else:
+        resolved = validate_text_changes(content, changes)["changes"]
+    return [
+        (change["position"], change["position"] + len(change["old_text"]))
+        for change in resolved if change.get("position") is not None
+    ]
+
+
+def text_conflicts(spans: Dict[int, List[tuple]]) -> List[dict]:
+    """
+    Overlapping ranges between different items: one sweep over all spans
+    sorted by start, keeping the spans still open.
+    """
+    events = sorted((start, end, item) for item, item_spans in spans.items() for start, end in item_spans)
+    open_spans = []
+    found = {}
+    for start, end, item in events:
+        open_spans = [span for span in open_spans if span[1] > start]
+        for other_start, other_end, other in open_spans:
+            if other != item:
+                pair = (min(item, other), max(item, other))
+                found.setdefault(pair, []).append([max(start, other_start), min(end, other_end)])
+        open_spans.append((start, end, item))
+    return [{"items": list(pair), "reason": "overlapping_text", "ranges": ranges} for pair, ranges in sorted(found.items())]
+
+
+def find_conflicts(kind: str, results: Dict[int, dict], content: Optional[str] = None) -> List[dict]:
+    """Conflicts between the successful results of items on one document."""
+    with_changes = {index: result.get("changes") or [] for index, result in results.items()}
+    with_changes = {index: changes for index, changes in with_changes.items() if changes}
+    if kind == "lexical":
+        block_ops, text_changes = with_changes, {}
+    else:
+        block_ops = {index: changes for index, changes in with_changes.items() if changes[0].get("operation") in BLOCK_OPERATIONS}
+        text_changes = {index: changes for index, changes in with_changes.items() if index not in block_ops}
+    conflicts = []
+    if len(block_ops) > 1:
+        conflicts += block_conflicts({index: BlockFootprint(changes) for index, changes in block_ops.items()})
+    if len(text_changes) > 1:
+        conflicts += text_conflicts({index: text_spans(content, changes) for index, changes in text_changes.items()})
+    return conflicts
@@ -0,0 +1,76 @@
+import argparse
+import json
+import sys
+
+# ============== Comparing benchmark results ==============
+# Matches the cells of two bench/load.py result files by (endpoint, size,
+# concurrency) and flags regressions: p95 latency or backend CPU per request
+# up, or throughput down, by more than the threshold (percent).
+
+# (label, getter, True when higher is worse)
+FIELDS = (
+    ("rps", lambda row: row["throughput_rps"], False),
+    ("p50", lambda row: row["latency_ms"]["p50"], True),
+    ("p95", lambda row: row["latency_ms"]["p95"], True),
+    ("p99", lambda row: row["latency_ms"]["p99"], True),
+    ("cpu", lambda row: row["backend_cpu_ms_per_request"], True),
+)
+CHECKED = ("rps", "p95", "cpu")
+
+
+def _key(row: dict) -> tuple:
+    return row["endpoint"], row["size"], row["concurrency"]
+
+
+def _change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> tuple:
+    """Returns (rows, regressions); each row is (key, {label: (old, new, pct, regressed)})."""
+    old_rows = {_key(row): row for row in baseline["results"]}
+    rows = []
+    regressions = 0
+    for row in current["results"]:
+        old = old_rows.get(_key(row))
+        if old is None:
+            continue
+        fields = {}
+        for label, get, higher_is_worse in FIELDS:
+            pct = _change(get(old), get(row))
+            regressed = label in CHECKED and (pct > threshold if higher_is_worse else pct < -threshold)
+            regressions += regressed
+            fields[label] = (get(old), get(row), pct, regressed)
+        rows.append((_key(row), fields))
+    return rows, regressions
+
+
+def print_comparison(rows: list, baseline: dict, current: dict):
+    print(f"\n{baseline['version']['commit']} -> {current['version']['commit']}")
+    print(f"{'endpoint':<11} {'size':<9} {'conc':>4} " + " ".join(f"{label:>16}" for label, _, _ in FIELDS))
+    for (endpoint, size, concurrency), fields in rows:
+        cells = []
+        for label, _, _ in FIELDS:
+            old, new, pct, regressed = fields[label]
+            cells.append(f"{new:>8.1f} {pct:+6.1f}%{'!' if regressed else ' '}")
+        print(f"{endpoint:<11} {size:<9} {concurrency:>4} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two bench/load.py result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args()
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    rows, regressions = compare(baseline, current, args.threshold)
+    print_comparison(rows, baseline, current)
+    print(f"\n{regressions} regression(s) beyond {args.threshold:g}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import random
+import sys
+import time
+
+from bench.documents import SIZES, markdown_document
+from markdown_blocks import document_to_markdown, iter_markdown, iter_markdown_blocks, markdown_to_document
+from models import SimplifiedDocument
+
+# ============== Markdown <-> SimplifiedDocument converter ==============
+# Round-trip properties of markdown_blocks.py on random inputs, then
+# conversion throughput on the benchmark documents.
+#
+#   document -> markdown -> document is the identity (ignoring ids) for
+#     documents the markdown subset can express: no empty paragraphs,
+#     formatted runs separated by unformatted text, lines without leading or
+#     trailing whitespace
+#   markdown -> document -> markdown -> document gives the same blocks and
+#     ids for any markdown, and the second markdown is a fixed point
+#
+#   python -m bench.convert                       # 2000 cases each, 500-page throughput
+#   python -m bench.convert --cases 20000 --sizes 50-page 500-page
+
+# Words chosen to hit the escapes: emphasis, block markers, backslashes
+_WORDS = (
+    "alpha beta gamma delta the of and results study * ** *** \\ \\* # ## - + 1. 2) 10. ``` ~~~ "
+    "a*b 2*3*4 snake_case C:\\path x** **y #tag -1 +/- 3.14 {braces} [link] `code`"
+).split()
+_MARKDOWN_ALPHABET = "ab  **\\#-+1.)`~\n\n\t_"
+
+
+def _phrase(rng: random.Random) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def _segments(rng: random.Random, lines: int) -> list:
+    segments = []
+    for line in range(lines):
+        if line:
+            segments.append({"text": "\n", "format": 0})
+        for index in range(rng.randint(1, 4)):
+            if index:
+                segments.append({"text": " ", "format": 0})
+            segments.append({"text": _phrase(rng), "format": rng.choice((0, 0, 1, 2, 3))})
+    return segments
+
+
+def random_document(rng: random.Random, blocks: int) -> SimplifiedDocument:
+    """A document inside the markdown subset (see above)."""
+    out = []
+    indent = 0
+    for index in range(blocks):
+        kind = rng.choice(("paragraph", "paragraph", "heading", "list-item", "list-item"))
+        block = {"id": f"r{index}", "type": kind}
+        if kind == "heading":
+            block["tag"] = rng.choice(("h1", "h2", "h3"))
+            block["segments"] = _segments(rng, 1)
+        elif kind == "list-item":
+            indent = rng.randint(0, indent + 1) if out and out[-1]["type"] == "list-item" else 0
+            block.update(listType=rng.choice(("bullet", "number")), indent=min(indent, 3))
+            block["segments"] = _segments(rng, rng.choice((1, 1, 2)))
+        else:
+            block["segments"] = _segments(rng, rng.choice((1, 1, 2, 3)))
+        out.append(block)
+    return SimplifiedDocument.model_validate({"blocks": out})
+
+
+def _blocks(document: SimplifiedDocument, ids: bool = True) -> list:
+    """Blocks with normalized segments, for comparing documents."""
+    out = []
+    for block in document.blocks:
+        segments = [(segment.text, segment.format) for segment in block.segments if segment.text]
+        merged = []
+        for text, fmt in segments:
+            if merged and merged[-1][1] == fmt:
+                merged[-1] = (merged[-1][0] + text, fmt)
+            else:
+                merged.append((text, fmt))
+        out.append((block.id if ids else None, block.type, block.tag, block.listType, block.indent, merged))
+    return out
+
+
+def check_round_trips(cases: int, seed: int) -> int:
+    rng = random.Random(seed)
+    failures = 0
+    for case in range(cases):
+        document = random_document(rng, rng.randint(1, 12))
+        markdown = document_to_markdown(document)
+        if _blocks(markdown_to_document(markdown), ids=False) != _blocks(document, ids=False):
+            failures += 1
+            if failures <= 3:
+                print(f"document round trip failed (case {case}):\n{markdown!r}")
+
+        source = "".join(rng.choice(_MARKDOWN_ALPHABET) for _ in range(rng.randint(0, 80)))
+        first = markdown_to_document(source)
+        markdown = document_to_markdown(first)
+        second = markdown_to_document(markdown)
+        if _blocks(second) != _blocks(first) or document_to_markdown(second) != markdown:
+            failures += 1
+            if failures <= 3:
+                print(f"markdown round trip failed (case {case}):\n{source!r}\n{markdown!r}")
+    return failures
+
+
+def throughput(size: str, repeat: int) -> dict:
+    markdown = markdown_document(SIZES[size])
+    parse = render = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        blocks = list(iter_markdown_blocks(markdown))
+        parse = min(parse, time.perf_counter() - started)
+        started = time.perf_counter()
+        out = "".join(iter_markdown(blocks))
+        render = min(render, time.perf_counter() - started)
+    megabytes = len(markdown.encode()) / 1e6
+    return {
+        "size": size,
+        "blocks": len(blocks),
+        "mb": megabytes,
+        "parse_ms": parse * 1000,
+        "render_ms": render * 1000,
+        "parse_mb_s": megabytes / parse,
+        "render_mb_s": megabytes / render,
+        "stable": out == document_to_markdown(markdown_to_document(out)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-trip checks and throughput of the markdown converter.")
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=["500-page"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = check_round_trips(args.cases, args.seed)
+    print(f"round trips: {args.cases} documents + {args.cases} markdown inputs, {failures} failure(s)")
+
+    print(f"\n{'size':<9} {'blocks':>7} {'MB':>6} {'parse ms':>9} {'MB/s':>6} {'render ms':>10} {'MB/s':>6}")
+    for size in args.sizes:
+        row = throughput(size, args.repeat)
+        print(f"{row['size']:<9} {row['blocks']:>7} {row['mb']:>6.2f} {row['parse_ms']:>9.1f} {row['parse_mb_s']:>6.1f} "
+              f"{row['render_ms']:>10.1f} {row['render_mb_s']:>6.1f}{'' if row['stable'] else '  (not stable)'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
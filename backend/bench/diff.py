@@ -0,0 +1,166 @@
+import argparse
+import random
+import sys
+import time
+
+from bench.convert import random_document
+from bench.documents import SIZES, simplified_document
+from doc_diff import diff_documents, minimize_block_changes, text_diff, word_diff
+from edit_engine import apply_block_changes, apply_editor_changes, validate_block_changes
+from models import SimplifiedDocument, TextSegment
+
+# ============== Block and word diff ==============
+# Correctness of doc_diff.py on random inputs, then timing on the benchmark
+# documents.
+#
+#   diff_documents(old, new) ops are all valid against old, and applying them
+#     gives new's blocks (ids aside), both as the model means them
+#     (apply_block_changes) and as the editor applies them, list grouping
+#     included (apply_editor_changes)
+#   word_diff / text_diff chunks rebuild both texts, none empty, no two
+#     neighbours with the same op
+#
+# Timing: the 500-page document with --edits blocks edited by one word and a
+# tenth as many deleted, the same edits sent as model-style replace_block ops
+# and minimized, and a full rewrite (an unrelated document of the same size).
+#
+#   python -m bench.diff                          # 2000 cases, 500-page timing
+#   python -m bench.diff --cases 20000 --sizes 50-page 500-page --edits 1000
+
+_TEXT_WORDS = "the big dog ran , fast . over  the\n lazy cat\n\n".split(" ")
+
+
+def _content(document: SimplifiedDocument) -> list:
+    out = []
+    for block in document.blocks:
+        merged = []
+        for segment in block.segments:
+            if not segment.text:
+                continue
+            if merged and merged[-1][1] == segment.format:
+                merged[-1] = (merged[-1][0] + segment.text, segment.format)
+            else:
+                merged.append((segment.text, segment.format))
+        out.append((block.type, block.tag, block.listType, block.indent, merged))
+    return out
+
+
+def _edited(rng: random.Random, document: SimplifiedDocument, case: int) -> SimplifiedDocument:
+    """`document` with a few blocks inserted, deleted, rewritten or retyped."""
+    blocks = list(document.blocks)
+    for edit in range(rng.randint(0, 5)):
+        position = rng.randint(0, len(blocks))
+        other = random_document(rng, 1).blocks[0]
+        roll = rng.random()
+        if roll < 0.3:
+            blocks.insert(position, other.model_copy(update={"id": f"n{case}-{edit}"}))
+        elif not blocks:
+            continue
+        elif roll < 0.6:
+            del blocks[min(position, len(blocks) - 1)]
+        else:
+            position = min(position, len(blocks) - 1)
+            if rng.random() < 0.5:
+                blocks[position] = blocks[position].model_copy(update={"segments": other.segments})
+            else:
+                blocks[position] = other.model_copy(update={"id": blocks[position].id})
+    return SimplifiedDocument(blocks=blocks)
+
+
+def check_diffs(cases: int, seed: int) -> int:
+    rng = random.Random(seed)
+    failures = 0
+    for case in range(cases):
+        old = random_document(rng, rng.randint(0, 15))
+        new = random_document(rng, rng.randint(0, 15)) if rng.random() < 0.3 else _edited(rng, old, case)
+        changes = diff_documents(old, new)
+        rejected = validate_block_changes(old, changes)["rejected"]
+        if rejected or _content(apply_block_changes(old, changes)) != _content(new) \
+                or _content(apply_editor_changes(old, changes)) != _content(new):
+            failures += 1
+            if failures <= 3:
+                print(f"block diff failed (case {case}): {rejected or changes}")
+
+        old_text = " ".join(rng.choice(_TEXT_WORDS) for _ in range(rng.randint(0, 20)))
+        new_text = " ".join(rng.choice(_TEXT_WORDS) for _ in range(rng.randint(0, 20)))
+        for diff in (word_diff, text_diff):
+            chunks = diff(old_text, new_text)
+            ok = (
+                "".join(text for op, text in chunks if op <= 0) == old_text
+                and "".join(text for op, text in chunks if op >= 0) == new_text
+                and all(text for op, text in chunks)
+                and all(chunks[k][0] != chunks[k + 1][0] for k in range(len(chunks) - 1))
+            )
+            if not ok:
+                failures += 1
+                if failures <= 3:
+                    print(f"{diff.__name__} failed (case {case}): {old_text!r} -> {new_text!r}: {chunks}")
+    return failures
+
+
+def timing(size: str, edits: int, repeat: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    document = SimplifiedDocument.model_validate(simplified_document(SIZES[size]))
+    blocks = list(document.blocks)
+    replaces = []
+    for index in rng.sample(range(len(blocks)), min(edits, len(blocks))):
+        words = "".join(segment.text for segment in blocks[index].segments).split(" ")
+        words[rng.randrange(len(words))] = "changed"
+        blocks[index] = blocks[index].model_copy(update={"segments": [TextSegment(text=" ".join(words), format=0)]})
+        replaces.append({"operation": "replace_block", "blockId": blocks[index].id,
+                         "newBlock": {**blocks[index].model_dump(exclude_none=True), "id": f"{blocks[index].id}-new"}})
+    edited = SimplifiedDocument.model_validate({"blocks": [block.model_dump() for block in blocks]})
+    for index in sorted(rng.sample(range(len(blocks)), len(replaces) // 10), reverse=True):
+        del blocks[index]
+    trimmed = SimplifiedDocument.model_validate({"blocks": [block.model_dump() for block in blocks]})
+    rewrite = SimplifiedDocument.model_validate(simplified_document(SIZES[size], seed=seed + 1))
+
+    def best(run):
+        elapsed = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            out = run()
+            elapsed = min(elapsed, time.perf_counter() - started)
+        return elapsed * 1000, out
+
+    edit_ms, edit_ops = best(lambda: diff_documents(document, trimmed))
+    minimize_ms, minimized = best(lambda: minimize_block_changes(document, [dict(change) for change in replaces]))
+    rewrite_ms, rewrite_ops = best(lambda: diff_documents(document, rewrite))
+    return {
+        "size": size,
+        "blocks": len(document.blocks),
+        "edit_ms": edit_ms,
+        "edit_ops": len(edit_ops),
+        "minimize_ms": minimize_ms,
+        "model_ops": len(replaces),
+        "modify_ops": sum(change["operation"] == "modify_segments" for change in minimized),
+        "same": _content(apply_editor_changes(document, minimized)) == _content(edited),
+        "rewrite_ms": rewrite_ms,
+        "rewrite_ops": len(rewrite_ops),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Correctness checks and timing of the block/word diff.")
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=["500-page"])
+    parser.add_argument("--edits", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = check_diffs(args.cases, args.seed)
+    print(f"diffs: {args.cases} document pairs + {args.cases} text pairs, {failures} failure(s)")
+
+    print(f"\n{'size':<9} {'blocks':>7} {'edit ms':>8} {'ops':>5} {'minimize ms':>12} {'replace->modify':>16} {'rewrite ms':>11} {'ops':>6}")
+    for size in args.sizes:
+        row = timing(size, args.edits, args.repeat, args.seed)
+        failures += not row["same"]
+        print(f"{row['size']:<9} {row['blocks']:>7} {row['edit_ms']:>8.1f} {row['edit_ops']:>5} {row['minimize_ms']:>12.1f} "
+              f"{row['model_ops']:>7} -> {row['modify_ops']:<6} {row['rewrite_ms']:>11.1f} {row['rewrite_ops']:>6}"
+              f"{'' if row['same'] else '  (minimized ops give a different document)'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import random
+from functools import lru_cache
+
+# ============== Benchmark documents ==============
+# Deterministic SimplifiedDocuments (and their markdown) of a given length:
+# a title, a section heading per page, paragraphs with some bold/italic
+# segments, and the odd bulleted list. Block ids are "blk-000123" so the fake
+# server can find them in prompts.
+
+WORDS_PER_PAGE = 500
+SIZES = {"small": 1, "50-page": 50, "500-page": 500}
+
+_WORDS = (
+    "analysis approach argument assessment assumption budget capacity context contribution data decision "
+    "design development discussion distribution effect environment evaluation evidence experience factor "
+    "framework function growth hypothesis impact implementation improvement income individual interpretation "
+    "issue knowledge literature method model network objective outcome participant pattern performance period "
+    "perspective policy population practice principle priority procedure process property proportion range "
+    "relationship research resource response result role sample sector significance source strategy structure "
+    "study survey system technique theory trend value variable the of and to in that is for with as on by"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng: random.Random) -> list:
+    """Segments of one paragraph; roughly one in four gets a bold or italic phrase."""
+    sentences = [_sentence(rng) for _ in range(rng.randint(3, 6))]
+    text = " ".join(sentences)
+    if rng.random() < 0.25:
+        words = text.split(" ")
+        start = rng.randint(1, max(1, len(words) - 4))
+        return [
+            {"text": " ".join(words[:start]) + " ", "format": 0},
+            {"text": " ".join(words[start:start + 3]), "format": rng.choice((1, 2))},
+            {"text": " " + " ".join(words[start + 3:]), "format": 0},
+        ]
+    return [{"text": text, "format": 0}]
+
+
+def _words(segments: list) -> int:
+    return sum(len(segment["text"].split()) for segment in segments)
+
+
+@lru_cache(maxsize=16)
+def _simplified_document(pages: int, seed: int) -> str:
+    rng = random.Random(seed)
+    blocks = []
+
+    def add(block_type: str, segments: list, **extra):
+        blocks.append({"id": f"blk-{len(blocks):06d}", "type": block_type, **extra, "segments": segments})
+
+    add("heading", [{"text": "A study of " + " ".join(rng.choice(_WORDS) for _ in range(4)), "format": 0}], tag="h1")
+    for page in range(pages):
+        add("heading", [{"text": f"{page + 1}. " + " ".join(rng.choice(_WORDS) for _ in range(3)).title(), "format": 0}], tag="h2")
+        words = 0
+        while words < WORDS_PER_PAGE:
+            if rng.random() < 0.1:
+                for _ in range(3):
+                    segments = [{"text": _sentence(rng), "format": 0}]
+                    add("list-item", segments, listType="bullet")
+                    words += _words(segments)
+            else:
+                segments = _paragraph(rng)
+                add("paragraph", segments)
+                words += _words(segments)
+    return json.dumps({"blocks": blocks})
+
+
+def simplified_document(pages: int, seed: int = 0) -> dict:
+    """A SimplifiedDocument (as a dict) of about `pages` * WORDS_PER_PAGE words."""
+    return json.loads(_simplified_document(pages, seed))
+
+
+def to_markdown(document: dict) -> str:
+    lines = []
+    for block in document["blocks"]:
+        text = ""
+        for segment in block["segments"]:
+            if segment["format"] & 1:
+                text += f"**{segment['text']}**"
+            elif segment["format"] & 2:
+                text += f"*{segment['text']}*"
+            else:
+                text += segment["text"]
+        if block["type"] == "heading":
+            lines.append("#" * int(block["tag"][1]) + " " + text)
+        elif block["type"] == "list-item":
+            lines.append("- " + text)
+        else:
+            lines.append(text)
+    return "\n\n".join(lines)
+
+
+def markdown_document(pages: int, seed: int = 0) -> str:
+    return to_markdown(simplified_document(pages, seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a benchmark document to stdout.")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--kind", choices=("simplified", "markdown"), default="simplified")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    pages = SIZES[args.size]
+    if args.kind == "markdown":
+        print(markdown_document(pages, args.seed))
+    else:
+        print(json.dumps(simplified_document(pages, args.seed)))
+
+
+if __name__ == "__main__":
+    main()
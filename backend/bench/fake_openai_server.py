@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ============== Fake OpenAI-compatible server ==============
+# Serves POST /v1/chat/completions (plain and stream=true) with canned answers
+# shaped like the real ones, so the backend can be load-tested end to end
+# without API costs:
+#   - edit_document offered: one call with --changes modify_segments ops on
+#     block ids found in the prompt (large payloads with e.g. --changes 300)
+#   - replace_text offered: up to --changes replace_text calls on sentences
+#     taken from the document in the prompt
+#   - json_object: {"reasoning", "summary"}; otherwise --text-tokens of text
+# Timing: --latency (+ uniform --jitter) before the first token, then output
+# at --tokens-per-second. --error-rate answers 503 instead.
+#
+#   python -m bench.fake_openai_server --port 9100
+#   OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=bench uvicorn app:app
+
+CONFIG = {
+    "latency": 0.2,
+    "jitter": 0.05,
+    "tokens_per_second": 400.0,
+    "changes": 5,
+    "text_tokens": 300,
+    "error_rate": 0.0,
+}
+
+_BLOCK_ID_RE = re.compile(r"blk-\d{6}|\bm[0-9a-f]{8}(?:-\d+)?\b")  # bench documents, markdown_blocks.py ids
+_SENTENCE_RE = re.compile(r"[A-Z][^.\n*]{20,160}\.")
+_WORDS = "the study shows a clear and consistent pattern across every sample in the period".split()
+
+app = FastAPI(title="Fake OpenAI")
+stats = {"requests": 0, "errors": 0, "streams_completed": 0, "streams_abandoned": 0}
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _prompt_text(messages: list) -> str:
+    return "\n".join(str(message.get("content") or "") for message in messages)
+
+
+def _text(tokens: int) -> str:
+    return " ".join(random.choice(_WORDS) for _ in range(max(1, int(tokens * 0.75)))).capitalize() + "."
+
+
+def _tool_call(index: int, name: str, arguments: dict) -> dict:
+    return {"id": f"call_{index}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+
+def answer(body: dict) -> dict:
+    """The assistant message for a request."""
+    tools = [tool["function"]["name"] for tool in body.get("tools") or []]
+    prompt = _prompt_text(body.get("messages") or [])
+    summary = {"reasoning": "Applied the requested edits.", "summary": "Edited the document."}
+    changes = CONFIG["changes"]
+
+    if "edit_document" in tools:
+        ids = list(dict.fromkeys(_BLOCK_ID_RE.findall(prompt)))
+        ops = [
+            {"operation": "modify_segments", "blockId": block_id, "newSegments": [{"text": _text(40), "format": 0}]}
+            for block_id in random.sample(ids, min(changes, len(ids)))
+        ]
+        return {"role": "assistant", "content": None, "tool_calls": [_tool_call(0, "edit_document", {"changes": ops, **summary})]}
+
+    if "replace_text" in tools:
+        document = prompt.split("Document content:", 1)[-1]
+        sentences = list(dict.fromkeys(_SENTENCE_RE.findall(document)))
+        picked = random.sample(sentences, min(changes, len(sentences)))
+        calls = [_tool_call(i, "replace_text", {"old_text": old, "new_text": old.upper()}) for i, old in enumerate(picked)]
+        return {"role": "assistant", "content": json.dumps(summary), "tool_calls": calls or None}
+
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        return {"role": "assistant", "content": json.dumps(summary)}
+    return {"role": "assistant", "content": _text(CONFIG["text_tokens"])}
+
+
+def _completion_tokens(message: dict) -> int:
+    arguments = "".join(call["function"]["arguments"] for call in message.get("tool_calls") or [])
+    return _tokens((message.get("content") or "") + arguments)
+
+
+def _finish_reason(message: dict) -> str:
+    return "tool_calls" if message.get("tool_calls") else "stop"
+
+
+async def _stream(body: dict, message: dict, created: int):
+    def chunk(delta: dict, finish=None) -> str:
+        data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        return f"data: {json.dumps(data)}\n\n"
+
+    step = 64  # characters per chunk, ~16 tokens
+    delay = _tokens("x" * step) / CONFIG["tokens_per_second"]
+    completed = False
+    try:
+        yield chunk({"role": "assistant", "content": None if message.get("tool_calls") else ""})
+        for index, call in enumerate(message.get("tool_calls") or []):
+            yield chunk({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                         "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            arguments = call["function"]["arguments"]
+            for i in range(0, len(arguments), step):
+                await asyncio.sleep(delay)
+                yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[i:i + step]}}]})
+        if not message.get("tool_calls"):
+            content = message.get("content") or ""
+            for i in range(0, len(content), step):
+                await asyncio.sleep(delay)
+                yield chunk({"content": content[i:i + step]})
+        yield chunk({}, _finish_reason(message))
+        yield "data: [DONE]\n\n"
+        completed = True
+    finally:
+        # Abandoned: the client (the backend) closed the stream before the end
+        stats["streams_completed" if completed else "streams_abandoned"] += 1
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    await asyncio.sleep(CONFIG["latency"] + random.uniform(0, CONFIG["jitter"]))
+    if random.random() < CONFIG["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse(status_code=503, content={"error": {"message": "injected error", "type": "server_error"}})
+
+    message = answer(body)
+    created = int(time.time())
+    if body.get("stream"):
+        return StreamingResponse(_stream(body, message, created), media_type="text/event-stream")
+
+    completion_tokens = _completion_tokens(message)
+    await asyncio.sleep(completion_tokens / CONFIG["tokens_per_second"])
+    prompt_tokens = _tokens(_prompt_text(body.get("messages") or []))
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": created,
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": message, "finish_reason": _finish_reason(message)}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+@app.get("/stats")
+async def server_stats():
+    return {**stats, "config": CONFIG}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for key, value in CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    CONFIG.update({key: getattr(args, key) for key in CONFIG})
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
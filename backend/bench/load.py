@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import httpx
+
+from bench.documents import SIZES, markdown_document, simplified_document
+from bench.compare import compare, print_comparison
+
+# ============== Load driver ==============
+# Runs every (endpoint, document size, concurrency) cell against a backend and
+# reports throughput, p50/p95/p99 latency and the backend's CPU time per
+# request (from process_cpu_seconds_total on /metrics), plus the time per
+# request not spent in model calls (request minus model stage histograms).
+#
+# By default it starts the fake OpenAI server and a backend wired to it on
+# free ports; --url benchmarks a backend that is already running instead.
+# Results go to bench/results/<time>-<commit>.json; --compare checks them
+# against an earlier file.
+#
+#   cd backend && python -m bench.load --concurrency 1,8,32 --requests 40
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+COMMAND_INSTRUCTION = "Fix the grammar and tighten the wording in the first section"
+ENHANCE_PROMPT = "Write a short paragraph introducing the study's method"
+
+
+REQUEST_MARKER = "@@request@@"  # replaced per request, so concurrent requests are not deduplicated
+
+
+def _payload(endpoint: str, size: str) -> dict:
+    pages = SIZES[size]
+    instruction = f"{COMMAND_INSTRUCTION} ({REQUEST_MARKER})"
+    if endpoint == "command":
+        return {"content": markdown_document(pages), "instruction": instruction, "bypass_cache": True}
+    if endpoint == "command_v2":
+        return {"document": simplified_document(pages), "instruction": instruction, "bypass_cache": True}
+    if endpoint == "format":
+        return {"content": f"{markdown_document(pages)}\n\n{REQUEST_MARKER}", "format_type": "APA", "bypass_cache": True}
+    if endpoint == "format_blocks":
+        return {**_payload("format", size), "output": "blocks"}
+    # The editor sends the text around the cursor, not the whole document
+    return {"prompt": f"{ENHANCE_PROMPT} ({REQUEST_MARKER})", "context": markdown_document(pages)[:4000]}
+
+
+ENDPOINTS = {
+    "command": "/api/command",
+    "command_v2": "/api/command/v2",
+    "format": "/api/format",
+    "format_blocks": "/api/format",
+    "enhance": "/api/enhance",
+}
+
+
+# ============== /metrics scraping ==============
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text: str) -> dict:
+    """Prometheus text -> {(name, ((label, value), ...)): value}."""
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if not line or line.startswith("#") or not match:
+            continue
+        labels = tuple(sorted(_LABEL_RE.findall(match.group(3) or "")))
+        samples[(match.group(1), labels)] = float(match.group(4).replace("+Inf", "inf"))
+    return samples
+
+
+def _sum(samples: dict, name: str, **labels) -> float:
+    wanted = set(labels.items())
+    return sum(value for (sample_name, sample_labels), value in samples.items()
+               if sample_name == name and wanted <= set(sample_labels))
+
+
+async def scrape(client: httpx.AsyncClient, url: str) -> dict:
+    response = await client.get(f"{url}/metrics")
+    response.raise_for_status()
+    return parse_metrics(response.text)
+
+
+def backend_costs(before: dict, after: dict, path: str, requests: int) -> dict:
+    def delta(name: str, **labels) -> float:
+        return _sum(after, name, **labels) - _sum(before, name, **labels)
+
+    cpu = delta("process_cpu_seconds_total")
+    served = delta("vrite_http_request_duration_seconds_count", endpoint=path) or requests
+    request_time = delta("vrite_http_request_duration_seconds_sum", endpoint=path)
+    model_time = sum(delta("vrite_stage_duration_seconds_sum", endpoint=path, stage=stage) for stage in ("model_call", "model_stream"))
+    return {
+        "backend_cpu_ms_per_request": round(cpu / served * 1000, 3),
+        "backend_non_model_ms_per_request": round((request_time - model_time) / served * 1000, 3),
+        "model_calls_per_request": round(delta("vrite_stage_duration_seconds_count", endpoint=path, stage="model_call") / served, 2),
+    }
+
+
+# ============== Running cells ==============
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_cell(client: httpx.AsyncClient, url: str, endpoint: str, size: str, concurrency: int, requests: int,
+                   warmup: int, identical: bool = False) -> dict:
+    path = ENDPOINTS[endpoint]
+    body = json.dumps(_payload(endpoint, size)).encode("utf-8")
+    marker = REQUEST_MARKER.encode("utf-8")
+    headers = {"content-type": "application/json"}
+    latencies = []
+    statuses = Counter()
+
+    async def send(tag: str) -> int:
+        content = body.replace(marker, b"same" if identical else tag.encode("utf-8"))
+        response = await client.post(f"{url}{path}", content=content, headers=headers)
+        return response.status_code
+
+    for i in range(warmup):
+        await send(f"warmup {i} {time.time()}")
+
+    pending = iter(range(requests))
+    run_id = f"{time.time():.6f}"
+
+    async def worker():
+        for i in pending:
+            started = time.perf_counter()
+            try:
+                status = await send(f"{run_id} {i}")
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[str(status)] += 1
+
+    before = await scrape(client, url)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    after = await scrape(client, url)
+
+    ordered = sorted(latencies)
+    ok = statuses.get("200", 0)
+    return {
+        "endpoint": endpoint,
+        "size": size,
+        "concurrency": concurrency,
+        "requests": requests,
+        "ok": ok,
+        "statuses": dict(statuses),
+        "request_bytes": len(body),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(ok / wall, 3) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 0.50) * 1000, 2),
+            "p95": round(percentile(ordered, 0.95) * 1000, 2),
+            "p99": round(percentile(ordered, 0.99) * 1000, 2),
+            "mean": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+            "max": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+        },
+        **backend_costs(before, after, path, requests),
+    }
+
+
+# ============== Local services ==============
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+@contextmanager
+def local_services(fake_args: list, backend_env: dict):
+    """Start the fake OpenAI server and a backend pointed at it; yields the backend URL."""
+    fake_port, backend_port = _free_port(), _free_port()
+    processes = []
+    try:
+        fake = subprocess.Popen(
+            [sys.executable, "-m", "bench.fake_openai_server", "--port", str(fake_port), *fake_args], cwd=BACKEND_DIR
+        )
+        processes.append(fake)
+        _wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+
+        env = {
+            **os.environ,
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+            "OPENAI_FAKE_UPSTREAM": "",
+            "JOBS_DB": "",
+            "RESPONSE_CACHE_DB": "",
+            "TRACE_EXPORT": "",
+            "RATE_LIMIT_ENABLED": "false",  # every bench request comes from one address
+            **backend_env,
+        }
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(backend_port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+        )
+        processes.append(backend)
+        url = f"http://127.0.0.1:{backend_port}"
+        _wait_ready(f"{url}/health", backend)
+        yield url
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# ============== Results ==============
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+
+
+def version_info() -> dict:
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD") or "unknown",
+        "subject": _git("log", "-1", "--format=%s"),
+        "dirty": bool(_git("status", "--porcelain", "--", ".")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def print_results(results: list):
+    print(f"{'endpoint':<11} {'size':<9} {'conc':>4} {'ok':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'cpu ms/req':>10} {'non-model ms':>12}")
+    for row in results:
+        latency = row["latency_ms"]
+        print(f"{row['endpoint']:<11} {row['size']:<9} {row['concurrency']:>4} {row['ok']:>5} {row['throughput_rps']:>8.1f} "
+              f"{latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f} "
+              f"{row['backend_cpu_ms_per_request']:>10.2f} {row['backend_non_model_ms_per_request']:>12.2f}")
+
+
+async def run(url: str, args) -> list:
+    results = []
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 8)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for endpoint in args.endpoints:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    row = await run_cell(client, url, endpoint, size, concurrency, args.requests, args.warmup, args.identical)
+                    results.append(row)
+                    if args.verbose:
+                        print_results([row])
+    return results
+
+
+def _csv(kind):
+    return lambda value: [kind(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the backend against a fake model server.")
+    parser.add_argument("--url", help="benchmark this running backend instead of starting one")
+    parser.add_argument("--endpoints", type=_csv(str), default=list(ENDPOINTS))
+    parser.add_argument("--sizes", type=_csv(str), default=["small", "50-page"], help=f"any of {', '.join(SIZES)}")
+    parser.add_argument("--concurrency", type=_csv(int), default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=40, help="measured requests per cell")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--identical", action="store_true", help="send identical requests (exercises dedup and the cache)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--fake-args", default="", help='extra fake server flags, e.g. "--latency 0.5 --changes 200"')
+    parser.add_argument("--env", action="append", default=[], help="backend environment override KEY=VALUE (repeatable)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"))
+    parser.add_argument("--label", default="", help="added to the result file name")
+    parser.add_argument("--compare", help="baseline result file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    parser.add_argument("--verbose", action="store_true", help="print each cell as it finishes")
+    args = parser.parse_args()
+    for name in args.endpoints:
+        if name not in ENDPOINTS:
+            parser.error(f"unknown endpoint {name!r}")
+    for name in args.sizes:
+        if name not in SIZES:
+            parser.error(f"unknown size {name!r}")
+
+    started = time.time()
+    if args.url:
+        results = asyncio.run(run(args.url.rstrip("/"), args))
+    else:
+        backend_env = dict(item.split("=", 1) for item in args.env)
+        with local_services(args.fake_args.split(), backend_env) as url:
+            results = asyncio.run(run(url, args))
+
+    report = {
+        "version": version_info(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "config": {
+            "url": args.url or "local",
+            "fake_args": args.fake_args,
+            "env": args.env,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "identical": args.identical,
+        },
+        "results": results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(started)) + f"-{report['version']['commit']}"
+    path = os.path.join(args.output, f"{name}{'-' + args.label if args.label else ''}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results)
+    print(f"\nSaved {path}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressions = compare(baseline, report, args.threshold)
+        print_comparison(rows, baseline, report)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+from config import env_int
+from doc_encoding import minimal_block_dict
+
+# ============== Content-addressed response cache ==============
+# Keys are a SHA-256 over the canonical JSON of everything that determines a
+# response (endpoint, document, instruction, snippets, trimmed history, model
+# parameters). Values are the JSON response bodies. Markdown is keyed as sent:
+# V1 responses hold positions, context and applied_content for that exact
+# text, so a CRLF or trailing-space variant is a different entry.
+#
+# Tier 1: in-process LRU bounded by entry count and total bytes, with TTL.
+# Tier 2: optional SQLite file (RESPONSE_CACHE_DB) shared by all uvicorn
+#         workers on the host, bounded by row count, with TTL.
+
+CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_TTL_SECONDS = env_int("RESPONSE_CACHE_TTL", 3600)
+CACHE_MAX_ENTRIES = env_int("RESPONSE_CACHE_MAX_ENTRIES", 512)
+CACHE_MAX_BYTES = env_int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB") or None
+CACHE_DB_MAX_ENTRIES = env_int("RESPONSE_CACHE_DB_MAX_ENTRIES", 10000)
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def make_key(endpoint: str, payload: dict) -> str:
+    digest = hashlib.sha256()
+    digest.update(endpoint.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(canonical_json(payload).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def normalize_snippets(snippets) -> list:
+    return [snippet.strip() for snippet in (snippets or []) if snippet.strip()]
+
+
+class MemoryTier:
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value_json)
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def set(self, key: str, value_json: str):
+        size = len(value_json)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value_json)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteTier:
+    """Blocking SQLite access; ResponseCache calls it through asyncio.to_thread."""
+
+    EVICT_EVERY = 100  # writes between eviction sweeps
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:  # commit on success, roll back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value_json: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value_json, now, now),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(conn, now)
+
+    def _evict(self, conn, now: float) -> int:
+        removed = conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,)).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            removed += conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+        return removed
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        enabled: bool = CACHE_ENABLED,
+        ttl: float = CACHE_TTL_SECONDS,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        db_path: Optional[str] = CACHE_DB_PATH,
+        db_max_entries: int = CACHE_DB_MAX_ENTRIES,
+    ):
+        self.enabled = enabled
+        self.memory = MemoryTier(max_entries, max_bytes, ttl)
+        self.disk = SQLiteTier(db_path, db_max_entries, ttl) if (enabled and db_path) else None
+        self.counters = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0, "bypassed": 0, "disk_errors": 0}
+
+    async def get(self, key: str) -> Optional[dict]:
+        value_json = self.memory.get(key)
+        if value_json is not None:
+            self.counters["hits_memory"] += 1
+            return json.loads(value_json)
+        if self.disk is not None:
+            try:
+                value_json = await asyncio.to_thread(self.disk.get, key)
+            except sqlite3.Error as e:
+                self.counters["disk_errors"] += 1
+                print(f"Response cache disk read failed: {e}")
+                value_json = None
+            if value_json is not None:
+                self.counters["hits_disk"] += 1
+                self.memory.set(key, value_json)
+                return json.loads(value_json)
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: dict):
+        value_json = json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+        self.memory.set(key, value_json)
+        self.counters["stores"] += 1
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.set, key, value_json)
+            except sqlite3.Error as e:
+                self.counters["disk_errors"] += 1
+                print(f"Response cache disk write failed: {e}")
+
+    async def get_or_compute(self, key: str, compute, bypass: bool = False) -> dict:
+        """
+        Return the cached response for `key`, or await `compute()` and store it.
+        With bypass=True the cache is not read, but the fresh result is stored.
+        """
+        if not self.enabled:
+            return await compute()
+        if bypass:
+            self.counters["bypassed"] += 1
+        else:
+            cached = await self.get(key)
+            if cached is not None:
+                return cached
+        value = await compute()
+        await self.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        hits = self.counters["hits_memory"] + self.counters["hits_disk"]
+        lookups = hits + self.counters["misses"]
+        return {
+            "enabled": self.enabled,
+            **self.counters,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.bytes,
+            "memory_evictions": self.memory.evictions,
+            "disk": self.disk.path if self.disk else None,
+        }
+
+
+response_cache = ResponseCache()
+
+
+# ============== Request keys ==============
+
+def _history(history) -> list:
+    # The whole history: how much of it reaches the prompt depends on token budgets
+    return history or []
+
+
+def format_key(request, params: dict) -> str:
+    return make_key("/api/format", {
+        "content": request.content,
+        "format_type": request.format_type,
+        "params": params,
+    })
+
+
+def command_key(request, params: dict) -> str:
+    return make_key("/api/command", {
+        "content": request.content,
+        "instruction": request.instruction.strip(),
+        "context_snippets": normalize_snippets(request.context_snippets),
+        "history": _history(request.conversation_history),
+        "params": params,
+    })
+
+
+def command_v2_key(request, params: dict) -> str:
+    return make_key("/api/command/v2", {
+        "document": [minimal_block_dict(block) for block in request.document.blocks],
+        "instruction": request.instruction.strip(),
+        "context_snippets": normalize_snippets(request.context_snippets),
+        "history": _history(request.conversation_history),
+        "params": params,
+    })
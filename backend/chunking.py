@@ -0,0 +1,188 @@
+import os
+from typing import List, Optional, Tuple
+
+from config import env_int
+from models import SimplifiedBlock, SimplifiedDocument
+from tokens import count_tokens
+from doc_encoding import minimal_block_dict
+from retrieval import is_whole_document_instruction
+
+# ============== Map-reduce execution for large V2 documents ==============
+# The document is split into section-aligned chunks under a token budget, the
+# same instruction runs on every chunk concurrently, and the per-chunk
+# edit_document change lists are merged back into one list in document order.
+
+CHUNK_MAX_TOKENS = env_int("CHUNK_MAX_TOKENS", 4000)           # per-chunk document budget
+CHUNK_PARALLELISM = env_int("CHUNK_PARALLELISM", 4)            # chunk calls in flight per request
+CHUNK_TRIGGER_TOKENS = env_int("CHUNK_TRIGGER_TOKENS", 8000)  # "auto" chunks document-wide edits above this
+# "single" | "chunked" | "auto" (chunk large document-wide edits, and retry truncated ones chunked)
+DEFAULT_EXECUTION = os.getenv("V2_EXECUTION", "auto")
+
+CHUNK_NOTE = """NOTE: This is PART {part} of {parts} of a longer document; the other parts are edited separately with the same instruction.
+Only reference the block ids shown here. afterBlockId=null inserts at the start of this part."""
+
+
+def block_tokens(block: SimplifiedBlock) -> int:
+    # Measured on the minimal encoding, which is what the model sees by default
+    return count_tokens(str(minimal_block_dict(block)))
+
+
+def document_tokens(document: SimplifiedDocument) -> int:
+    return sum(block_tokens(block) for block in document.blocks)
+
+
+def should_chunk(document: SimplifiedDocument, instruction: str, execution: str) -> bool:
+    if execution == "chunked":
+        return len(document.blocks) > 1
+    if execution == "auto":
+        return is_whole_document_instruction(instruction) and document_tokens(document) > CHUNK_TRIGGER_TOKENS
+    return False
+
+
+def split_document(document: SimplifiedDocument, max_tokens: int = None) -> List[List[SimplifiedBlock]]:
+    """
+    Split into chunks of whole sections (a heading and the blocks up to the next
+    heading). Sections larger than the budget are split at block boundaries.
+    """
+    max_tokens = CHUNK_MAX_TOKENS if max_tokens is None else max_tokens
+
+    sections = []
+    for block in document.blocks:
+        if block.type == "heading" or not sections:
+            sections.append([])
+        sections[-1].append(block)
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for section in sections:
+        section_tokens = sum(block_tokens(block) for block in section)
+        if current and current_tokens + section_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        if section_tokens <= max_tokens:
+            current.extend(section)
+            current_tokens += section_tokens
+            continue
+        for block in section:
+            tokens = block_tokens(block)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(current)
+                current, current_tokens = [], 0
+            current.append(block)
+            current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def merge_chunk_changes(chunks: List[List[SimplifiedBlock]], chunk_changes: List[List[dict]]) -> Tuple[List[dict], List[dict]]:
+    """
+    Merge per-chunk change lists in chunk order. Returns (merged, dropped).
+
+    - Ops that reference a block outside their own chunk are dropped.
+    - afterBlockId=null in chunk k>0 means "start of this chunk". It is anchored
+      after the last original block before the chunk that is neither deleted
+      nor replaced (an anchor must still be in place when the op applies).
+    - Ops that edit a block keep their blockId whether it is original or was
+      inserted earlier in the same chunk.
+    - apply_block_changes puts each insert directly after its anchor, except
+      that list items of one listType inserted one after another on the same
+      anchor follow each other. The boundary inserts are therefore placed
+      before the earlier inserts on their anchor, so they come out after them.
+      If that would join two list runs, an unchanged modify_segments on the
+      anchor goes between them.
+    - New block ids that collide with existing or earlier new ids are renamed.
+    """
+    merged = []
+    dropped = []
+    used_ids = {block.id for chunk in chunks for block in chunk}
+    survivors = []  # original ids, in document order, not deleted/replaced so far
+
+    for chunk, changes in zip(chunks, chunk_changes):
+        chunk_ids = {block.id for block in chunk}
+        boundary_anchor = survivors[-1] if survivors else None
+        removed = set()
+        renamed = {}
+        created = set()
+        boundary_inserts = []
+        chunk_ops = []
+
+        for change in changes:
+            change = dict(change)
+            operation = change.get("operation")
+            if operation in ("modify_segments", "replace_block", "delete_block"):
+                block_id = renamed.get(change.get("blockId"), change.get("blockId"))
+                if block_id not in chunk_ids and block_id not in created:
+                    dropped.append({"change": change, "reason": "block not in chunk"})
+                    continue
+                change["blockId"] = block_id
+                if operation != "modify_segments":
+                    removed.add(block_id)
+                chunk_ops.append(change)
+            elif operation == "insert_block":
+                after = change.get("afterBlockId")
+                after = renamed.get(after, after)
+                if after is not None and after not in chunk_ids and after not in created:
+                    dropped.append({"change": change, "reason": "anchor not in chunk"})
+                    continue
+                new_block = dict(change.get("newBlock") or {})
+                new_id = new_block.get("id")
+                if new_id:
+                    if new_id in used_ids:
+                        fresh = _fresh_id(new_id, used_ids)
+                        renamed[new_id] = fresh
+                        new_block["id"] = fresh
+                        new_id = fresh
+                    used_ids.add(new_id)
+                    created.add(new_id)
+                change["newBlock"] = new_block
+                change["afterBlockId"] = after
+                if after is None and boundary_anchor is not None:
+                    change["afterBlockId"] = boundary_anchor
+                    boundary_inserts.append(change)
+                else:
+                    chunk_ops.append(change)
+            else:
+                dropped.append({"change": change, "reason": "unknown operation"})
+
+        if boundary_inserts:
+            position = next(
+                (i for i, op in enumerate(merged)
+                 if op.get("operation") == "insert_block" and op.get("afterBlockId") == boundary_anchor),
+                len(merged),
+            )
+            if position < len(merged) and _list_type(boundary_inserts[-1]) and _list_type(boundary_inserts[-1]) == _list_type(merged[position]):
+                boundary_inserts.append(_unchanged(boundary_anchor, chunks, merged[:position]))
+            merged[position:position] = boundary_inserts
+        merged.extend(chunk_ops)
+        survivors.extend(block.id for block in chunk if block.id not in removed)
+
+    return merged, dropped
+
+
+def _list_type(change: dict) -> Optional[str]:
+    new_block = change.get("newBlock") or {}
+    if change.get("operation") != "insert_block" or new_block.get("type") != "list-item":
+        return None
+    return new_block.get("listType") or "bullet"
+
+
+def _unchanged(block_id: str, chunks: List[List[SimplifiedBlock]], earlier: List[dict]) -> dict:
+    """A modify_segments that leaves block_id as the ops in `earlier` left it."""
+    segments = next(
+        (op["newSegments"] for op in reversed(earlier)
+         if op.get("operation") == "modify_segments" and op.get("blockId") == block_id),
+        None,
+    )
+    if segments is None:
+        block = next(block for chunk in chunks for block in chunk if block.id == block_id)
+        segments = [segment.model_dump() for segment in block.segments]
+    return {"operation": "modify_segments", "blockId": block_id, "newSegments": segments}
+
+
+def _fresh_id(block_id: str, used: set) -> str:
+    n = 2
+    while f"{block_id}-{n}" in used:
+        n += 1
+    return f"{block_id}-{n}"
@@ -0,0 +1,14 @@
+import os
+
+# ============== Environment settings ==============
+# Numeric settings read from the environment (.env is loaded by app.py). An
+# unset or empty variable means the default.
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
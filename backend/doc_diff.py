@@ -0,0 +1,404 @@
+import os
+import re
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+from config import env_int
+from doc_encoding import minimal_block_dict
+from edit_engine import apply_block_changes, order_block_changes
+from models import SimplifiedBlock, SimplifiedDocument
+
+# ============== Block and word diff ==============
+# Turns "before" and "after" into the smallest change list instead of a full
+# rewrite:
+#   - Block level: blocks are compared by content key (type, tag, list, indent,
+#     segments). Common prefix and suffix are trimmed, blocks that occur once
+#     on each side anchor the match (patience diff: longest increasing run of
+#     anchors), and the gaps between anchors are diffed with Myers' algorithm.
+#     Typical edits cost about linear time. The Myers search of one diff is
+#     bounded by DIFF_MAX_COST edits; a gap past the bound is treated as
+#     replaced wholesale rather than searched.
+#   - Changed regions: old and new blocks are paired by shape. Same shape is
+#     modify_segments, a different shape replace_block (keeping the block id),
+#     the rest delete_block / insert_block. Inserts come first, in the order
+#     the editor needs (edit_engine.order_block_changes: new list items in
+#     list order, other new blocks in reverse on their anchor).
+#   - Word level: inside each changed block (and between changed text blocks
+#     for markdown) the same diff runs over words, giving [op, text] chunks:
+#     -1 removed, 0 unchanged, 1 added. Whitespace between two changes is
+#     folded into them, so "big dog" -> "small cat" is one removal and one
+#     addition.
+#
+# DIFF_CHANGES: edit_document ops from the model are replaced by the diff
+# between the document and the result of applying them, when that is not
+# longer: replace_block that only edits text becomes modify_segments, ops
+# that change nothing disappear, and each modify_segments/replace_block gets
+# its word-level `diff` so the client doesn't have to compute one.
+
+DIFF_CHANGES = os.getenv("DIFF_CHANGES", "true").lower() in ("1", "true", "yes")
+DIFF_MAX_COST = env_int("DIFF_MAX_COST", 2000)  # Myers edit-distance bound per gap
+SHAPE_MAX_COST = 64  # pairing changed blocks by shape; beyond that they pair in order
+WORD_MIN_OVERLAP = 0.5  # share of words two texts must have in common to be diffed word by word
+
+_TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]")
+
+counters = {"documents": 0, "texts": 0, "capped": 0, "ops_before": 0, "ops_after": 0}
+
+
+# ============== Sequence diff ==============
+
+def _myers(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int, max_cost: int) -> Optional[List[tuple]]:
+    """
+    (matching runs (i, j, length), edit distance) of a shortest edit script
+    between a[a0:a1] and b[b0:b1], or None when the distance exceeds max_cost.
+    """
+    n, m = a1 - a0, b1 - b0
+    if n + m > max_cost:
+        # Lower bound: every item without a counterpart on the other side is an edit
+        available = Counter(a[a0:a1])
+        common = 0
+        for j in range(b0, b1):
+            if available[b[j]] > 0:
+                available[b[j]] -= 1
+                common += 1
+        if n + m - 2 * common > max_cost:
+            return None
+    limit = min(n + m, max_cost)
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)
+    trace = []
+    for d in range(limit + 1):
+        trace.append(v[offset - d:offset + d + 1] if d else [v[offset]])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, d, n, m, a0, b0), d
+    return None
+
+
+def _backtrack(trace: List[list], d: int, n: int, m: int, a0: int, b0: int) -> List[tuple]:
+    # trace[e] holds v[-e..e] as it was before step e
+    runs = []
+    x, y = n, m
+    for e in range(d, 0, -1):
+        before = trace[e]  # v after step e - 1, indexed k + e
+        k = x - y
+        if k == -e or (k != e and before[k - 1 + e] < before[k + 1 + e]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = before[prev_k + e]
+        prev_y = prev_x - prev_k
+        start_x = prev_x if prev_k == k + 1 else prev_x + 1
+        start_y = start_x - k
+        if x > start_x:
+            runs.append((a0 + start_x, b0 + start_y, x - start_x))
+        x, y = prev_x, prev_y
+    if x > 0:
+        runs.append((a0, b0, x))
+    return runs
+
+
+def _anchors(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int) -> List[tuple]:
+    """Items occurring exactly once on each side, longest run in the same order."""
+    counts = {}
+    for i in range(a0, a1):
+        entry = counts.get(a[i])
+        counts[a[i]] = [1, i, None, 0] if entry is None else [entry[0] + 1, i, None, 0]
+    for j in range(b0, b1):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] = j
+            entry[3] += 1
+    pairs = sorted((entry[1], entry[2]) for entry in counts.values() if entry[0] == 1 and entry[3] == 1)
+    if not pairs:
+        return []
+    # Longest increasing subsequence of the b positions (patience sorting)
+    tails = []
+    tail_index = []
+    previous = [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        slot = bisect_left(tails, j)
+        if slot == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[slot] = j
+            tail_index[slot] = index
+        previous[index] = tail_index[slot - 1] if slot else None
+    chain = []
+    index = tail_index[-1]
+    while index is not None:
+        chain.append(pairs[index])
+        index = previous[index]
+    chain.reverse()
+    return chain
+
+
+def diff_sequences(a: Sequence, b: Sequence, max_cost: int = DIFF_MAX_COST) -> List[tuple]:
+    """
+    Opcodes (tag, i1, i2, j1, j2) turning a into b, tag in "equal", "delete",
+    "insert" and "replace" (as difflib.SequenceMatcher.get_opcodes()).
+    max_cost bounds the Myers search over all gaps together.
+    """
+    runs = []
+    budget = max_cost
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        a0, a1, b0, b1 = ranges.pop()
+        start = 0
+        while a0 + start < a1 and b0 + start < b1 and a[a0 + start] == b[b0 + start]:
+            start += 1
+        if start:
+            runs.append((a0, b0, start))
+            a0 += start
+            b0 += start
+        end = 0
+        while a0 < a1 - end and b0 < b1 - end and a[a1 - end - 1] == b[b1 - end - 1]:
+            end += 1
+        if end:
+            runs.append((a1 - end, b1 - end, end))
+            a1 -= end
+            b1 -= end
+        if a0 == a1 or b0 == b1:
+            continue
+
+        anchors = _anchors(a, b, a0, a1, b0, b1)
+        if anchors:
+            previous_i, previous_j = a0, b0
+            for i, j in anchors:
+                runs.append((i, j, 1))
+                ranges.append((previous_i, i, previous_j, j))
+                previous_i, previous_j = i + 1, j + 1
+            ranges.append((previous_i, a1, previous_j, b1))
+            continue
+        found = _myers(a, b, a0, a1, b0, b1, budget)
+        if found is None:
+            counters["capped"] += 1  # too different: the whole gap is a replacement
+        else:
+            runs.extend(found[0])
+            budget -= found[1]
+
+    opcodes = []
+    i = j = 0
+    for run_i, run_j, length in sorted(runs) + [(len(a), len(b), 0)]:
+        if i < run_i or j < run_j:
+            tag = "replace" if i < run_i and j < run_j else "delete" if i < run_i else "insert"
+            opcodes.append((tag, i, run_i, j, run_j))
+        if length:
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], run_i + length, opcodes[-1][3], run_j + length)
+            else:
+                opcodes.append(("equal", run_i, run_i + length, run_j, run_j + length))
+        i, j = run_i + length, run_j + length
+    return opcodes
+
+
+# ============== Words ==============
+
+def _chunks(old_tokens: List[str], new_tokens: List[str], opcodes: List[tuple]) -> List[list]:
+    """[op, text] chunks; whitespace-only equal runs between two changes are folded into them."""
+    chunks = []
+    removed, added = [], []
+
+    def flush():
+        if removed:
+            chunks.append([-1, "".join(removed)])
+            removed.clear()
+        if added:
+            chunks.append([1, "".join(added)])
+            added.clear()
+
+    for index, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == "equal":
+            text = "".join(old_tokens[i1:i2])
+            if (removed or added) and index + 1 < len(opcodes) and not text.strip():
+                removed.append(text)
+                added.append(text)
+                continue
+            flush()
+            chunks.append([0, text])
+            continue
+        removed.extend(old_tokens[i1:i2])
+        added.extend(new_tokens[j1:j2])
+    flush()
+    return chunks
+
+
+def word_diff(old: str, new: str) -> List[list]:
+    """Word-level [op, text] chunks from `old` to `new` (-1 removed, 0 unchanged, 1 added)."""
+    if old == new:
+        return [[0, old]] if old else []
+    old_tokens = _TOKEN_RE.findall(old)
+    new_tokens = _TOKEN_RE.findall(new)
+    # When most words differ a word-by-word diff is noise: replace the text
+    old_words = Counter(token for token in old_tokens if not token.isspace())
+    new_words = Counter(token for token in new_tokens if not token.isspace())
+    total = sum(old_words.values()) + sum(new_words.values())
+    if total > 8 and 2 * sum((old_words & new_words).values()) < total * WORD_MIN_OVERLAP:
+        return [chunk for chunk in ([-1, old], [1, new]) if chunk[1]]
+    max_cost = min(DIFF_MAX_COST, max(8, (len(old_tokens) + len(new_tokens)) // 2))
+    return _chunks(old_tokens, new_tokens, diff_sequences(old_tokens, new_tokens, max_cost))
+
+
+def text_diff(old: str, new: str) -> List[list]:
+    """
+    Word-level chunks for two whole texts (markdown): lines are matched
+    first, and only the lines that changed are diffed word by word.
+    """
+    counters["texts"] += 1
+    old_blocks = old.splitlines(keepends=True)
+    new_blocks = new.splitlines(keepends=True)
+    chunks = []
+    for tag, i1, i2, j1, j2 in diff_sequences(old_blocks, new_blocks):
+        if tag == "equal":
+            part = [[0, "".join(old_blocks[i1:i2])]]
+        else:
+            part = word_diff("".join(old_blocks[i1:i2]), "".join(new_blocks[j1:j2]))
+        for chunk in part:
+            if chunks and chunks[-1][0] == chunk[0]:
+                chunks[-1][1] += chunk[1]
+            else:
+                chunks.append(chunk)
+    return chunks
+
+
+# ============== Blocks ==============
+
+def _segments(block: SimplifiedBlock) -> tuple:
+    """(text, format) pairs, merged as normalize_segments() does."""
+    merged = []
+    for segment in block.segments:
+        if not segment.text:
+            continue
+        if merged and merged[-1][1] == segment.format:
+            merged[-1] = (merged[-1][0] + segment.text, segment.format)
+        else:
+            merged.append((segment.text, segment.format))
+    return tuple(merged) or (("", 0),)
+
+
+def _shape(block: SimplifiedBlock) -> tuple:
+    return block.type, block.tag, block.listType, block.indent
+
+
+def _text(block: SimplifiedBlock) -> str:
+    return "".join(segment.text for segment in block.segments)
+
+
+def _segment_dicts(block: SimplifiedBlock) -> List[dict]:
+    return [{"text": text, "format": fmt} for text, fmt in _segments(block)]
+
+
+class _Ids:
+    """Ids for inserted blocks: the new document's id unless the original document uses it."""
+
+    def __init__(self, taken):
+        self.taken = set(taken)
+
+    def claim(self, block_id: Optional[str]) -> str:
+        base = block_id or "block"
+        candidate = base
+        n = 1
+        while candidate in self.taken:
+            n += 1
+            candidate = f"{base}-{n}"
+        self.taken.add(candidate)
+        return candidate
+
+
+def diff_documents(old: SimplifiedDocument, new: SimplifiedDocument, word_diffs: bool = True) -> List[dict]:
+    """
+    edit_document ops turning `old` into `new`, in editor order (see
+    edit_engine.order_block_changes): inserts first, each anchored on the
+    original block before it, then the other ops in document order.
+    """
+    counters["documents"] += 1
+    old_keys = [(_shape(block), _segments(block)) for block in old.blocks]
+    new_keys = [(_shape(block), _segments(block)) for block in new.blocks]
+    ids = _Ids(block.id for block in old.blocks)
+
+    inserts = []  # (anchor, [insert ops]) in document order
+    edits = []
+    anchor = None  # original block just before the current position
+
+    def insert(block: SimplifiedBlock):
+        new_block = minimal_block_dict(block.model_copy(update={"id": ids.claim(block.id)}))
+        change = {"operation": "insert_block", "afterBlockId": anchor, "newBlock": new_block}
+        if inserts and inserts[-1][0] == anchor:
+            inserts[-1][1].append(change)
+        else:
+            inserts.append((anchor, [change]))
+
+    for tag, i1, i2, j1, j2 in diff_sequences(old_keys, new_keys):
+        if tag == "equal":
+            anchor = old.blocks[i2 - 1].id
+            continue
+        olds, news = old.blocks[i1:i2], new.blocks[j1:j2]
+        # Pair the changed blocks by shape; leftovers are deleted or inserted
+        shapes = diff_sequences([_shape(b) for b in olds], [_shape(b) for b in news], SHAPE_MAX_COST)
+        for shape_tag, s1, s2, t1, t2 in shapes:
+            paired = min(s2 - s1, t2 - t1) if shape_tag in ("equal", "replace") else 0
+            for offset in range(paired):
+                before, after = olds[s1 + offset], news[t1 + offset]
+                if _shape(before) == _shape(after):
+                    change = {"operation": "modify_segments", "blockId": before.id, "newSegments": _segment_dicts(after)}
+                else:
+                    new_block = minimal_block_dict(after.model_copy(update={"id": before.id}))
+                    change = {"operation": "replace_block", "blockId": before.id, "newBlock": new_block}
+                if word_diffs:
+                    change["diff"] = word_diff(_text(before), _text(after))
+                edits.append(change)
+                anchor = before.id
+            for before in olds[s1 + paired:s2]:
+                edits.append({"operation": "delete_block", "blockId": before.id})
+                anchor = before.id
+            for after in news[t1 + paired:t2]:
+                insert(after)
+
+    return order_block_changes(old, inserts, edits)
+
+
+# Fields of a model op carried over to the diff op on the same block
+_TAGS = ("source", "rule", "repaired")
+
+
+def _block_of(change: dict) -> Optional[str]:
+    if change.get("operation") == "insert_block":
+        return (change.get("newBlock") or {}).get("id")
+    return change.get("blockId")
+
+
+def minimize_block_changes(document: SimplifiedDocument, changes: List[dict]) -> List[dict]:
+    """
+    The diff between `document` and the result of applying `changes` (which
+    must be valid), when it needs no more ops than `changes`; else `changes`.
+    """
+    counters["ops_before"] += len(changes)
+    applied = apply_block_changes(document, changes)
+    minimized = diff_documents(document, applied)
+    if len(minimized) > len(changes):
+        counters["ops_after"] += len(changes)
+        return changes
+    tags: Dict[str, dict] = {}
+    for change in changes:
+        block_id = _block_of(change)
+        if block_id is not None and block_id not in tags:
+            tags[block_id] = {tag: change[tag] for tag in _TAGS if change.get(tag)}
+    for change in minimized:
+        change.update(tags.get(_block_of(change), {}))
+    counters["ops_after"] += len(minimized)
+    return minimized
+
+
+def stats() -> dict:
+    return {**counters, "enabled": DIFF_CHANGES, "max_cost": DIFF_MAX_COST}
@@ -0,0 +1,276 @@
+import json
+import os
+from typing import List, Optional
+
+from models import TextSegment, SimplifiedBlock, SimplifiedDocument
+from tokens import count_tokens
+
+# ============== Document encoders for the V2 prompt ==============
+# "json"    - legacy pretty-printed model_dump (every None field and format 0)
+# "minimal" - compact JSON, defaults omitted, same-format segments merged
+# "compact" - one block per line: id<TAB>type<TAB>text with {format:text} markers
+#
+# Every encoder decodes back to SimplifiedDocument. The only normalization is
+# normalize_block(): adjacent segments with the same format are merged and empty
+# segments are dropped, which does not change the rendered document.
+
+DEFAULT_DOCUMENT_ENCODING = os.getenv("V2_DOCUMENT_ENCODING", "minimal")
+# encoding_stats: exact baseline (full legacy encoding + token count) or a sampled estimate
+ENCODING_STATS_EXACT = os.getenv("ENCODING_STATS_EXACT", "false").lower() in ("1", "true", "yes")
+BASELINE_SAMPLE_BLOCKS = 32
+
+COMPACT_FORMAT_NOTE = """Document encoding: one block per line as <id><TAB><type><TAB><text>.
+Types: p=paragraph, h1/h2/h3=heading, ul=bullet list-item, ol=numbered list-item (+N = indent level).
+Formatted text is written {format:text}, e.g. {1:bold} or {3:bold italic}; unmarked text is format 0.
+Characters \\ { } are escaped with a backslash. Use these ids as blockId/afterBlockId."""
+
+
+def normalize_segments(segments: List[TextSegment]) -> List[TextSegment]:
+    merged = []
+    for segment in segments:
+        if not segment.text:
+            continue
+        if merged and merged[-1].format == segment.format:
+            merged[-1] = TextSegment(text=merged[-1].text + segment.text, format=segment.format)
+        else:
+            merged.append(TextSegment(text=segment.text, format=segment.format))
+    if not merged:
+        # Keep one empty segment so blank blocks stay recognizable
+        merged.append(TextSegment(text="", format=0))
+    return merged
+
+
+def normalize_block(block: SimplifiedBlock) -> SimplifiedBlock:
+    return block.model_copy(update={"segments": normalize_segments(block.segments)})
+
+
+def normalize_document(document: SimplifiedDocument) -> SimplifiedDocument:
+    return SimplifiedDocument(blocks=[normalize_block(block) for block in document.blocks])
+
+
+# ============== json / minimal ==============
+
+def _encode_json(document: SimplifiedDocument) -> str:
+    return json.dumps(document.model_dump(), indent=2)
+
+
+def _decode_json(text: str) -> SimplifiedDocument:
+    return SimplifiedDocument.model_validate(json.loads(text))
+
+
+def minimal_block_dict(block: SimplifiedBlock) -> dict:
+    data = {"id": block.id, "type": block.type}
+    if block.tag is not None:
+        data["tag"] = block.tag
+    if block.listType is not None:
+        data["listType"] = block.listType
+    if block.indent is not None:
+        data["indent"] = block.indent
+    segments = []
+    for segment in normalize_segments(block.segments):
+        segments.append({"text": segment.text, "format": segment.format} if segment.format else {"text": segment.text})
+    data["segments"] = segments
+    return data
+
+
+def _encode_minimal(document: SimplifiedDocument) -> str:
+    blocks = [minimal_block_dict(block) for block in document.blocks]
+    return json.dumps({"blocks": blocks}, separators=(",", ":"), ensure_ascii=False)
+
+
+# ============== compact (line-oriented) ==============
+
+_TYPE_CODES = {
+    ("heading", "h1"): "h1",
+    ("heading", "h2"): "h2",
+    ("heading", "h3"): "h3",
+    ("heading", None): "h",
+    ("list-item", "bullet"): "ul",
+    ("list-item", "number"): "ol",
+    ("list-item", None): "li",
+}
+_CODE_TYPES = {code: key for key, code in _TYPE_CODES.items()}
+
+_ESCAPES = {"\\": "\\\\", "{": "\\{", "}": "\\}", "\n": "\\n", "\t": "\\t"}
+_UNESCAPES = {"\\": "\\", "{": "{", "}": "}", "n": "\n", "t": "\t"}
+
+
+def _escape(text: str) -> str:
+    if not any(ch in text for ch in _ESCAPES):
+        return text
+    return "".join(_ESCAPES.get(ch, ch) for ch in text)
+
+
+def _type_code(block: SimplifiedBlock) -> str:
+    if block.type == "paragraph":
+        code = "p"
+    elif block.type == "heading":
+        code = _TYPE_CODES[("heading", block.tag)]
+    else:
+        code = _TYPE_CODES[("list-item", block.listType)]
+    if block.indent is not None:
+        code += f"+{block.indent}"
+    return code
+
+
+def encode_compact_block(block: SimplifiedBlock) -> str:
+    parts = []
+    for segment in normalize_segments(block.segments):
+        if segment.format:
+            parts.append(f"{{{segment.format}:{_escape(segment.text)}}}")
+        else:
+            parts.append(_escape(segment.text))
+    return f"{_escape(block.id)}\t{_type_code(block)}\t{''.join(parts)}"
+
+
+def _encode_compact(document: SimplifiedDocument) -> str:
+    return "\n".join(encode_compact_block(block) for block in document.blocks)
+
+
+def _unescape_plain(text: str) -> str:
+    if "\\" not in text:
+        return text
+    out = []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\" and i + 1 < len(text):
+            out.append(_UNESCAPES.get(text[i + 1], text[i + 1]))
+            i += 2
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def _parse_compact_text(text: str) -> List[TextSegment]:
+    segments = []
+    buffer = []
+    fmt = 0
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == "\\" and i + 1 < n:
+            buffer.append(_UNESCAPES.get(text[i + 1], text[i + 1]))
+            i += 2
+            continue
+        if ch == "{" and fmt == 0:
+            colon = text.find(":", i)
+            if colon == -1 or not text[i + 1:colon].isdigit():
+                raise ValueError(f"Malformed format marker at offset {i}")
+            if buffer:
+                segments.append(TextSegment(text="".join(buffer), format=0))
+                buffer = []
+            fmt = int(text[i + 1:colon])
+            i = colon + 1
+            continue
+        if ch == "}" and fmt != 0:
+            segments.append(TextSegment(text="".join(buffer), format=fmt))
+            buffer = []
+            fmt = 0
+            i += 1
+            continue
+        buffer.append(ch)
+        i += 1
+    if fmt != 0:
+        raise ValueError("Unterminated format marker")
+    if buffer:
+        segments.append(TextSegment(text="".join(buffer), format=0))
+    return normalize_segments(segments)
+
+
+def decode_compact_block(line: str) -> SimplifiedBlock:
+    block_id, code, text = line.split("\t", 2)
+    indent = None
+    if "+" in code:
+        code, indent_text = code.split("+", 1)
+        indent = int(indent_text)
+    if code == "p":
+        block_type, variant = "paragraph", None
+    elif code in _CODE_TYPES:
+        block_type, variant = _CODE_TYPES[code]
+    else:
+        raise ValueError(f"Unknown block type code: {code}")
+    return SimplifiedBlock(
+        id=_unescape_plain(block_id),
+        type=block_type,
+        tag=variant if block_type == "heading" else None,
+        listType=variant if block_type == "list-item" else None,
+        indent=indent,
+        segments=_parse_compact_text(text),
+    )
+
+
+def _decode_compact(text: str) -> SimplifiedDocument:
+    if not text:
+        return SimplifiedDocument(blocks=[])
+    return SimplifiedDocument(blocks=[decode_compact_block(line) for line in text.split("\n")])
+
+
+# ============== Registry ==============
+
+class DocumentEncoder:
+    def __init__(self, name: str, encode, decode, label: str, note: str = ""):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.label = label  # shown in the prompt: "Document (<label>):"
+        self.note = note    # extra format explanation appended to the prompt
+
+
+ENCODERS = {}
+
+
+def register_encoder(encoder: DocumentEncoder):
+    ENCODERS[encoder.name] = encoder
+
+
+register_encoder(DocumentEncoder("json", _encode_json, _decode_json, "Lexical JSON"))
+register_encoder(DocumentEncoder("minimal", _encode_minimal, _decode_json, "Lexical JSON, format omitted = 0"))
+register_encoder(DocumentEncoder("compact", _encode_compact, _decode_compact, "compact blocks", COMPACT_FORMAT_NOTE))
+
+
+def get_encoder(name: Optional[str] = None) -> DocumentEncoder:
+    name = name or DEFAULT_DOCUMENT_ENCODING
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown document encoding: {name}")
+    return ENCODERS[name]
+
+
+def _baseline_sample(document: SimplifiedDocument) -> SimplifiedDocument:
+    blocks = document.blocks
+    step = max(1, len(blocks) // BASELINE_SAMPLE_BLOCKS)
+    return SimplifiedDocument(blocks=blocks[::step][:BASELINE_SAMPLE_BLOCKS])
+
+
+def encoding_stats(document: SimplifiedDocument, encoder: DocumentEncoder, encoded: str) -> dict:
+    """
+    Size of the chosen encoding next to the legacy pretty-printed JSON.
+
+    By default the baseline is estimated: both encodings of an evenly spaced
+    sample of blocks give the extra characters per block (the text itself is
+    the same in both), and baseline tokens follow the character ratio.
+    ENCODING_STATS_EXACT encodes and tokenizes the whole baseline instead.
+    """
+    chars = len(encoded)
+    tokens = count_tokens(encoded)
+    if encoder.name == "json":
+        baseline_chars, baseline_tokens = chars, tokens
+    elif ENCODING_STATS_EXACT:
+        baseline = _encode_json(document)
+        baseline_chars, baseline_tokens = len(baseline), count_tokens(baseline)
+    else:
+        sample = _baseline_sample(document)
+        extra = (len(_encode_json(sample)) - len(encoder.encode(sample))) / max(1, len(sample.blocks))
+        baseline_chars = chars + round(extra * len(document.blocks))
+        baseline_tokens = round(tokens * baseline_chars / chars) if chars else 0
+    return {
+        "encoding": encoder.name,
+        "chars": chars,
+        "baseline_chars": baseline_chars,
+        "tokens": tokens,
+        "baseline_tokens": baseline_tokens,
+        "baseline_exact": encoder.name == "json" or ENCODING_STATS_EXACT,
+        "tokens_saved_pct": round(100 * (1 - tokens / baseline_tokens), 1) if baseline_tokens else 0.0,
+    }
@@ -0,0 +1,492 @@
+import bisect
+import os
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+from models import TextSegment, SimplifiedBlock, SimplifiedDocument
+
+# ============== Server-side validation and application of AI edits ==============
+# replace_text (V1): every old_text is located in ONE pass over the document
+# with an Aho-Corasick automaton, then resolved to a position with context.
+# edit_document (V2): ops are checked against a block-id index and applied on
+# a linked list of blocks. Both run in linear time in document size + changes.
+
+VALIDATION_ENABLED = os.getenv("EDIT_VALIDATION", "true").lower() in ("1", "true", "yes")
+CONTEXT_CHARS = 40
+
+
+# ============== Multi-pattern text locator ==============
+
+class AhoCorasick:
+    """Finds all occurrences of many patterns in one scan of the text."""
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = [p for p in dict.fromkeys(patterns) if p]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # pattern indexes ending at each state
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(ch, 0)
+                self._fail[nxt] = candidate if candidate != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> Dict[str, dict]:
+        """Returns {pattern: {"count": n, "positions": [start, ...]}}, every occurrence in order."""
+        found = {pattern: {"count": 0, "positions": []} for pattern in self.patterns}
+        if not self.patterns:
+            return found
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for index in out[state]:
+                pattern = patterns[index]
+                entry = found[pattern]
+                entry["count"] += 1
+                entry["positions"].append(i - len(pattern) + 1)
+        return found
+
+
+# ============== replace_text (V1) ==============
+
+class _Spans:
+    """Non-overlapping claimed [start, end) ranges with O(log n) overlap checks."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def overlaps(self, start: int, end: int) -> bool:
+        i = bisect.bisect_right(self.starts, start)
+        if i and self.ends[i - 1] > start:
+            return True
+        return i < len(self.starts) and self.starts[i] < end
+
+    def add(self, start: int, end: int):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+
+def validate_text_changes(content: str, changes: List[dict], apply: bool = False) -> dict:
+    """
+    Resolve each {"old_text", "new_text"} change against `content`.
+
+    The k-th change with a given old_text takes the k-th non-overlapping
+    occurrence. Each resolved change gets position/context_before/context_after
+    and a status: "ok", "ambiguous" (resolved, but old_text occurs more often
+    than it is replaced), "missing", "empty" or "conflict" (overlaps an earlier
+    change). Returns {"changes", "issues", "applied_content"?}.
+    """
+    locator = AhoCorasick([change.get("old_text", "") for change in changes])
+    found = locator.find_all(content)
+    requested = Counter(change.get("old_text", "") for change in changes)
+
+    claimed = _Spans()
+    scanned = Counter()  # old_text -> positions already taken or found overlapping
+    resolved = []
+    issues = []
+
+    for index, change in enumerate(changes):
+        old_text = change.get("old_text", "") or ""
+        new_text = change.get("new_text", "") or ""
+        entry = {"old_text": old_text, "new_text": new_text}
+        if not old_text:
+            entry.update(status="empty", operation="insert", position=None)
+            issues.append({"index": index, "status": "empty", "old_text": old_text})
+            resolved.append(entry)
+            continue
+
+        occurrences = found[old_text]
+        # Earlier changes (including ones with the same old_text) have claimed
+        # their spans, so the first free occurrence is this change's match.
+        # Claims only grow, so the search resumes where the last one stopped.
+        position = None
+        positions = occurrences["positions"]
+        while scanned[old_text] < len(positions):
+            start = positions[scanned[old_text]]
+            scanned[old_text] += 1
+            if not claimed.overlaps(start, start + len(old_text)):
+                position = start
+                break
+
+        if occurrences["count"] == 0:
+            status = "missing"
+        elif position is None:
+            status = "conflict"
+        elif occurrences["count"] > requested[old_text]:
+            status = "ambiguous"
+        else:
+            status = "ok"
+
+        entry.update(
+            operation="replace" if new_text else "delete",
+            position=position,
+            status=status,
+            occurrences=occurrences["count"],
+        )
+        if position is not None:
+            end = position + len(old_text)
+            claimed.add(position, end)
+            entry["context_before"] = content[max(0, position - CONTEXT_CHARS):position]
+            entry["context_after"] = content[end:end + CONTEXT_CHARS]
+        if status != "ok":
+            issues.append({"index": index, "status": status, "old_text": old_text, "occurrences": occurrences["count"]})
+        resolved.append(entry)
+
+    result = {"changes": resolved, "issues": issues}
+    if apply:
+        result["applied_content"] = apply_text_changes(content, resolved)
+    return result
+
+
+def apply_text_changes(content: str, resolved: List[dict]) -> str:
+    """Apply resolved changes (those with a position) in one left-to-right pass."""
+    spans = sorted(
+        (c["position"], c["position"] + len(c["old_text"]), c["new_text"])
+        for c in resolved if c.get("position") is not None
+    )
+    parts = []
+    cursor = 0
+    for start, end, new_text in spans:
+        parts.append(content[cursor:start])
+        parts.append(new_text)
+        cursor = end
+    parts.append(content[cursor:])
+    return "".join(parts)
+
+
+# ============== edit_document (V2) ==============
+
+BLOCK_OPERATIONS = ("modify_segments", "replace_block", "insert_block", "delete_block")
+BLOCK_TYPES = ("paragraph", "heading", "list-item")
+
+
+def _segments_error(segments) -> Optional[str]:
+    if not isinstance(segments, list):
+        return "segments must be a list"
+    for segment in segments:
+        if not isinstance(segment, dict) or not isinstance(segment.get("text"), str):
+            return "each segment needs a text string"
+        if not isinstance(segment.get("format", 0), int):
+            return "segment format must be an integer bitmask"
+    return None
+
+
+def _new_block_error(block) -> Optional[str]:
+    if not isinstance(block, dict):
+        return "newBlock is required"
+    if not block.get("id"):
+        return "newBlock.id is required"
+    if block.get("type") not in BLOCK_TYPES:
+        return f"newBlock.type must be one of {', '.join(BLOCK_TYPES)}"
+    return _segments_error(block.get("segments"))
+
+
+class BlockValidator:
+    """
+    Checks edit_document ops one at a time against the document's block ids,
+    tracking blocks removed or created by earlier ops. Used for whole change
+    lists and incrementally by the streaming endpoint. An insert may anchor on
+    a block inserted earlier in the list (new-2 after new-1 is how the model
+    writes several paragraphs); editor_block_changes turns such chains into
+    anchors the editor knows.
+    """
+
+    def __init__(self, document: SimplifiedDocument):
+        self.original_ids = {block.id for block in document.blocks}
+        self.removed = set()   # deleted or replaced original blocks
+        self.created = set()   # ids introduced by insert_block / replace_block
+
+    def check(self, change: dict) -> Optional[str]:
+        """Returns None if the op can be applied, else the reason it can't."""
+        if not isinstance(change, dict):
+            return "change must be an object"
+        operation = change.get("operation")
+        if operation not in BLOCK_OPERATIONS:
+            return f"unknown operation: {operation}"
+
+        if operation == "insert_block":
+            after = change.get("afterBlockId")
+            if after is not None and after not in self.created:
+                if after not in self.original_ids:
+                    return f"unknown afterBlockId: {after}"
+                if after in self.removed:
+                    return f"afterBlockId {after} was deleted or replaced by an earlier change"
+            error = _new_block_error(change.get("newBlock"))
+            if error:
+                return error
+            new_id = change["newBlock"]["id"]
+            if new_id in self.original_ids or new_id in self.created:
+                return f"duplicate block id: {new_id}"
+            self.created.add(new_id)
+            return None
+
+        block_id = change.get("blockId")
+        if block_id not in self.original_ids:
+            return f"unknown blockId: {block_id}"
+        if block_id in self.removed:
+            return f"block {block_id} was already deleted or replaced"
+        if operation == "modify_segments":
+            return _segments_error(change.get("newSegments"))
+        if operation == "replace_block":
+            error = _new_block_error(change.get("newBlock"))
+            if error:
+                return error
+            new_id = change["newBlock"]["id"]
+            if new_id != block_id:
+                if new_id in self.original_ids or new_id in self.created:
+                    return f"duplicate block id: {new_id}"
+                self.created.add(new_id)
+        self.removed.add(block_id)
+        return None
+
+
+def validate_block_changes(document: SimplifiedDocument, changes: List[dict], apply: bool = False) -> dict:
+    """
+    Split edit_document ops into accepted and rejected ones.
+    Returns {"changes", "rejected", "applied_document"?}.
+    """
+    validator = BlockValidator(document)
+    accepted = []
+    rejected = []
+    for index, change in enumerate(changes):
+        error = validator.check(change)
+        if error:
+            rejected.append({"index": index, "change": change, "reason": error})
+        else:
+            accepted.append(change)
+    result = {"changes": accepted, "rejected": rejected}
+    if apply:
+        result["applied_document"] = apply_block_changes(document, accepted).model_dump(exclude_none=True)
+    return result
+
+
+def apply_block_changes(document: SimplifiedDocument, changes: List[dict]) -> SimplifiedDocument:
+    """
+    Apply validated ops as the model means them: each insert goes directly
+    after its anchor, original or inserted earlier (afterBlockId=null inserts
+    at the start), except that list items inserted one after another on the
+    same anchor stay in order, as in the editor. Blocks live in a doubly
+    linked list keyed by id so every op is O(1). The editor applies
+    editor_block_changes(document, changes) to the same result.
+    """
+    HEAD = object()
+    blocks = {block.id: block for block in document.blocks}
+    nxt = {HEAD: None}
+    prv = {}
+    previous = HEAD
+    for block in document.blocks:
+        nxt[previous] = block.id
+        prv[block.id] = previous
+        previous = block.id
+    nxt[previous] = None
+
+    def unlink(block_id):
+        before, after = prv.pop(block_id), nxt.pop(block_id)
+        nxt[before] = after
+        if after is not None:
+            prv[after] = before
+
+    def link_after(anchor, block_id):
+        after = nxt[anchor]
+        nxt[anchor] = block_id
+        prv[block_id] = anchor
+        nxt[block_id] = after
+        if after is not None:
+            prv[after] = block_id
+
+    list_run = None  # (listType, anchor, last item) while list-item inserts follow each other
+    for change in changes:
+        operation = change["operation"]
+        previous_run, list_run = list_run, None
+        if operation == "modify_segments":
+            block = blocks[change["blockId"]]
+            segments = [TextSegment.model_validate(segment) for segment in change["newSegments"]]
+            blocks[block.id] = block.model_copy(update={"segments": segments})
+        elif operation == "replace_block":
+            new_block = SimplifiedBlock.model_validate(change["newBlock"])
+            old_id = change["blockId"]
+            anchor = prv[old_id]
+            unlink(old_id)
+            del blocks[old_id]
+            blocks[new_block.id] = new_block
+            link_after(anchor, new_block.id)
+        elif operation == "delete_block":
+            unlink(change["blockId"])
+            del blocks[change["blockId"]]
+        elif operation == "insert_block":
+            new_block = SimplifiedBlock.model_validate(change["newBlock"])
+            blocks[new_block.id] = new_block
+            anchor = change.get("afterBlockId")
+            list_type = _list_type(change)
+            if list_type is not None and previous_run is not None and previous_run[:2] == (list_type, anchor):
+                link_after(previous_run[2], new_block.id)
+            else:
+                link_after(HEAD if anchor is None else anchor, new_block.id)
+            if list_type is not None:
+                list_run = (list_type, anchor, new_block.id)
+
+    ordered = []
+    current = nxt[HEAD]
+    while current is not None:
+        ordered.append(blocks[current])
+        current = nxt[current]
+    return SimplifiedDocument(blocks=ordered)
+
+
+# ============== Editor order ==============
+# The editor (lexicalChangeApplicator.ts) applies a change list against the
+# ids of the blocks it sent. An insert lands directly after its anchor, or at
+# the end of the document when the anchor is not an original block still in
+# place (a new block, or one deleted or replaced by an earlier op); so a run
+# of inserts on one anchor comes out in reverse. Consecutive list-item
+# inserts of one listType are the exception: they become one list at the
+# first one's anchor, in order.
+#
+# editor_block_changes rewrites valid ops so the editor gets the document
+# apply_block_changes gives: all inserts first, each run of new blocks
+# anchored on the original block before it, its paragraphs and lists in
+# reverse and the items of each list in order, then the other ops. Two runs
+# whose list items would join are kept apart by another op; when none can
+# move there, an unchanged modify_segments on the next run's anchor does.
+
+def _list_type(change: dict) -> Optional[str]:
+    """listType of an insert_block that adds a list item, else None."""
+    block = change["newBlock"]
+    return (block.get("listType") or "bullet") if block.get("type") == "list-item" else None
+
+
+def _units(inserts: List[dict]) -> List[List[dict]]:
+    """A run of inserts split into what the editor inserts at once: a list, or one block."""
+    units = []
+    for change in inserts:
+        list_type = _list_type(change)
+        if list_type is not None and units and _list_type(units[-1][0]) == list_type:
+            units[-1].append(change)
+        else:
+            units.append([change])
+    return units
+
+
+def order_block_changes(document: SimplifiedDocument, runs: List[tuple], edits: List[dict]) -> List[dict]:
+    """
+    Editor order (see above) for `runs`, (anchor, insert ops in document
+    order) in document order with one run per anchor, and `edits`, the other
+    ops in the order they apply.
+    """
+    runs = [(anchor, _units(inserts)[::-1]) for anchor, inserts in runs]
+    anchored = Counter(anchor for anchor, _ in runs)
+    waiting = list(edits)
+    segments = {}  # blocks modified ahead of time -> their new segments
+    ordered = []
+    last = None  # listType of the last op, when it inserts a list item
+
+    def separator() -> dict:
+        touched = set()
+        for index, change in enumerate(waiting):
+            block_id = change["blockId"]
+            if block_id not in touched and (change["operation"] == "modify_segments" or not anchored[block_id]):
+                if change["operation"] == "modify_segments":
+                    segments[block_id] = change["newSegments"]
+                return waiting.pop(index)
+            touched.add(block_id)
+        anchor = runs[0][0]  # not None: a run at the start goes first
+        if anchor not in segments:
+            block = next(block for block in document.blocks if block.id == anchor)
+            segments[anchor] = [segment.model_dump() for segment in block.segments]
+        return {"operation": "modify_segments", "blockId": anchor, "newSegments": segments[anchor]}
+
+    while runs:
+        index = next((i for i, (_, units) in enumerate(runs) if last is None or _list_type(units[0][0]) != last), None)
+        if index is None:
+            ordered.append(separator())
+            last = None
+            continue
+        anchor, units = runs.pop(index)
+        anchored[anchor] -= 1
+        for unit in units:
+            ordered.extend({**change, "afterBlockId": anchor} for change in unit)
+        last = _list_type(units[-1][0])
+    return ordered + waiting
+
+
+def editor_block_changes(document: SimplifiedDocument, changes: List[dict]) -> List[dict]:
+    """Valid ops (see BlockValidator) in editor order; without inserts they are unchanged."""
+    inserts = {change["newBlock"]["id"]: change for change in changes if change["operation"] == "insert_block"}
+    if not inserts:
+        return changes
+    replaced = {change["newBlock"]["id"]: change["blockId"] for change in changes if change["operation"] == "replace_block"}
+    runs = []
+    anchor = None
+    run = None
+    for block in apply_block_changes(document, changes).blocks:
+        if block.id in inserts:
+            if run is None:
+                run = []
+                runs.append((anchor, run))
+            run.append(inserts[block.id])
+        else:
+            anchor = replaced.get(block.id, block.id)
+            run = None
+    return order_block_changes(document, runs, [change for change in changes if change["operation"] != "insert_block"])
+
+
+def apply_editor_changes(document: SimplifiedDocument, changes: List[dict]) -> SimplifiedDocument:
+    """`changes` applied the way the editor does (see above), list grouping included."""
+    order = [block.id for block in document.blocks]
+    blocks = {block.id: block for block in document.blocks}
+    in_place = set(order)  # the editor's block-key map, less blocks deleted or replaced
+    index = 0
+    while index < len(changes):
+        change = changes[index]
+        operation = change["operation"]
+        index += 1
+        if operation == "insert_block":
+            group = [change]
+            list_type = _list_type(change)
+            while list_type is not None and index < len(changes) and changes[index]["operation"] == "insert_block" \
+                    and _list_type(changes[index]) == list_type:
+                group.append(changes[index])
+                index += 1
+            anchor = change.get("afterBlockId")
+            position = 0 if anchor is None else order.index(anchor) + 1 if anchor in in_place else len(order)
+            new_blocks = [SimplifiedBlock.model_validate(insert["newBlock"]) for insert in group]
+            blocks.update((block.id, block) for block in new_blocks)
+            order[position:position] = [block.id for block in new_blocks]
+        elif change["blockId"] not in in_place:
+            continue  # "Block not found"
+        elif operation == "modify_segments":
+            block = blocks[change["blockId"]]
+            blocks[block.id] = block.model_copy(update={"segments": [TextSegment.model_validate(s) for s in change["newSegments"]]})
+        elif operation == "replace_block":
+            new_block = SimplifiedBlock.model_validate(change["newBlock"])
+            order[order.index(change["blockId"])] = new_block.id
+            in_place.discard(change["blockId"])
+            blocks[new_block.id] = new_block
+        elif operation == "delete_block":
+            order.remove(change["blockId"])
+            in_place.discard(change["blockId"])
+    return SimplifiedDocument(blocks=[blocks[block_id] for block_id in order])
@@ -0,0 +1,203 @@
+import json
+import os
+import time
+from typing import Optional
+
+# ============== Single-pass vs two-pass summaries ==============
+# Two-pass: a second json_object completion produces reasoning/summary after
+# the tool calls (re-sends the whole conversation, including the document).
+# Single-pass: reasoning/summary ride along in the tool-call completion, or are
+# built locally from the change list when the model leaves them out.
+
+SINGLE_PASS_DEFAULT = os.getenv("EDIT_SINGLE_PASS", "true").lower() in ("1", "true", "yes")
+
+SINGLE_PASS_V1_NOTE = """In the SAME reply as your tool calls, write your reasoning and summary as a JSON object in the message text: {"reasoning": "...", "summary": "..."}"""
+
+SINGLE_PASS_V2_NOTE = """Put your reasoning and summary in the "reasoning" and "summary" fields of the edit_document call (after "changes")."""
+
+SUMMARY_FOLLOW_UP = "Now provide your reasoning and summary in JSON format with fields: reasoning, summary"
+
+
+def use_single_pass(flag: Optional[bool]) -> bool:
+    return SINGLE_PASS_DEFAULT if flag is None else flag
+
+
+def with_summary_fields(tool: dict) -> dict:
+    """Copy of a tool schema with optional reasoning/summary string arguments added."""
+    function = dict(tool["function"])
+    parameters = dict(function["parameters"])
+    properties = dict(parameters["properties"])
+    properties["reasoning"] = {
+        "type": "string",
+        "description": "Brief analysis of what changes were made and why (1-3 sentences)",
+    }
+    properties["summary"] = {
+        "type": "string",
+        "description": "Concise statement of what was changed (no pleasantries)",
+    }
+    parameters["properties"] = properties
+    function["parameters"] = parameters
+    return {"type": tool["type"], "function": function}
+
+
+def parse_inline_summary(content: Optional[str]) -> dict:
+    """Pull {"reasoning", "summary"} out of message text, tolerating prose around the JSON."""
+    if not content:
+        return {}
+    start = content.find("{")
+    end = content.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        result = json.loads(content[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(result, dict):
+        return {}
+    return {key: result[key] for key in ("reasoning", "summary") if isinstance(result.get(key), str)}
+
+
+def _clip(text: str, limit: int = 40) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def local_text_summary(changes: list) -> str:
+    """Summary for replace_text change lists: {"old_text", "new_text"}."""
+    if not changes:
+        return "No changes needed."
+    if len(changes) == 1:
+        change = changes[0]
+        return f'Replaced "{_clip(change.get("old_text", ""))}" with "{_clip(change.get("new_text", ""))}".'
+    shown = ", ".join(f'"{_clip(c.get("old_text", ""), 25)}"' for c in changes[:3])
+    more = f" and {len(changes) - 3} more" if len(changes) > 3 else ""
+    return f"Made {len(changes)} replacements: {shown}{more}."
+
+
+_OPERATION_VERBS = {
+    "modify_segments": "modified",
+    "replace_block": "replaced",
+    "insert_block": "inserted",
+    "delete_block": "deleted",
+}
+
+
+def local_block_summary(changes: list) -> str:
+    """Summary for edit_document change lists."""
+    if not changes:
+        return "No changes needed."
+    counts = {}
+    for change in changes:
+        operation = change.get("operation")
+        counts[operation] = counts.get(operation, 0) + 1
+    parts = []
+    for operation, verb in _OPERATION_VERBS.items():
+        if operation in counts:
+            n = counts[operation]
+            parts.append(f"{verb} {n} block{'s' if n != 1 else ''}")
+    if not parts:
+        return f"Applied {len(changes)} changes."
+    text = ", ".join(parts)
+    return text[0].upper() + text[1:] + "."
+
+
+# ============== Side-by-side mode stats ==============
+
+class ModeStats:
+    """Running latency/token totals per (endpoint, mode), served by /api/stats/edit-modes."""
+
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, endpoint: str, mode: str, latency: float, usage: dict):
+        entry = self._stats.setdefault((endpoint, mode), {
+            "requests": 0,
+            "completions": 0,
+            "latency_total": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            # Requests whose prompt hit the provider's prefix cache, and their latency
+            "cache_hit_requests": 0,
+            "cache_hit_latency_total": 0.0,
+        })
+        entry["requests"] += 1
+        entry["completions"] += usage.get("calls", 0)
+        entry["latency_total"] += latency
+        entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        entry["completion_tokens"] += usage.get("completion_tokens", 0)
+        entry["cached_tokens"] += usage.get("cached_tokens", 0)
+        if usage.get("cached_tokens"):
+            entry["cache_hit_requests"] += 1
+            entry["cache_hit_latency_total"] += latency
+
+    def snapshot(self) -> list:
+        rows = []
+        for (endpoint, mode), entry in sorted(self._stats.items()):
+            n = entry["requests"]
+            hits = entry["cache_hit_requests"]
+            misses = n - hits
+            hit_latency = entry["cache_hit_latency_total"] / hits if hits else None
+            miss_latency = (entry["latency_total"] - entry["cache_hit_latency_total"]) / misses if misses else None
+            rows.append({
+                "endpoint": endpoint,
+                "mode": mode,
+                "requests": n,
+                "avg_latency_ms": round(entry["latency_total"] / n * 1000, 1),
+                "avg_completions": round(entry["completions"] / n, 2),
+                "avg_prompt_tokens": round(entry["prompt_tokens"] / n, 1),
+                "avg_completion_tokens": round(entry["completion_tokens"] / n, 1),
+                "avg_cached_tokens": round(entry["cached_tokens"] / n, 1),
+                "prompt_cache_hit_rate": round(entry["cached_tokens"] / entry["prompt_tokens"], 3) if entry["prompt_tokens"] else 0.0,
+                "prompt_cache_hit_requests": hits,
+                "latency_saved_ms": (
+                    round((miss_latency - hit_latency) * 1000, 1)
+                    if hit_latency is not None and miss_latency is not None else None
+                ),
+            })
+        return rows
+
+
+MODE_STATS = ModeStats()
+
+
+def cached_prompt_tokens(usage) -> int:
+    """usage.prompt_tokens_details.cached_tokens (a plain dict on older openai clients)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class UsageTally:
+    """Accumulates response.usage across the completions of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, response):
+        self.calls += 1
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+            self.cached_tokens += cached_prompt_tokens(usage)
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+
+    def finish(self, endpoint: str, single_pass: bool) -> dict:
+        """Record the request in MODE_STATS; returns its summary for the request trace."""
+        latency = time.perf_counter() - self.started
+        mode = "single_pass" if single_pass else "two_pass"
+        MODE_STATS.record(endpoint, mode, latency, self.as_dict())
+        return {"mode": mode, **self.as_dict()}
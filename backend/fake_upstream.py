@@ -0,0 +1,153 @@
+import asyncio
+import json
+import random
+import time
+from typing import Optional
+
+import httpx
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+# ============== Fake upstream for offline testing ==============
+# OPENAI_FAKE_UPSTREAM="delay=0.2,jitter=0.1,error_rate=0.1" makes llm.py use
+# this in-process stand-in for AsyncOpenAI instead of the real API. It answers
+# every chat completion with a small valid response (a "no changes" tool call
+# when tools are offered, or a JSON/text message) after an injected delay, and
+# can inject failures:
+#   delay, jitter       base latency and uniform extra latency (seconds)
+#   slow_rate, slow_delay  share of calls that take slow_delay instead (tail)
+#   error_rate, error_status  share of calls failing with that HTTP status
+#   timeout_rate        share of calls that hang until the client gives up
+#   connect_error_rate  share of calls failing with a connection error
+#   chunk_delay         seconds between streamed chunks
+# All values can also be changed at runtime with FakeUpstream.configure().
+
+DEFAULTS = {
+    "delay": 0.05,
+    "jitter": 0.0,
+    "slow_rate": 0.0,
+    "slow_delay": 5.0,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "timeout_rate": 0.0,
+    "connect_error_rate": 0.0,
+    "chunk_delay": 0.01,
+}
+
+_REQUEST = httpx.Request("POST", "http://fake-upstream/v1/chat/completions")
+
+
+def parse_spec(spec: str) -> dict:
+    """"delay=0.2,error_rate=0.1" -> {"delay": 0.2, "error_rate": 0.1} (unknown keys are ignored)."""
+    config = {}
+    for item in (spec or "").split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key in DEFAULTS and value.strip():
+            config[key] = type(DEFAULTS[key])(float(value))
+    return config
+
+
+def _estimate_tokens(messages) -> int:
+    return sum(len(str(message.get("content") or "")) for message in messages) // 4 + 1
+
+
+def fake_reply(kwargs: dict) -> dict:
+    """Assistant message for a request: a no-op call of the first tool, else JSON or text."""
+    tools = kwargs.get("tools") or []
+    summary = {"reasoning": "Fake upstream response.", "summary": "No changes needed."}
+    if tools:
+        name = tools[0]["function"]["name"]
+        if name == "edit_document":
+            arguments = {"changes": [], **summary}
+        elif name == "replace_text":
+            return {"role": "assistant", "content": json.dumps(summary)}
+        else:
+            arguments = {}
+        return {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{"id": "call_fake", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}],
+        }
+    if (kwargs.get("response_format") or {}).get("type") == "json_object":
+        return {"role": "assistant", "content": json.dumps(summary)}
+    return {"role": "assistant", "content": "Fake upstream text."}
+
+
+class _FakeStream:
+    def __init__(self, message: dict, model: str, chunk_delay: float):
+        self.message = message
+        self.model = model
+        self.chunk_delay = chunk_delay
+        self.response = self  # code closes streams with stream.response.aclose()
+
+    async def aclose(self):
+        pass
+
+    def _chunk(self, delta: dict, finish: Optional[str] = None) -> ChatCompletionChunk:
+        return ChatCompletionChunk.model_validate({
+            "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+        })
+
+    async def __aiter__(self):
+        if self.message.get("tool_calls"):
+            call = self.message["tool_calls"][0]
+            yield self._chunk({"tool_calls": [{"index": 0, "id": call["id"], "type": "function", "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            arguments = call["function"]["arguments"]
+            for i in range(0, len(arguments), 16):
+                await asyncio.sleep(self.chunk_delay)
+                yield self._chunk({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 16]}}]})
+            yield self._chunk({}, "tool_calls")
+            return
+        content = self.message.get("content") or ""
+        for i in range(0, len(content), 16):
+            await asyncio.sleep(self.chunk_delay)
+            yield self._chunk({"content": content[i:i + 16]})
+        yield self._chunk({}, "stop")
+
+
+class FakeUpstream:
+    """Just enough of openai.AsyncOpenAI: chat.completions.create() and close()."""
+
+    def __init__(self, **config):
+        self.config = {**DEFAULTS, **config}
+        self.chat = self
+        self.completions = self
+        self.calls = 0
+
+    def configure(self, **config):
+        self.config.update(config)
+
+    async def close(self):
+        pass
+
+    async def create(self, *, model: str, messages: list, stream: bool = False, timeout=None, **kwargs):
+        self.calls += 1
+        config = self.config
+        roll = random.random()
+        if roll < config["connect_error_rate"]:
+            raise openai.APIConnectionError(request=_REQUEST)
+        roll -= config["connect_error_rate"]
+        if roll < config["timeout_rate"]:
+            await asyncio.sleep(3600)  # the caller's deadline ends this
+        roll -= config["timeout_rate"]
+        if random.random() < config["slow_rate"]:
+            await asyncio.sleep(config["slow_delay"])
+        else:
+            await asyncio.sleep(config["delay"] + random.uniform(0, config["jitter"]))
+        if roll < config["error_rate"]:
+            status = int(config["error_status"])
+            response = httpx.Response(status, request=_REQUEST, json={"error": {"message": "injected error"}})
+            raise openai.APIStatusError(f"Error code: {status} - injected error", response=response, body=None)
+
+        message = fake_reply({**kwargs, "messages": messages})
+        if stream:
+            return _FakeStream(message, model, config["chunk_delay"])
+        prompt_tokens = _estimate_tokens(messages)
+        completion_tokens = len(json.dumps(message)) // 4
+        return ChatCompletion.model_validate({
+            "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
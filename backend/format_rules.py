@@ -0,0 +1,556 @@
+import os
+import re
+from typing import List, Optional, Tuple
+
+from models import SimplifiedBlock, SimplifiedDocument
+
+# ============== Rule-based APA/MLA/Chicago formatting ==============
+# Most of a citation style is mechanical: Title Case headings, the title line,
+# the name of the references heading. Those rules run locally on the markdown
+# (or on SimplifiedDocument blocks) and produce the same change lists the model
+# would. The model is only asked for what rules can't decide, such as which
+# phrases are book titles, and only when the text has something that looks
+# like one.
+#
+# The title is only taken from a line that is clearly one: a "#" heading or a
+# bold line first, or the line after an MLA-style header (name, instructor,
+# course, date), which is left alone. Otherwise finding the title is left to
+# the model too.
+#
+# FORMAT_MODE / request.format_mode:
+#   "rules"  - rules only, never call the model
+#   "hybrid" - rules, then the model for the rest of the style if needed
+#   "model"  - the model does everything (previous behaviour)
+#
+# FORMAT_OUTPUT / request.output, for /api/format:
+#   "text"   - replace_text changes on the markdown (previous behaviour)
+#   "blocks" - the markdown is read as blocks (markdown_blocks.py) and runs
+#              through the /api/format/v2 pipeline: edit_document ops
+
+FORMAT_MODE_DEFAULT = os.getenv("FORMAT_MODE", "hybrid")
+FORMAT_MODES = ("rules", "hybrid", "model")
+FORMAT_OUTPUT_DEFAULT = os.getenv("FORMAT_OUTPUT", "text")
+FORMAT_OUTPUTS = ("text", "blocks")
+
+TITLE_MAX_WORDS = 15
+HEADING_MAX_WORDS = 8
+
+STYLE_RULES = {
+    "APA": {
+        "title": "bold",          # **Title**
+        "heading_level": 2,       # top-level section headings
+        "references": "References",
+        "references_level": 2,
+        "model_rules": [],        # nothing left for the model
+        "model_hint": None,
+    },
+    "MLA": {
+        "title": "heading",       # # Title, no bold/italic
+        "heading_level": 2,
+        "references": "Works Cited",
+        "references_level": 1,
+        "model_rules": ["Book titles in text and in Works Cited entries: italic"],
+        "model_hint": "titles",
+    },
+    "Chicago": {
+        "title": "heading",
+        "heading_level": 2,
+        "references": "Bibliography",
+        "references_level": 1,
+        "model_rules": ["Book titles in text and in Bibliography entries: italic", "Foreign phrases: italic"],
+        "model_hint": "titles_or_foreign",
+    },
+}
+
+MODEL_INSTRUCTION_V1 = """Apply the remaining {style} formatting using MARKDOWN. {formatted} already formatted; do not change them.
+{rules}
+
+Example: replace_text("The Great Gatsby", "*The Great Gatsby*")
+
+Use replace_text tool with markdown syntax (*italic*, **bold**, # heading). If nothing needs changing, make no changes."""
+
+MODEL_INSTRUCTION_V2 = """Apply the remaining {style} formatting. {formatted} already formatted; do not change them.
+{rules}
+
+Italic is segment format 2, bold 1 (combine bits, e.g. 3 = bold italic). Split segments so only the phrase itself is italic, and use modify_segments on the blocks that need it (replace_block to turn a paragraph into a heading). If nothing needs changing, make no changes."""
+
+# The title rule, for the model, when the rules found no title line
+TITLE_RULES = {
+    ("bold", False): "Title: the paper's title line, in bold Title Case on its own line (**Title**)",
+    ("bold", True): "Title: the paper's title line, as a paragraph in bold (format 1) Title Case",
+    ("heading", False): "Title: the paper's title line, as a level-1 heading in Title Case without bold or italic (# Title)",
+    ("heading", True): "Title: the paper's title line, as an h1 heading in Title Case without bold or italic",
+}
+TITLE_NOTE = "The title is the first line after any name, instructor, course and date lines, which stay as they are. If no line is clearly the title, leave it."
+
+
+def use_format_mode(mode: Optional[str]) -> str:
+    mode = mode or FORMAT_MODE_DEFAULT
+    return mode if mode in FORMAT_MODES else "hybrid"
+
+
+def use_format_output(output: Optional[str]) -> str:
+    output = output or FORMAT_OUTPUT_DEFAULT
+    return output if output in FORMAT_OUTPUTS else "text"
+
+
+def style_rules(format_type: str) -> Optional[dict]:
+    for name, rules in STYLE_RULES.items():
+        if name.lower() == (format_type or "").strip().lower():
+            return {**rules, "style": name}
+    return None
+
+
+def model_instruction(rules: dict, blocks: bool = False, title: bool = True) -> Optional[str]:
+    """
+    The part of the style left to the model (None when rules cover all of it).
+    title: whether the rules found the title line; if not, the model looks for it.
+    """
+    model_rules = list(rules["model_rules"])
+    if not title:
+        model_rules.insert(0, f"{TITLE_RULES[(rules['title'], blocks)]}. {TITLE_NOTE}")
+    if not model_rules:
+        return None
+    template = MODEL_INSTRUCTION_V2 if blocks else MODEL_INSTRUCTION_V1
+    formatted = "The title, headings and" if title else "Headings and"
+    return template.format(
+        style=rules["style"],
+        formatted=f'{formatted} the "{rules["references"]}" heading are',
+        rules="\n".join(f"- {rule}" for rule in model_rules),
+    )
+
+
+# ============== Title Case ==============
+
+_MINOR_WORDS = {
+    "a", "an", "the", "and", "but", "or", "nor", "for", "so", "yet",
+    "as", "at", "by", "in", "of", "off", "on", "per", "to", "up", "via",
+}
+_WORD = re.compile(r"[A-Za-z][A-Za-z'’]*")
+
+
+def title_case(text: str) -> str:
+    """
+    Title Case: major words capitalized, minor words (articles, short
+    conjunctions and prepositions) lowercase unless first, last or after a
+    colon. Acronyms and mixed-case words (iPhone, NASA) are kept; a line in
+    ALL CAPS is treated as lowercase first.
+    """
+    if text.isupper():
+        text = text.lower()
+    words = list(_WORD.finditer(text))
+    out = []
+    cursor = 0
+    for i, match in enumerate(words):
+        word = match.group()
+        out.append(text[cursor:match.start()])
+        cursor = match.end()
+        after_colon = text[:match.start()].rstrip().endswith((":", "—", "?", "!"))
+        if word != word.lower() and word != word.capitalize():
+            out.append(word)  # acronym or mixed case
+        elif word.lower() in _MINOR_WORDS and 0 < i < len(words) - 1 and not after_colon:
+            out.append(word.lower())
+        else:
+            out.append(word[0].upper() + word[1:])
+    out.append(text[cursor:])
+    return "".join(out)
+
+
+# ============== Line classification ==============
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BOLD_LINE = re.compile(r"^(\*\*|__)(.+?)\1$")
+_REFERENCES = re.compile(
+    r"^(?:references?|reference list|works cited|bibliography|sources(?: cited)?)\s*:?$", re.IGNORECASE
+)
+_CAPS_LINE = re.compile(r"^[A-Z0-9][A-Z0-9 &,'/:\-]*[A-Z0-9:]$")
+# A one-word all-caps line is a heading only when it names a usual paper
+# section; otherwise it is taken for an acronym (NASA, UNICEF)
+SECTION_HEADINGS = frozenset({
+    "abstract", "introduction", "background", "overview", "method", "methods", "methodology",
+    "materials", "participants", "procedure", "procedures", "measures", "design", "analysis",
+    "results", "findings", "discussion", "limitations", "implications", "conclusion", "conclusions",
+    "summary", "notes", "acknowledgments", "acknowledgements", "appendix", "appendices",
+    "preface", "foreword", "epilogue", "afterword", "glossary", "tables", "figures",
+})
+_LIST_OR_QUOTE = re.compile(r"^(?:[-*+>|]|\d+[.)])\s")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_MONTH = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?"
+_DATE_LINE = re.compile(
+    rf"^(?:\d{{1,2}} {_MONTH} \d{{4}}|{_MONTH} \d{{1,2}},? \d{{4}}|\d{{4}}-\d{{2}}-\d{{2}}|\d{{1,2}}/\d{{1,2}}/\d{{2,4}})$",
+    re.IGNORECASE,
+)
+HEADER_MAX_LINES = 5  # MLA header: name, instructor, course, date (and sometimes one more)
+
+
+def _strip_emphasis(text: str) -> str:
+    text = text.strip()
+    match = _BOLD_LINE.match(text)
+    if match:
+        text = match.group(2).strip()
+    if len(text) > 2 and text[0] == text[-1] and text[0] in "*_" and text[1] != text[0]:
+        text = text[1:-1].strip()
+    return text
+
+
+def _is_title_like(text: str) -> bool:
+    return (
+        0 < len(text.split()) <= TITLE_MAX_WORDS
+        and len(text) <= 120
+        and not text.endswith((".", ",", ";"))
+        and not _LIST_OR_QUOTE.match(text)
+    )
+
+
+def _is_caps_heading(text: str) -> bool:
+    words = text.split()
+    return (
+        bool(_CAPS_LINE.match(text))
+        and any(ch.isalpha() for ch in text)
+        and len(text) >= 3
+        and len(words) <= HEADING_MAX_WORDS
+        and (len(words) > 1 or text.rstrip(":").lower() in SECTION_HEADINGS)
+    )
+
+
+def _is_header_line(text: str) -> bool:
+    return 0 < len(text.split()) <= 8 and len(text) <= 80 and not text.endswith((".", ",", ";", ":"))
+
+
+def _title_position(lines: list) -> Tuple[Optional[int], int]:
+    """
+    (index of the title line or None, number of header lines before it) for
+    the first non-empty lines, each (level, plain text, whole line bold) or
+    None for a line that can't be a title or header (a list item). Only a
+    line that is clearly the title counts: a "#" heading or a bold line
+    first, or the line after an MLA header ending in a date.
+    """
+    if not lines or lines[0] is None:
+        return None, 0
+    level, plain, bold = lines[0]
+    if level == 1 or (level == 0 and bold and _is_title_like(plain)):
+        return 0, 0
+    for index, line in enumerate(lines[:HEADER_MAX_LINES]):
+        if line is None or line[0] or not _is_header_line(line[1]):
+            break
+        if _DATE_LINE.match(line[1]):
+            if index == 0:
+                break
+            following = lines[index + 1] if index + 1 < len(lines) else None
+            if following is not None and following[0] <= 1 and _is_title_like(following[1]):
+                return index + 1, index + 1
+            return None, index + 1
+    return None, 0
+
+
+def _markdown_line(text: str) -> Tuple[int, str, bool]:
+    """(level, plain text, whole line bold) of a markdown line."""
+    stripped = text.strip()
+    match = _HEADING.match(stripped)
+    level, body = (len(match.group(1)), match.group(2)) if match else (0, stripped)
+    return level, _strip_emphasis(body), bool(_BOLD_LINE.match(body))
+
+
+def _classify(text: str, is_title: bool) -> Tuple[Optional[str], int, str]:
+    """
+    (kind, level, plain text) for one line, kind in "title", "references",
+    "heading" or None (leave alone). level is the markdown heading level, 0
+    for a line that isn't a markdown heading.
+    """
+    level, plain, bold = _markdown_line(text)
+    if not plain:
+        return None, level, plain
+    if _REFERENCES.match(plain) and (level or len(plain.split()) <= 3):
+        return "references", level, plain
+    if is_title:
+        return "title", level, plain
+    if level:
+        return "heading", level, plain
+    if _is_caps_heading(plain) or (bold and _is_title_like(plain)):
+        return "heading", 0, plain
+    return None, level, plain
+
+
+def _render_title(rules: dict, plain: str) -> str:
+    if rules["title"] == "bold":
+        return f"**{title_case(plain)}**"
+    return f"# {title_case(plain)}"
+
+
+def _heading_level(rules: dict, level: int) -> int:
+    # Section headings sit below the title: "#" headings after the first line move down
+    return max(level, rules["heading_level"]) if level else rules["heading_level"]
+
+
+# ============== Markdown (V1, replace_text) ==============
+
+def _anchor(content: str, line: str, start: int, resume: dict) -> Tuple[str, int]:
+    """
+    old_text for the line at `start`. The validator gives each change the
+    first occurrence not claimed by an earlier one, so the line itself is used
+    when its next occurrence is this line, else the line with its leading
+    newline. `resume` maps old_text -> where its next search starts.
+    Returns (old_text, offset of the line inside it).
+    """
+    for old_text, at in ((line, 0), ("\n" + line, 1)):
+        if at > start:
+            continue
+        found = content.find(old_text, resume.get(old_text, 0), start - at + len(old_text))
+        if found == start - at:
+            resume[old_text] = start - at + len(old_text)
+            return old_text, at
+    resume["\n" + line] = start + len(line)
+    return "\n" + line, 1
+
+
+def _markdown_title(lines: List[str]) -> Tuple[Optional[int], int, bool]:
+    """_title_position for markdown lines, plus whether there is any text."""
+    first = []
+    for line in lines:
+        if len(first) > HEADER_MAX_LINES:
+            break
+        if _FENCE.match(line):
+            first.append(None)
+            break
+        if line.strip():
+            first.append(None if _LIST_OR_QUOTE.match(line.strip()) else _markdown_line(line))
+    return (*_title_position(first), bool(first))
+
+
+def markdown_title_missing(content: str) -> bool:
+    """Whether markdown `content` has text but no line the rules take for the title."""
+    title, _, has_text = _markdown_title(content.split("\n"))
+    return has_text and title is None
+
+
+def markdown_rule_changes(content: str, format_type: str) -> List[dict]:
+    """
+    replace_text changes ({"old_text", "new_text", "source": "rules", "rule"})
+    that apply the mechanical part of `format_type` to markdown `content`.
+    Unknown styles get no changes.
+    """
+    rules = style_rules(format_type)
+    if rules is None:
+        return []
+    lines = content.split("\n")
+    title, header, _ = _markdown_title(lines)
+    changes = []
+    offset = 0
+    in_fence = False
+    seen = 0  # non-empty lines so far
+    resume = {}
+    for line in lines:
+        start = offset
+        offset += len(line) + 1
+        if _FENCE.match(line):
+            in_fence = not in_fence
+            continue
+        if in_fence or not line.strip():
+            continue
+        seen += 1
+        if seen <= header:
+            continue  # name, instructor, course, date
+        kind, level, plain = _classify(line, seen - 1 == title)
+        if kind == "title":
+            new_line = _render_title(rules, plain)
+        elif kind == "references":
+            new_line = "#" * rules["references_level"] + " " + rules["references"]
+        elif kind == "heading":
+            new_line = "#" * _heading_level(rules, level) + " " + title_case(plain)
+        else:
+            continue
+        body = line[:-1] if line.endswith("\r") else line  # CRLF content keeps its line endings
+        if new_line == body.strip() and body == body.strip():
+            continue
+        old_text, at = _anchor(content, line, start, resume)
+        changes.append({
+            "old_text": old_text,
+            "new_text": old_text[:at] + new_line + line[len(body):] + old_text[at + len(line):],
+            "source": "rules",
+            "rule": kind,
+        })
+    return changes
+
+
+# ============== SimplifiedDocument (V2, edit_document) ==============
+
+def _retitle_segments(segments, text: str, format_override: Optional[int] = None) -> list:
+    """Segments with `text` (same length, only case changed) cut at the old boundaries."""
+    result = []
+    cursor = 0
+    for segment in segments:
+        piece = text[cursor:cursor + len(segment.text)]
+        cursor += len(segment.text)
+        if piece:
+            result.append({"text": piece, "format": segment.format if format_override is None else format_override})
+    return result
+
+
+def _block_text(block: SimplifiedBlock) -> str:
+    return "".join(segment.text for segment in block.segments)
+
+
+def _block_level(block: SimplifiedBlock) -> int:
+    return int(block.tag[1]) if block.type == "heading" and block.tag else (1 if block.type == "heading" else 0)
+
+
+def _block_bold(block: SimplifiedBlock) -> bool:
+    return all(segment.format & 1 for segment in block.segments if segment.text.strip())
+
+
+def _block_title(document: SimplifiedDocument) -> Tuple[Optional[int], int, bool]:
+    """_title_position for the blocks with text, plus whether there are any."""
+    first = []
+    for block in document.blocks:
+        if len(first) > HEADER_MAX_LINES:
+            break
+        text = _block_text(block).strip()
+        if text:
+            first.append(None if block.type == "list-item" else (_block_level(block), text, _block_bold(block)))
+    return (*_title_position(first), bool(first))
+
+
+def document_title_missing(document: SimplifiedDocument) -> bool:
+    """Whether `document` has text but no block the rules take for the title."""
+    title, _, has_text = _block_title(document)
+    return has_text and title is None
+
+
+def block_rule_changes(document: SimplifiedDocument, format_type: str) -> List[dict]:
+    """edit_document ops (tagged "source": "rules") for the mechanical part of the style."""
+    rules = style_rules(format_type)
+    if rules is None:
+        return []
+    title, header, _ = _block_title(document)
+    changes = []
+    seen = 0  # blocks with text so far
+    for block in document.blocks:
+        text = _block_text(block)
+        if not text.strip():
+            continue
+        seen += 1
+        if block.type == "list-item" or seen <= header:
+            continue
+        level = _block_level(block)
+        all_bold = _block_bold(block)
+        kind = None
+        plain = text.strip()
+        if _REFERENCES.match(plain) and (level or len(plain.split()) <= 3):
+            kind = "references"
+        elif seen - 1 == title:
+            kind = "title"
+        elif level or _is_caps_heading(plain) or (all_bold and _is_title_like(plain) and not plain.endswith(":")):
+            kind = "heading"
+        if kind is None:
+            continue
+
+        if kind == "references":
+            new_type, new_level = "heading", rules["references_level"]
+            segments = [{"text": rules["references"], "format": 0}]
+        elif kind == "title" and rules["title"] == "bold":
+            new_type, new_level = "paragraph", 0
+            segments = [{"text": title_case(plain), "format": 1}]
+        else:
+            new_type = "heading"
+            new_level = 1 if kind == "title" else _heading_level(rules, level)
+            cased = title_case(text)
+            strip_format = 0 if kind == "title" or block.type != "heading" else None
+            if len(cased) == len(text):
+                segments = _retitle_segments(block.segments, cased, strip_format)
+            else:
+                segments = [{"text": cased.strip(), "format": 0}]
+
+        new_tag = f"h{min(new_level, 3)}" if new_type == "heading" else None
+        old_segments = [{"text": segment.text, "format": segment.format} for segment in block.segments]
+        if new_type == block.type and new_tag == block.tag:
+            if segments != old_segments:
+                changes.append({
+                    "operation": "modify_segments", "blockId": block.id, "newSegments": segments,
+                    "source": "rules", "rule": kind,
+                })
+        else:
+            new_block = {"id": block.id, "type": new_type, "segments": segments}
+            if new_tag:
+                new_block["tag"] = new_tag
+            changes.append({
+                "operation": "replace_block", "blockId": block.id, "newBlock": new_block,
+                "source": "rules", "rule": kind,
+            })
+    return changes
+
+
+def merge_block_changes(rule_changes: List[dict], model_changes: List[dict]) -> List[dict]:
+    """
+    Combine rule ops with model ops made against the rule-formatted document.
+    A model op on a block the rules touched replaces the rule op (the model
+    saw the rule result); a model modify_segments on a block whose type the
+    rules changed becomes a replace_block keeping the rule's type.
+    """
+    by_block = {change["blockId"]: change for change in rule_changes}
+    merged_model = []
+    for change in model_changes:
+        block_id = change.get("blockId")
+        rule = by_block.pop(block_id, None) if block_id is not None else None
+        change = {**change, "source": "model"}
+        if rule is not None:
+            change["source"] = "rules+model"
+            if change.get("operation") == "modify_segments" and rule["operation"] == "replace_block":
+                change = {
+                    "operation": "replace_block", "blockId": block_id,
+                    "newBlock": {**rule["newBlock"], "segments": change.get("newSegments")},
+                    "source": "rules+model",
+                }
+        merged_model.append(change)
+    kept_rules = [change for change in rule_changes if change["blockId"] in by_block]
+    return kept_rules + merged_model
+
+
+def merge_text_changes(rule_changes: List[dict], model_changes: List[dict], content: str) -> List[dict]:
+    """
+    Combine rule changes with model replace_text changes made against the
+    rule-formatted text. A model old_text that only exists in a rule's new_text
+    is folded into that rule change.
+    """
+    merged = [dict(change) for change in rule_changes]
+    for change in model_changes:
+        old_text = change.get("old_text", "")
+        if old_text and old_text not in content:
+            target = next((rule for rule in merged if old_text in rule["new_text"]), None)
+            if target is not None:
+                target["new_text"] = target["new_text"].replace(old_text, change.get("new_text", ""), 1)
+                target["source"] = "rules+model"
+                continue
+        merged.append({**change, "source": "model"})
+    return merged
+
+
+# ============== When the model is still needed ==============
+
+_QUOTED_TITLE = re.compile(r"[\"“][A-Z][^\"”\n]{2,80}[\"”]")
+_BY_AUTHOR = re.compile(r"\b[A-Z][\w']+(?: [A-Z][\w']+)* by [A-Z][a-z]+")
+_WORK_WORDS = re.compile(r"\b(?:novel|book|poem|film|journal|memoir|anthology)\b", re.IGNORECASE)
+_FOREIGN = re.compile(
+    r"\b(?:et al|ad hoc|per se|vice versa|de facto|a priori|a posteriori|status quo|bona fide|"
+    r"raison d'être|zeitgeist|sic|in situ|mea culpa|fait accompli|joie de vivre|ibid)\b",
+    re.IGNORECASE,
+)
+_ENTRY_YEAR = re.compile(r"\(\d{4}\)|, \d{4}\.|\. \d{4}\.")
+
+
+def needs_model(content: str, format_type: str) -> bool:
+    """Whether the text has anything the style's model_instruction would act on."""
+    rules = style_rules(format_type)
+    if rules is None:
+        return True
+    hint = rules["model_hint"]
+    if hint is None:
+        return False
+    if _QUOTED_TITLE.search(content) or _BY_AUTHOR.search(content) or _WORK_WORDS.search(content):
+        return True
+    if _ENTRY_YEAR.search(content):  # looks like a citation entry
+        return True
+    return hint == "titles_or_foreign" and bool(_FOREIGN.search(content))
+
+
+def document_text(document: SimplifiedDocument) -> str:
+    return "\n".join(_block_text(block) for block in document.blocks)
@@ -0,0 +1,535 @@
+import asyncio
+import contextvars
+import json
+import os
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from config import env_int
+
+# ============== Asynchronous job queue ==============
+# Long edits can run as jobs: submitting returns a job id at once, a fixed pool
+# of workers runs the model calls, and clients poll or subscribe (SSE) for
+# status, partial results and the final response.
+#
+# - Fairness: every user has their own FIFO; workers take from users in
+#   round-robin order, so one user's batch can't starve everyone else.
+# - Backpressure: submits beyond JOB_MAX_QUEUED (or the per-user limit) fail
+#   fast with QueueFull, which the API turns into a 429.
+# - Durability: with JOBS_DB set, job records are written to that SQLite file.
+#   Finished results survive a restart, and jobs that were queued or running
+#   are queued again. Without it, jobs live in this worker's memory only.
+#
+# Several workers (uvicorn --workers) can share the JOBS_DB file on a host. A job
+# is run by the worker it was submitted to, which owns it in the store and
+# refreshes a heartbeat every JOB_HEARTBEAT seconds; any worker answers its
+# status from the store, and a cancel sent to another worker is passed on
+# through a flag the owner reads with its heartbeat. Jobs whose owner went
+# silent for JOB_LEASE seconds (a crashed worker), or that it released on
+# shutdown, are adopted by exactly one other worker and queued again there.
+
+JOB_WORKERS = env_int("JOB_WORKERS", 4)
+JOB_MAX_QUEUED = env_int("JOB_MAX_QUEUED", 200)
+JOB_MAX_QUEUED_PER_USER = env_int("JOB_MAX_QUEUED_PER_USER", 20)
+JOB_RETENTION_SECONDS = env_int("JOB_RETENTION", 24 * 3600)    # finished jobs are kept this long
+JOB_HEARTBEAT_SECONDS = env_int("JOB_HEARTBEAT", 10)
+JOB_LEASE_SECONDS = env_int("JOB_LEASE", 60)         # an owner silent this long loses its unfinished jobs
+JOB_POLL_SECONDS = 1.0                                # status refresh for jobs another worker holds
+JOBS_DB_PATH = os.getenv("JOBS_DB") or None
+
+FINISHED = ("succeeded", "failed", "cancelled")
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def report_progress(partial: dict):
+    """Publish a partial result for the job running in this task (no-op outside jobs)."""
+    job = _current_job.get()
+    if job is not None:
+        job.partial = partial
+        job.touch()
+
+
+class QueueFull(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, job_id: str, kind: str, user: str, payload: dict):
+        self.id = job_id
+        self.kind = kind
+        self.user = user
+        self.payload = payload
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.task = None
+        self.owner = None  # worker holding the job (shared store)
+        self._changed = asyncio.Event()
+        self.on_change = None  # set by the queue: persistence hook
+
+    def touch(self):
+        """Wake subscribers (and persist) after a state change."""
+        self._changed.set()
+        self._changed = asyncio.Event()
+        if self.on_change is not None:
+            self.on_change(self)
+
+    async def wait_changed(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def state(self, include_payload: bool = False) -> dict:
+        state = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "attempts": self.attempts,
+            "partial": self.partial,
+            "result": self.result,
+            "error": self.error,
+        }
+        if include_payload:
+            state["payload"] = self.payload
+        return state
+
+
+class JobStore:
+    """
+    Blocking SQLite persistence, shared by the workers on one host; JobQueue
+    calls it from a worker thread. Every unfinished job has an owner (the
+    process that holds it in its queue) and a heartbeat the owner refreshes;
+    writes of a job's state only land while the writer still owns it.
+    """
+
+    COLUMNS = "id, kind, user, status, payload, result, error, partial, attempts, created, started, finished, owner"
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user TEXT NOT NULL, status TEXT NOT NULL, "
+                "payload TEXT NOT NULL, result TEXT, error TEXT, partial TEXT, attempts INTEGER NOT NULL, "
+                "created REAL NOT NULL, started REAL, finished REAL, "
+                "owner TEXT, heartbeat REAL, cancel INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner", "TEXT"), ("heartbeat", "REAL"), ("cancel", "INTEGER NOT NULL DEFAULT 0")):
+                if column not in columns:  # a store written before jobs had owners
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def save(self, record: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, user, status, payload, result, error, partial, attempts, created, started, finished, owner, heartbeat) "
+                "VALUES (:id, :kind, :user, :status, :payload, :result, :error, :partial, :attempts, :created, :started, :finished, :owner, :heartbeat) "
+                "ON CONFLICT(id) DO UPDATE SET status = excluded.status, result = excluded.result, error = excluded.error, "
+                "partial = excluded.partial, attempts = excluded.attempts, started = excluded.started, finished = excluded.finished "
+                "WHERE jobs.owner IS excluded.owner",
+                record,
+            )
+
+    def get(self, job_id: str):
+        with self._connect() as conn:
+            return conn.execute(f"SELECT {self.COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def claim(self, job_id: str, owner: str, started: float) -> Optional[str]:
+        """
+        Mark the owner's queued job running: "running" if done, "cancelled" if
+        a cancel was requested meanwhile, None if the job is no longer the
+        owner's to run.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', started = ?, attempts = attempts + 1, heartbeat = ? "
+                "WHERE id = ? AND owner = ? AND status = 'queued' AND cancel = 0",
+                (started, started, job_id, owner),
+            )
+            if cursor.rowcount == 1:
+                return "running"
+            row = conn.execute("SELECT owner, status, cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return "cancelled" if row == (owner, "queued", 1) else None
+
+    def beat(self, owner: str, now: float) -> list:
+        """Refresh the owner's heartbeat; returns the ids of its jobs another worker asked to cancel."""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE owner = ? AND finished IS NULL", (now, owner))
+            return [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE owner = ? AND finished IS NULL AND cancel = 1", (owner,))]
+
+    def request_cancel(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND finished IS NULL", (job_id,)).rowcount == 1
+
+    def adopt(self, owner: str, now: float, lease: float, retention: float) -> list:
+        """
+        Take over unfinished jobs whose owner stopped beating (or released
+        them), queued again; returns their rows. Each job goes to exactly one
+        worker: the takeover is conditional on the heartbeat still being stale.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (now - retention,))
+            stale = "finished IS NULL AND (heartbeat IS NULL OR heartbeat < ?)"
+            conn.execute(
+                f"UPDATE jobs SET status = 'cancelled', error = 'Cancelled', finished = ?, owner = ? WHERE {stale} AND cancel = 1",
+                (now, owner, now - lease),
+            )
+            adopted = []
+            for (job_id,) in conn.execute(f"SELECT id FROM jobs WHERE {stale} ORDER BY created", (now - lease,)).fetchall():
+                cursor = conn.execute(
+                    f"UPDATE jobs SET status = 'queued', started = NULL, partial = NULL, owner = ?, heartbeat = ? WHERE id = ? AND {stale}",
+                    (owner, now, job_id, now - lease),
+                )
+                if cursor.rowcount == 1:
+                    adopted.append(conn.execute(f"SELECT {self.COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone())
+            return adopted
+
+    def release(self, owner: str):
+        """Hand the owner's unfinished jobs back (shutdown): queued, up for adoption at once."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', started = NULL, partial = NULL, heartbeat = NULL WHERE owner = ? AND finished IS NULL",
+                (owner,),
+            )
+
+
+def _dumps(value) -> Optional[str]:
+    return None if value is None else json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _loads(value: Optional[str]):
+    return None if value is None else json.loads(value)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        max_queued: int = JOB_MAX_QUEUED,
+        max_queued_per_user: int = JOB_MAX_QUEUED_PER_USER,
+        retention: float = JOB_RETENTION_SECONDS,
+        db_path: Optional[str] = JOBS_DB_PATH,
+        heartbeat: float = JOB_HEARTBEAT_SECONDS,
+        lease: float = JOB_LEASE_SECONDS,
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.retention = retention
+        self.db_path = db_path
+        self.heartbeat = heartbeat
+        self.lease = lease
+        self.owner = secrets.token_hex(8)  # this worker's id in the store
+        self.store = None
+        self.handlers: Dict[str, Callable] = {}
+        self.jobs: Dict[str, Job] = {}
+        self._queues = OrderedDict()  # user -> deque of jobs; order = round-robin rotation
+        self._ready = None
+        self._tasks = []
+        self._dirty = OrderedDict()  # job id -> record waiting to be written
+        self._flusher = None
+        self._store_lock = asyncio.Lock()  # one store write at a time, so a claim can't be overwritten by an older state
+        self._stopping = False
+        self.counters = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "recovered": 0}
+
+    def register(self, kind: str, handler: Callable):
+        """`handler(payload) -> awaitable dict` runs one job of this kind."""
+        self.handlers[kind] = handler
+
+    # ----- lifecycle -----
+
+    async def start(self):
+        self._stopping = False
+        self._ready = asyncio.Semaphore(0)
+        if self.db_path:
+            try:
+                self.store = await asyncio.to_thread(JobStore, self.db_path)
+                await self._adopt()
+            except sqlite3.Error as e:
+                print(f"Job store unavailable, jobs are memory-only: {e}")
+                self.store = None
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.store is not None:
+            self._tasks.append(asyncio.create_task(self._beat()))
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.release, self.owner)
+            except sqlite3.Error as e:
+                print(f"Job store release failed: {e}")
+
+    def _job(self, row) -> Job:
+        job = Job(row[0], row[1], row[2], json.loads(row[4]))
+        job.status, job.result, job.error, job.partial = row[3], _loads(row[5]), row[6], _loads(row[7])
+        job.attempts, job.created, job.started, job.finished, job.owner = row[8], row[9], row[10], row[11], row[12]
+        return job
+
+    async def _adopt(self):
+        """Queue here the jobs left by workers that stopped (or by the last run)."""
+        rows = await asyncio.to_thread(self.store.adopt, self.owner, time.time(), self.lease, self.retention)
+        for row in rows:
+            job = self._job(row)
+            job.on_change = self._persist
+            self.jobs[job.id] = job
+            self._enqueue(job)
+            self.counters["recovered"] += 1
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                for job_id in await asyncio.to_thread(self.store.beat, self.owner, time.time()):
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        self._cancel_local(job)  # cancel sent to another worker
+                await self._adopt()
+            except sqlite3.Error as e:
+                print(f"Job store heartbeat failed: {e}")
+
+    def _persist(self, job: Job):
+        if self.store is None:
+            return
+        record = {
+            "id": job.id, "kind": job.kind, "user": job.user, "status": job.status,
+            "payload": _dumps(job.payload), "result": _dumps(job.result), "error": job.error,
+            "partial": _dumps(job.partial), "attempts": job.attempts,
+            "created": job.created, "started": job.started, "finished": job.finished,
+            "owner": job.owner, "heartbeat": time.time(),
+        }
+        # Latest state per job, written by one flusher so writes never reorder
+        self._dirty[job.id] = record
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        while self._dirty:
+            await self._save(next(iter(self._dirty)))
+
+    async def _save(self, job_id: str):
+        """Write the job's pending state now, if it has one."""
+        async with self._store_lock:
+            record = self._dirty.pop(job_id, None)
+            if record is None:
+                return
+            try:
+                await asyncio.to_thread(self.store.save, record)
+            except sqlite3.Error as e:
+                print(f"Job store write failed: {e}")
+
+    async def _claim(self, job: Job) -> Optional[str]:
+        await self._save(job.id)
+        async with self._store_lock:
+            try:
+                return await asyncio.to_thread(self.store.claim, job.id, self.owner, time.time())
+            except sqlite3.Error as e:
+                print(f"Job store claim failed, running anyway: {e}")
+                return "running"
+
+    # ----- submit / cancel -----
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def submit(self, kind: str, user: str, payload: dict) -> Job:
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        if self.queued >= self.max_queued:
+            self.counters["rejected"] += 1
+            raise QueueFull("Job queue is full", retry_after=self._retry_after(self.queued))
+        user_queued = len(self._queues.get(user, ()))
+        if user_queued >= self.max_queued_per_user:
+            self.counters["rejected"] += 1
+            raise QueueFull("Too many queued jobs for this user", retry_after=self._retry_after(user_queued))
+
+        job = Job(secrets.token_urlsafe(12), kind, user, payload)
+        job.owner = self.owner
+        job.on_change = self._persist
+        self.jobs[job.id] = job
+        self._enqueue(job)
+        self.counters["submitted"] += 1
+        self._prune()
+        job.touch()
+        if self.store is not None:
+            await self._save(job.id)  # stored before the id is handed out, so every worker knows it
+        return job
+
+    def _retry_after(self, depth: int) -> int:
+        return max(1, depth // max(1, self.workers))
+
+    def _enqueue(self, job: Job):
+        self._queues.setdefault(job.user, deque()).append(job)
+        self._ready.release()
+
+    def position(self, job: Job) -> Optional[int]:
+        """Jobs from the same user ahead of this one (None once it left the queue)."""
+        queue = self._queues.get(job.user)
+        if job.status != "queued" or queue is None:
+            return None
+        for index, queued in enumerate(queue):
+            if queued is job:
+                return index
+        return None
+
+    async def lookup(self, job_id: str) -> Optional[Job]:
+        """This worker's job, else its last stored state (held by another worker), else None."""
+        job = self.jobs.get(job_id)
+        if job is not None or self.store is None:
+            return job
+        try:
+            row = await asyncio.to_thread(self.store.get, job_id)
+        except sqlite3.Error as e:
+            print(f"Job store read failed: {e}")
+            return None
+        return None if row is None else self._job(row)
+
+    def live(self, job: Job) -> bool:
+        """True if this worker runs the job, so wait_changed() sees its updates."""
+        return self.jobs.get(job.id) is job
+
+    async def cancel(self, job: Job) -> bool:
+        if job.status in FINISHED:
+            return False
+        if not self.live(job):
+            try:
+                return await asyncio.to_thread(self.store.request_cancel, job.id)
+            except sqlite3.Error as e:
+                print(f"Job store write failed: {e}")
+                return False
+        return self._cancel_local(job)
+
+    def _cancel_local(self, job: Job) -> bool:
+        if job.status in FINISHED:
+            return False
+        if job.status == "queued":
+            queue = self._queues.get(job.user)
+            if queue is not None and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self._queues[job.user]
+            self._finish(job, "cancelled", error="Cancelled")
+        elif job.task is not None:
+            job.task.cancel()  # the worker records the cancellation
+        return True
+
+    # ----- workers -----
+
+    def _next(self) -> Optional[Job]:
+        while self._queues:
+            user, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            # Round-robin: this user goes to the back of the rotation
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            job = self._next()
+            if job is None:
+                continue  # cancelled while queued
+            await self._run(job)
+
+    async def _run(self, job: Job):
+        if self.store is not None:
+            claimed = await self._claim(job)
+            if claimed == "cancelled":
+                self._finish(job, "cancelled", error="Cancelled")
+                return
+            if claimed is None:
+                self.jobs.pop(job.id, None)  # adopted by another worker while this one was silent
+                return
+            if job.status in FINISHED:
+                return  # cancelled here while claiming; that state is saved next
+        job.status = "running"
+        job.started = time.time()
+        job.attempts += 1
+        job.touch()
+        token = _current_job.set(job)
+        job.task = asyncio.ensure_future(self._call(job))
+        try:
+            result = await job.task
+        except asyncio.CancelledError:
+            if self._stopping:
+                # Shutdown (awaiting the job task cancelled it as well): leave the
+                # job "running" in the store so it is re-queued on restart
+                raise
+            self._finish(job, "cancelled", error="Cancelled")
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            self._finish(job, "failed", error=detail if isinstance(detail, str) else json.dumps(detail))
+        else:
+            self._finish(job, "succeeded", result=result)
+        finally:
+            _current_job.reset(token)
+            job.task = None
+
+    async def _call(self, job: Job):
+        return await self.handlers[job.kind](job.payload)
+
+    def _finish(self, job: Job, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        self.counters[status] += 1
+        job.touch()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [jid for jid, job in self.jobs.items() if job.finished and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def stats(self) -> dict:
+        running = sum(1 for job in self.jobs.values() if job.status == "running")
+        return {
+            **self.counters,
+            "queued": self.queued,
+            "running": running,
+            "users_waiting": len(self._queues),
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "max_queued_per_user": self.max_queued_per_user,
+            "durable": self.store is not None,
+        }
+
+
+job_queue = JobQueue()
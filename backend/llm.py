@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+import openai
+
+from config import env_float, env_int
+from fake_upstream import FakeUpstream, parse_spec
+from metrics import record_completion, record_model_call, stage
+from resilience import call_resilient
+
+# ============== Upstream client settings ==============
+# All values can be overridden from the environment (.env is loaded by app.py).
+
+class LLMSettings:
+    def __init__(self):
+        self.api_key = os.getenv("OPENAI_API_KEY")
+        self.base_url = os.getenv("OPENAI_BASE_URL") or None
+        # HTTP connection pool shared by every request in this worker
+        self.max_connections = env_int("OPENAI_MAX_CONNECTIONS", 100)
+        self.max_keepalive_connections = env_int("OPENAI_MAX_KEEPALIVE", 20)
+        self.keepalive_expiry = env_float("OPENAI_KEEPALIVE_EXPIRY", 30.0)
+        # Max model calls in flight at once; extra calls wait for a slot
+        self.max_concurrency = env_int("OPENAI_MAX_CONCURRENCY", 64)
+        # Per-call timeouts (seconds)
+        self.connect_timeout = env_float("OPENAI_CONNECT_TIMEOUT", 10.0)
+        self.request_timeout = env_float("OPENAI_REQUEST_TIMEOUT", 120.0)    # whole call, retries included
+        # The client's own retries; resilience.py retries (with backoff and a breaker) instead
+        self.max_retries = env_int("OPENAI_MAX_RETRIES", 0)
+        # In-process fake upstream for offline testing (see fake_upstream.py)
+        self.fake_upstream = os.getenv("OPENAI_FAKE_UPSTREAM")
+
+
+_settings: Optional[LLMSettings] = None
+_client: Optional[openai.AsyncOpenAI] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def create_client(settings: LLMSettings) -> openai.AsyncOpenAI:
+    if settings.fake_upstream:
+        print(f"Using the fake upstream: {settings.fake_upstream}")
+        return FakeUpstream(**parse_spec(settings.fake_upstream))
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(settings.request_timeout, connect=settings.connect_timeout),
+    )
+    return openai.AsyncOpenAI(
+        api_key=settings.api_key,
+        base_url=settings.base_url,
+        max_retries=settings.max_retries,
+        timeout=httpx.Timeout(settings.request_timeout, connect=settings.connect_timeout),
+        http_client=http_client,
+    )
+
+
+async def startup(settings: Optional[LLMSettings] = None):
+    """Build the process-wide client. Called once from the app lifespan."""
+    global _settings, _client, _semaphore
+    _settings = settings or LLMSettings()
+    _client = create_client(_settings)
+    _semaphore = asyncio.Semaphore(_settings.max_concurrency)
+
+
+async def shutdown():
+    global _client, _semaphore
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _semaphore = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
+def get_settings() -> LLMSettings:
+    if _settings is None:
+        raise RuntimeError("LLM client is not initialized; is the app lifespan running?")
+    return _settings
+
+
+def get_client() -> openai.AsyncOpenAI:
+    if _client is None:
+        raise RuntimeError("LLM client is not initialized; is the app lifespan running?")
+    return _client
+
+
+async def chat_completion(timeout: Optional[float] = None, **kwargs):
+    """
+    Run one chat completion on the shared client.
+    Waits for a concurrency slot first, so a burst of requests queues here
+    instead of opening unbounded upstream connections. Deadlines, retries,
+    hedging and the circuit breaker are in resilience.py; `timeout` bounds the
+    whole call.
+    """
+    client = get_client()
+    if timeout is None:
+        timeout = _settings.request_timeout
+    model = kwargs.get("model", "")
+    with stage("model_call", model=model) as span:
+        queued = time.perf_counter()
+        async with _semaphore:
+            span["queue_ms"] = round((time.perf_counter() - queued) * 1000, 2)
+            response = await call_resilient(
+                lambda deadline: client.chat.completions.create(timeout=deadline, **kwargs),
+                model,
+                timeout,
+                span=span,
+            )
+        record_completion(model, response, span)
+        return response
+
+
+async def stream_chat_completion(timeout: Optional[float] = None, **kwargs):
+    """
+    Stream one chat completion, yielding chunks as they arrive.
+    The concurrency slot is held until the stream ends; if the consumer stops
+    early (e.g. the browser disconnected) the upstream response is closed.
+    """
+    client = get_client()
+    if timeout is None:
+        timeout = _settings.request_timeout
+    model = kwargs.get("model", "")
+    with stage("model_stream", model=model) as span:
+        started = time.perf_counter()
+        async with _semaphore:
+            span["queue_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            # Retried until the stream opens, never hedged; nothing is retried once chunks flow
+            stream = await call_resilient(
+                lambda deadline: client.chat.completions.create(stream=True, timeout=deadline, **kwargs),
+                model,
+                timeout,
+                hedge=False,
+                span=span,
+            )
+            chunks = 0
+            finish_reason = None
+            try:
+                async for chunk in stream:
+                    if not chunks:
+                        span["first_chunk_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                    chunks += 1
+                    if chunk.choices and chunk.choices[0].finish_reason:
+                        finish_reason = chunk.choices[0].finish_reason
+                    yield chunk
+            finally:
+                span.update(chunks=chunks, finish_reason=finish_reason or "none")
+                record_model_call(model, finish_reason)
+                # Shielded: a cancelled consumer is cancelled again at every await
+                await asyncio.shield(stream.response.aclose())
@@ -0,0 +1,347 @@
+import hashlib
+import re
+from typing import Iterable, Iterator, List, Union
+
+from doc_encoding import normalize_segments
+from models import TextSegment, SimplifiedBlock, SimplifiedDocument
+
+# ============== Markdown <-> SimplifiedDocument ==============
+# One converter between the markdown the V1 endpoints work on and the
+# SimplifiedDocument blocks of V2, so markdown input can go through the block
+# pipeline (compact encoding, edit_document ops). Covers the subset the
+# prompts and the editor use:
+#   - "#", "##", "###" headings (deeper levels become h3)
+#   - "-", "*", "+" and "1." / "1)" list items, nested by 4 columns (a tab
+#     counts as 4), as the editor's markdown export writes them
+#   - paragraphs; single line breaks stay "\n" inside the block
+#   - **bold** (format 1), *italic* (2), ***both*** (3), backslash escapes
+#   - fenced code blocks are kept verbatim as one unformatted paragraph
+# Both directions are a single pass: blocks are read line by line, and inline
+# emphasis is matched with one delimiter stack, so the cost is linear in the
+# size of the input. iter_markdown_blocks() and iter_markdown() are
+# generators and can convert inputs too large to hold as one document.
+#
+# Block ids come from the block's type and content ("m" + 8 hex digits, with
+# "-2", "-3", ... for repeated content), so the same markdown always gives
+# the same ids and editing one block doesn't renumber the others.
+#
+# Not representable in markdown, and dropped on the way out: format bits
+# other than bold/italic, indent on non-list blocks, empty paragraphs.
+# Segments whose bold and italic ranges overlap without nesting (bold "a",
+# bold italic "b", italic "c") have no unambiguous markdown either.
+
+INDENT_COLUMNS = 4
+
+_FENCE_RE = re.compile(r"^[ \t]*(`{3,}|~{3,})")
+_HEADING_RE = re.compile(r"^[ \t]*(#{1,6})(?:[ \t]+(.*))?$")
+_LIST_RE = re.compile(r"^([ \t]*)([-*+]|\d{1,9}[.)])(?:[ \t]+(.*))?$")
+_INLINE_RE = re.compile(r"\\([!-/:-@\[-`{-~])|\*+")
+# Line starts that would read as block syntax, escaped on output
+_LINE_START_RE = re.compile(r"^([ \t]*)(?:(\d{1,9})(?=[.)](?:[ \t]|$))|(?=#{1,6}(?:[ \t]|$)|[-+](?:[ \t]|$)|`{3}|~{3}))", re.MULTILINE)
+
+_BITS = {1: 2, 2: 1, 3: 3}       # delimiter length -> format bits
+_MARKERS = {1: "**", 2: "*"}     # format bit -> delimiter
+_EMPHASIS = 3                    # format bits markdown can express
+
+
+# ============== Inline: emphasis ==============
+
+class _Delimiter:
+    """A run of 1-3 "*"; opens/closes collect the format bits it was matched for."""
+
+    __slots__ = ("remaining", "can_open", "can_close", "opens", "closes")
+
+    def __init__(self, length: int, can_open: bool, can_close: bool):
+        self.remaining = length
+        self.can_open = can_open
+        self.can_close = can_close
+        self.opens = 0
+        self.closes = 0
+
+
+def parse_inline(text: str) -> List[TextSegment]:
+    """
+    Segments of one block's markdown text. A "*" run opens when followed by a
+    non-space and closes when preceded by one; a closer matches the opener on
+    top of the stack when the lengths agree or one of them is "***" (which
+    splits). Unmatched runs stay literal.
+    """
+    if "*" not in text and "\\" not in text:
+        return [TextSegment.model_construct(text=text, format=0)]
+
+    # Pass 1: literal text and delimiter runs
+    tokens = []
+    delimiters = []
+    literal = []
+    position = 0
+    for match in _INLINE_RE.finditer(text):
+        start, end = match.span()
+        literal.append(text[position:start])
+        position = end
+        if match.group(1) is not None:
+            literal.append(match.group(1))
+            continue
+        before = text[start - 1] if start else " "
+        after = text[end] if end < len(text) else " "
+        can_open, can_close = not after.isspace(), not before.isspace()
+        if end - start > 3 or not (can_open or can_close):
+            literal.append(match.group(0))
+            continue
+        tokens.append("".join(literal))
+        literal = []
+        delimiter = _Delimiter(end - start, can_open, can_close)
+        tokens.append(delimiter)
+        delimiters.append(delimiter)
+    literal.append(text[position:])
+    tokens.append("".join(literal))
+
+    # Pass 2: match closers to openers
+    stack = []
+    for delimiter in delimiters:
+        if delimiter.can_close:
+            while delimiter.remaining and stack:
+                opener = stack[-1]
+                if opener.remaining != delimiter.remaining and 3 not in (opener.remaining, delimiter.remaining):
+                    break
+                used = min(opener.remaining, delimiter.remaining)
+                opener.opens |= _BITS[used]
+                delimiter.closes |= _BITS[used]
+                opener.remaining -= used
+                delimiter.remaining -= used
+                if not opener.remaining:
+                    stack.pop()
+        if delimiter.remaining and delimiter.can_open:
+            stack.append(delimiter)
+
+    # Pass 3: text with the formats open at each point; what wasn't matched is literal
+    segments = []
+    depth = {1: 0, 2: 0}
+
+    def add(piece: str):
+        if not piece:
+            return
+        fmt = (1 if depth[1] else 0) | (2 if depth[2] else 0)
+        if segments and segments[-1][1] == fmt:
+            segments[-1][0].append(piece)
+        else:
+            segments.append([[piece], fmt])
+
+    for token in tokens:
+        if isinstance(token, str):
+            add(token)
+            continue
+        for bit in (1, 2):
+            if token.closes & bit:
+                depth[bit] -= 1
+        add("*" * token.remaining)
+        for bit in (1, 2):
+            if token.opens & bit:
+                depth[bit] += 1
+    if not segments:
+        return [TextSegment.model_construct(text="", format=0)]
+    return [TextSegment.model_construct(text="".join(pieces), format=fmt) for pieces, fmt in segments]
+
+
+def _escape_inline(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("*", "\\*")
+
+
+def _escape_line_starts(text: str) -> str:
+    return _LINE_START_RE.sub(lambda match: match.group(1) + (match.group(2) or "") + "\\", text)
+
+
+def inline_markdown(segments: List[TextSegment]) -> str:
+    """
+    Markdown for a block's segments. Whitespace at the edges of a formatted
+    segment is written outside its markers (a marker next to a space would
+    not parse back), and at each segment boundary only the formats that change
+    are closed or opened, the longer-running one outermost.
+    """
+    runs = [(segment.text, segment.format & _EMPHASIS) for segment in normalize_segments(segments) if segment.text]
+    pieces = []
+    for index, (text, bits) in enumerate(runs):
+        if not bits:
+            pieces.append((text, 0))
+            continue
+        before = runs[index - 1][1] if index else 0
+        after = runs[index + 1][1] if index + 1 < len(runs) else 0
+        core = text.strip()
+        if not core:
+            pieces.append((text, bits & before & after))
+            continue
+        lead = text[:len(text) - len(text.lstrip())]
+        trail = text[len(text.rstrip()):]
+        if lead:
+            pieces.append((lead, bits & before))
+        pieces.append((core, bits))
+        if trail:
+            pieces.append((trail, bits & after))
+
+    # Index of the last piece of the run of each format bit, for nesting order
+    run_end = [None] * len(pieces)
+    next_bits = 0
+    for index in range(len(pieces) - 1, -1, -1):
+        bits = pieces[index][1]
+        run_end[index] = {
+            bit: run_end[index + 1][bit] if bits & next_bits & bit else index
+            for bit in (1, 2)
+        }
+        next_bits = bits
+
+    out = []
+    stack = []
+    for index, (text, bits) in enumerate(pieces):
+        closing = sum(stack) & ~bits
+        while closing:
+            bit = stack.pop()
+            out.append(_MARKERS[bit])
+            closing &= ~bit
+        opening = [bit for bit in (1, 2) if bits & bit and bit not in stack]
+        opening.sort(key=lambda bit: -run_end[index][bit])
+        for bit in opening:
+            out.append(_MARKERS[bit])
+            stack.append(bit)
+        out.append(_escape_inline(text))
+    while stack:
+        out.append(_MARKERS[stack.pop()])
+    return _escape_line_starts("".join(out))
+
+
+# ============== Blocks ==============
+
+class BlockIds:
+    """Ids derived from each block's type and content, unique within one document."""
+
+    def __init__(self):
+        self._seen = {}
+
+    def assign(self, kind: str, segments: List[TextSegment]) -> str:
+        digest = hashlib.blake2b(kind.encode(), digest_size=4)
+        for segment in segments:
+            digest.update(f"\x00{segment.format}\x00{segment.text}".encode())
+        block_id = "m" + digest.hexdigest()
+        count = self._seen.get(block_id, 0) + 1
+        self._seen[block_id] = count
+        return block_id if count == 1 else f"{block_id}-{count}"
+
+
+def _make_block(ids: BlockIds, block_type: str, tag, list_type, indent, text: str, verbatim: bool = False) -> SimplifiedBlock:
+    segments = [TextSegment.model_construct(text=text, format=0)] if verbatim else parse_inline(text)
+    kind = f"{tag or block_type}:{list_type or ''}:{indent if indent is not None else ''}"
+    return SimplifiedBlock.model_construct(
+        id=ids.assign(kind, segments), type=block_type, tag=tag, listType=list_type, indent=indent, segments=segments
+    )
+
+
+def _closes_fence(line: str, marker: str, length: int) -> bool:
+    stripped = line.strip()
+    return len(stripped) >= length and not stripped.strip(marker)
+
+
+def iter_markdown_blocks(lines: Union[str, Iterable[str]]) -> Iterator[SimplifiedBlock]:
+    """
+    SimplifiedBlocks of markdown, read one line at a time (a file object or
+    any iterable of lines; a str is split first). Blocks are yielded as soon
+    as the line after them is read.
+    """
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    ids = BlockIds()
+    pending = None  # (type, tag, listType, indent, text lines) of the block being read
+    fence = None    # (marker, length, lines) inside a fenced code block
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if fence is not None:
+            fence[2].append(line)
+            if _closes_fence(line, fence[0], fence[1]):
+                yield _make_block(ids, "paragraph", None, None, None, "\n".join(fence[2]), verbatim=True)
+                fence = None
+            continue
+        if not line.strip():
+            if pending is not None:
+                yield _make_block(ids, *pending[:4], "\n".join(pending[4]))
+                pending = None
+            continue
+
+        match = _FENCE_RE.match(line) or _HEADING_RE.match(line) or _LIST_RE.match(line)
+        if match is None:
+            if pending is None:
+                pending = ("paragraph", None, None, None, [])
+            pending[4].append(line.strip())  # a paragraph line, or a list item's continuation
+            continue
+        if pending is not None:
+            yield _make_block(ids, *pending[:4], "\n".join(pending[4]))
+            pending = None
+        if match.re is _FENCE_RE:
+            fence = (match.group(1)[0], len(match.group(1)), [line])
+        elif match.re is _HEADING_RE:
+            tag = f"h{min(len(match.group(1)), 3)}"
+            yield _make_block(ids, "heading", tag, None, None, (match.group(2) or "").strip())
+        else:
+            indent = len(match.group(1).expandtabs(INDENT_COLUMNS)) // INDENT_COLUMNS
+            list_type = "number" if match.group(2)[0].isdigit() else "bullet"
+            pending = ("list-item", None, list_type, indent, [(match.group(3) or "").strip()])
+
+    if pending is not None:
+        yield _make_block(ids, *pending[:4], "\n".join(pending[4]))
+    if fence is not None:
+        # Unclosed: the code runs to the end of the input, and is closed there
+        fence[2].append(fence[0] * fence[1])
+        yield _make_block(ids, "paragraph", None, None, None, "\n".join(fence[2]), verbatim=True)
+
+
+def _fenced_text(block: SimplifiedBlock):
+    """The text of a paragraph holding a closed fenced code block, else None."""
+    if block.type != "paragraph" or any(segment.format for segment in block.segments):
+        return None
+    text = "".join(segment.text for segment in block.segments)
+    match = _FENCE_RE.match(text)
+    if match is None or "\n" not in text:
+        return None
+    last = text.rsplit("\n", 1)[1]
+    return text if _closes_fence(last, match.group(1)[0], len(match.group(1))) else None
+
+
+def iter_markdown(blocks: Iterable[SimplifiedBlock]) -> Iterator[str]:
+    """Markdown for `blocks`, one chunk per block, each with the separator before it."""
+    numbers = {}  # indent -> last number of the ordered list open at that level
+    previous = None
+    for block in blocks:
+        text = _fenced_text(block)
+        if text is None:
+            text = inline_markdown(block.segments)
+        if block.type == "list-item":
+            indent = block.indent or 0
+            for level in [level for level in numbers if level > indent]:
+                del numbers[level]
+            if block.listType == "number":
+                numbers[indent] = numbers.get(indent, 0) + 1
+                marker = f"{numbers[indent]}."
+            else:
+                numbers.pop(indent, None)
+                marker = "-"
+            prefix = " " * (INDENT_COLUMNS * indent) + marker
+        elif block.type == "heading":
+            numbers.clear()
+            prefix = "#" * int(block.tag[1]) if block.tag else "#"
+            text = text.replace("\n", " ")
+        else:
+            numbers.clear()
+            prefix = ""
+        chunk = f"{prefix} {text}" if prefix and text else prefix or text
+        if previous is None:
+            yield chunk
+        else:
+            yield ("\n" if previous == block.type == "list-item" else "\n\n") + chunk
+        previous = block.type
+
+
+def markdown_to_document(markdown: str) -> SimplifiedDocument:
+    return SimplifiedDocument.model_construct(blocks=list(iter_markdown_blocks(markdown)))
+
+
+def document_to_markdown(document: Union[SimplifiedDocument, dict]) -> str:
+    if isinstance(document, dict):
+        document = SimplifiedDocument.model_validate(document)
+    return "".join(iter_markdown(document.blocks))
@@ -0,0 +1,406 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import re
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import httpx
+
+from config import env_float
+from edit_summary import cached_prompt_tokens
+
+# ============== Metrics and request tracing ==============
+# /metrics serves counters and histograms in the Prometheus text format:
+# requests and latency per endpoint, latency per stage of a request (parse,
+# prompt building, routed calls, model calls, tool parsing, summary call,
+# validation), token counters per model, route escalations, repair
+# follow-ups, document sizes, and - through collectors registered by app.py -
+# the cache, dedup, upstream, job and session counters.
+#
+# Every request gets an X-Request-ID (the client's, if it sent a sane one).
+# Stages are timed with `with stage("name"):`; each one feeds the stage
+# histogram and, for sampled requests, becomes a span of the request's trace.
+# annotate() adds request-wide attributes (edit mode, token totals, stream
+# outcome) to the trace record.
+# TRACE_EXPORT writes traces as JSON lines to a file ("file:/path") or POSTs
+# them in batches to a collector URL ("http://...").
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATE = env_float("TRACE_SAMPLE_RATE", 1.0)
+TRACE_FLUSH_SECONDS = env_float("TRACE_FLUSH_SECONDS", 2.0)
+TRACE_MAX_BUFFER = 1000  # traces waiting for export; the oldest are dropped beyond this
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+AUTOCOMPLETE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0)
+SIZE_BUCKETS = (1000, 4000, 16000, 64000, 256000, 1000000, 4000000)  # characters
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labels, key)))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+                break
+        entry[-2] += value
+        entry[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, entry in sorted(self._values.items()):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(float(bound))})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(round(entry[-2], 6))}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {entry[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], list]):
+        """Register `fn() -> [(name, type, help, [(labels, value), ...]), ...]`, called at scrape time."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("vrite_http_requests_total", "HTTP requests by endpoint, method and status.", ("endpoint", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("vrite_http_request_duration_seconds", "Request latency by endpoint (streams: until the last byte).", ("endpoint",))
+STAGE_SECONDS = REGISTRY.histogram("vrite_stage_duration_seconds", "Latency of the stages of a request.", ("endpoint", "stage"))
+ERRORS = REGISTRY.counter("vrite_errors_total", "Errors raised by endpoints, by class.", ("endpoint", "error"))
+MODEL_CALLS = REGISTRY.counter("vrite_model_calls_total", "Model completions by model and finish reason.", ("endpoint", "model", "finish_reason"))
+TOKENS = REGISTRY.counter("vrite_tokens_total", "Tokens reported by the upstream (type: input, output, cached).", ("endpoint", "model", "type"))
+DOCUMENT_CHARS = REGISTRY.histogram("vrite_document_chars", "Size of the documents sent to the model, in characters.", ("endpoint",), SIZE_BUCKETS)
+STREAM_FIRST_TOKEN_SECONDS = REGISTRY.histogram("vrite_stream_first_token_seconds", "Time to first token of streamed responses.", ("endpoint",))
+STREAM_SECONDS = REGISTRY.histogram("vrite_stream_duration_seconds", "Duration of streamed responses by outcome (completed, disconnected, error).", ("endpoint", "outcome"))
+AUTOCOMPLETE_SECONDS = REGISTRY.histogram("vrite_autocomplete_duration_seconds", "Autocomplete latency by source (cache, model, superseded).", ("source",), AUTOCOMPLETE_BUCKETS)
+ROUTE_ESCALATIONS = REGISTRY.counter("vrite_route_escalations_total", "Routed calls moved to a larger model or budget, by route and cause.", ("endpoint", "route", "cause"))
+REPAIR_FOLLOW_UPS = REGISTRY.counter("vrite_repair_follow_ups_total", "Edit repair follow-up calls by result (ok, failed, unparsable).", ("endpoint", "result"))
+TRACE_EXPORTS = REGISTRY.counter("vrite_trace_exports_total", "Trace export results (exported, dropped, failed).", ("result",))
+
+
+@REGISTRY.collector
+def process_metrics() -> list:
+    return [("process_cpu_seconds_total", "counter", "User and system CPU time of the backend process.", [({}, round(time.process_time(), 6))])]
+
+
+# ============== Tracing ==============
+
+class Trace:
+    def __init__(self, request_id: str, scope: dict):
+        self.request_id = request_id
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans = []
+        self.attributes = {}
+        self.parsed = False
+        self.sampled = exporter is not None and random.random() < TRACE_SAMPLE_RATE
+
+    @property
+    def endpoint(self) -> str:
+        # The route template, so /api/jobs/{job_id} is one label value; the
+        # router fills in scope["route"] before the handler runs
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+    def add_span(self, name: str, span_id: str, parent_id: Optional[str], started: float, ended: float, attributes: dict):
+        if self.sampled:
+            self.spans.append({
+                "name": name,
+                "span_id": span_id,
+                "parent_id": parent_id,
+                "start_ms": round((started - self.started) * 1000, 2),
+                "duration_ms": round((ended - started) * 1000, 2),
+                **({"attributes": attributes} if attributes else {}),
+            })
+
+    def record(self, status: int) -> dict:
+        return {
+            "request_id": self.request_id,
+            "method": self.scope.get("method"),
+            "endpoint": self.endpoint,
+            "status": status,
+            "start": self.wall_started,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            **({"attributes": self.attributes} if self.attributes else {}),
+            "spans": self.spans,
+        }
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+_span_id = contextvars.ContextVar("span_id", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.request_id if trace is not None else None
+
+
+def current_endpoint() -> str:
+    trace = _trace.get()
+    return trace.endpoint if trace is not None else "background"
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Time one stage of the current request. Yields a dict of span attributes the
+    caller may add to. The first stage of a request also records
+    "parse_request": everything before the handler ran (body read, validation).
+    """
+    trace = _trace.get()
+    started = time.perf_counter()
+    endpoint = trace.endpoint if trace is not None else "background"
+    if trace is not None and not trace.parsed:
+        trace.parsed = True
+        STAGE_SECONDS.observe(started - trace.started, endpoint=endpoint, stage="parse_request")
+        trace.add_span("parse_request", secrets.token_hex(4), None, trace.started, started, {})
+    span_id = secrets.token_hex(4)
+    parent_id = _span_id.get()
+    token = _span_id.set(span_id)
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _span_id.reset(token)
+        ended = time.perf_counter()
+        STAGE_SECONDS.observe(ended - started, endpoint=endpoint, stage=name)
+        if trace is not None:
+            trace.add_span(name, span_id, parent_id, started, ended, attributes)
+
+
+def annotate(**attributes):
+    """Add attributes to the current request's trace record (not to a stage)."""
+    trace = _trace.get()
+    if trace is not None and trace.sampled:
+        trace.attributes.update(attributes)
+
+
+def record_model_call(model: str, finish_reason: Optional[str]):
+    MODEL_CALLS.inc(endpoint=current_endpoint(), model=model, finish_reason=finish_reason or "none")
+
+
+def record_completion(model: str, response, span: Optional[dict] = None):
+    """Count one chat completion: finish reason and token usage."""
+    endpoint = current_endpoint()
+    finish_reason = response.choices[0].finish_reason if response.choices else None
+    record_model_call(model, finish_reason)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        cached = cached_prompt_tokens(usage)
+        TOKENS.inc(usage.prompt_tokens or 0, endpoint=endpoint, model=model, type="input")
+        TOKENS.inc(usage.completion_tokens or 0, endpoint=endpoint, model=model, type="output")
+        TOKENS.inc(cached, endpoint=endpoint, model=model, type="cached")
+        if span is not None:
+            span.update(input_tokens=usage.prompt_tokens, output_tokens=usage.completion_tokens, cached_tokens=cached)
+    if span is not None:
+        span["finish_reason"] = finish_reason or "none"
+
+
+def record_escalation(route: str, cause: str):
+    ROUTE_ESCALATIONS.inc(endpoint=current_endpoint(), route=route, cause=cause)
+
+
+def record_repair_follow_up(result: str):
+    REPAIR_FOLLOW_UPS.inc(endpoint=current_endpoint(), result=result)
+
+
+def record_document(chars: int):
+    DOCUMENT_CHARS.observe(chars, endpoint=current_endpoint())
+
+
+def record_stream(first_token: Optional[float], total: float, outcome: str):
+    """One streamed response: time to first token (None if none arrived) and total duration."""
+    endpoint = current_endpoint()
+    if first_token is not None:
+        STREAM_FIRST_TOKEN_SECONDS.observe(first_token, endpoint=endpoint)
+    STREAM_SECONDS.observe(total, endpoint=endpoint, outcome=outcome)
+
+
+def record_autocomplete(source: str, seconds: float):
+    AUTOCOMPLETE_SECONDS.observe(seconds, source=source)
+
+
+def record_error(error: BaseException):
+    ERRORS.inc(endpoint=current_endpoint(), error=type(error).__name__)
+
+
+# ============== Trace export ==============
+
+class TraceExporter:
+    """Buffers finished traces and writes them in batches off the request path."""
+
+    def __init__(self, target: str):
+        self.target = target
+        self._buffer = []
+        self._flusher = None
+        self._client = None
+
+    def submit(self, record: dict):
+        self._buffer.append(record)
+        if len(self._buffer) > TRACE_MAX_BUFFER:
+            del self._buffer[0]
+            TRACE_EXPORTS.inc(result="dropped")
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(TRACE_FLUSH_SECONDS)
+        await self.flush()
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            if self.target.startswith("file:"):
+                await asyncio.to_thread(self._append, self.target[len("file:"):], batch)
+            else:
+                if self._client is None:
+                    self._client = httpx.AsyncClient(timeout=5.0)
+                response = await self._client.post(self.target, json={"traces": batch})
+                response.raise_for_status()
+            TRACE_EXPORTS.inc(len(batch), result="exported")
+        except (OSError, httpx.HTTPError) as e:
+            TRACE_EXPORTS.inc(len(batch), result="failed")
+            print(f"Trace export to {self.target} failed: {e}")
+
+    @staticmethod
+    def _append(path: str, batch: list):
+        with open(path, "a", encoding="utf-8") as f:
+            for record in batch:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+exporter = TraceExporter(TRACE_EXPORT) if TRACE_EXPORT else None
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: request id header, request counters and latency, trace
+    export. Plain ASGI (not BaseHTTPMiddleware) so streamed responses are
+    timed to their last byte and their stages land in the same trace.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope.get("headers") or []).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if _REQUEST_ID_RE.match(incoming) else secrets.token_hex(8)
+        trace = Trace(request_id, scope)
+        token = _trace.set(trace)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _trace.reset(token)
+            REQUESTS.inc(endpoint=trace.endpoint, method=scope["method"], status=status)
+            REQUEST_SECONDS.observe(time.perf_counter() - trace.started, endpoint=trace.endpoint)
+            if trace.sampled:
+                exporter.submit(trace.record(status))
@@ -0,0 +1,129 @@
+from pydantic import BaseModel
+from typing import Optional, List, Literal, Dict, Union
+
+class DocumentRequest(BaseModel):
+    content: str
+    instruction: str
+    conversation_history: Optional[list] = None
+    context_snippets: Optional[List[str]] = None
+    single_pass: Optional[bool] = None  # None = server default (EDIT_SINGLE_PASS)
+    context_window: Optional[bool] = None  # None = server default (CONTEXT_WINDOW_ENABLED)
+    bypass_cache: bool = False
+    apply_changes: bool = False  # also return the document with the changes applied
+    repair: Optional[bool] = None  # None = server default (EDIT_REPAIR)
+
+class DeltaChange(BaseModel):
+    operation: str  # "insert" | "delete" | "replace"
+    position: int
+    old_text: Optional[str] = None
+    new_text: Optional[str] = None
+    context_before: Optional[str] = None
+    context_after: Optional[str] = None
+
+class DeltaResponse(BaseModel):
+    type: str  # "delta" | "full"
+    reasoning: Optional[str] = None
+    changes: Optional[List[DeltaChange]] = None
+    summary: str
+    processed_content: Optional[str] = None
+
+class FormatRequest(BaseModel):
+    content: str
+    format_type: str = "APA"
+    single_pass: Optional[bool] = None
+    bypass_cache: bool = False
+    apply_changes: bool = False  # also return the document with the changes applied
+    repair: Optional[bool] = None  # None = server default (EDIT_REPAIR)
+    format_mode: Optional[Literal['rules', 'hybrid', 'model']] = None  # None = server default (FORMAT_MODE)
+    output: Optional[Literal['text', 'blocks']] = None  # None = server default (FORMAT_OUTPUT)
+
+class WriteRequest(BaseModel):
+    prompt: str
+    context: Optional[str] = None
+
+class AutocompleteRequest(BaseModel):
+    context: str  # text before the cursor
+    max_tokens: int = 50  # capped by the autocomplete route
+    session_id: Optional[str] = None  # editor session; a new request cancels the session's previous one
+
+# ============== Lexical JSON Models (V2 API) ==============
+
+class TextSegment(BaseModel):
+    text: str
+    format: int = 0  # Bitmask: 0=normal, 1=bold, 2=italic, 4=underline, etc.
+
+class SimplifiedBlock(BaseModel):
+    id: str
+    type: Literal['paragraph', 'heading', 'list-item']
+    tag: Optional[Literal['h1', 'h2', 'h3']] = None
+    listType: Optional[Literal['bullet', 'number']] = None
+    indent: Optional[int] = None
+    segments: List[TextSegment]
+
+class SimplifiedDocument(BaseModel):
+    blocks: List[SimplifiedBlock]
+
+class LexicalDocumentRequest(BaseModel):
+    document: SimplifiedDocument
+    instruction: str
+    conversation_history: Optional[list] = None
+    context_snippets: Optional[List[str]] = None
+    single_pass: Optional[bool] = None  # None = server default (EDIT_SINGLE_PASS)
+    context_window: Optional[bool] = None  # None = server default (CONTEXT_WINDOW_ENABLED)
+    bypass_cache: bool = False
+    apply_changes: bool = False  # also return the document with the changes applied
+    repair: Optional[bool] = None  # None = server default (EDIT_REPAIR)
+    document_encoding: Optional[Literal['json', 'minimal', 'compact']] = None  # None = V2_DOCUMENT_ENCODING
+    execution: Optional[Literal['single', 'chunked', 'auto']] = None  # None = V2_EXECUTION
+
+class LexicalFormatRequest(BaseModel):
+    document: SimplifiedDocument
+    format_type: str = "APA"
+    format_mode: Optional[Literal['rules', 'hybrid', 'model']] = None  # None = server default (FORMAT_MODE)
+    single_pass: Optional[bool] = None
+    bypass_cache: bool = False
+    apply_changes: bool = False
+    repair: Optional[bool] = None
+    document_encoding: Optional[Literal['json', 'minimal', 'compact']] = None
+
+# ============== Editing sessions ==============
+
+class SessionCreateRequest(BaseModel):
+    document: SimplifiedDocument
+
+class SessionPatchRequest(BaseModel):
+    changes: List[dict]  # edit_document operations
+    base_hash: Optional[str] = None  # document_hash the client patched against
+
+class SessionCommandRequest(BaseModel):
+    instruction: str
+    context_snippets: Optional[List[str]] = None
+    base_hash: Optional[str] = None  # document_hash the client expects the server to hold
+    update_session: bool = True  # apply the accepted changes to the session's document
+    single_pass: Optional[bool] = None
+    context_window: Optional[bool] = None
+    bypass_cache: bool = False
+    apply_changes: bool = False
+    repair: Optional[bool] = None
+    document_encoding: Optional[Literal['json', 'minimal', 'compact']] = None
+    execution: Optional[Literal['single', 'chunked', 'auto']] = None
+
+# ============== Batch ==============
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None  # echoed back in the item's result
+    endpoint: Literal['command', 'command/v2', 'format', 'format/v2'] = 'command/v2'
+    document: Optional[str] = None  # key in BatchRequest.documents; fills the request's content/document
+    request: dict = {}  # body of that endpoint
+
+class BatchRequest(BaseModel):
+    documents: Dict[str, Union[str, SimplifiedDocument]] = {}  # markdown for V1 endpoints, SimplifiedDocument for V2
+    items: List[BatchItem]
+    concurrency: Optional[int] = None  # None = BATCH_CONCURRENCY (also the maximum)
+
+# ============== Diff ==============
+
+class DiffRequest(BaseModel):
+    original: Union[str, SimplifiedDocument]  # markdown, or a SimplifiedDocument on both sides
+    suggested: Union[str, SimplifiedDocument]
+    output: Optional[Literal['text', 'blocks']] = None  # markdown only: "blocks" diffs the blocks it reads as
@@ -0,0 +1,143 @@
+import json
+from typing import List, Optional
+
+from config import env_int
+from tokens import count_tokens, tokenizer_name
+
+# ============== Token-budgeted prompt assembly ==============
+# Every call gets one token budget shared by the prompt and the completion.
+# Parts are charged in priority order: system prompt and tool schemas, the
+# instruction, context snippets, the (windowed) document, a floor for the
+# output, then conversation history from the newest turn back. Turns that
+# don't fit are condensed into one short local summary or dropped, and
+# max_tokens gets whatever is left (capped per endpoint).
+
+PROMPT_TOKEN_BUDGET = env_int("PROMPT_TOKEN_BUDGET", 48000)           # prompt + completion, per call
+HISTORY_SUMMARY_TOKENS = env_int("HISTORY_SUMMARY_TOKENS", 300)       # condensed older turns
+SNIPPETS_MAX_SHARE = 0.25         # context snippets may use at most this share of the budget
+MESSAGE_OVERHEAD_TOKENS = 4       # role/separator tokens per chat message
+SUMMARY_TURN_CHARS = 160          # characters kept per condensed turn
+
+# (output floor, output cap) per kind of call
+V1_OUTPUT = (env_int("V1_MIN_OUTPUT_TOKENS", 500), env_int("V1_MAX_OUTPUT_TOKENS", 2000))
+V2_OUTPUT = (env_int("V2_MIN_OUTPUT_TOKENS", 2048), env_int("V2_MAX_OUTPUT_TOKENS", 16384))
+
+
+def message_tokens(message: dict) -> int:
+    content = message.get("content")
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False) if content is not None else ""
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+class PromptBudget:
+    def __init__(self, output: tuple, total: Optional[int] = None):
+        self.total = PROMPT_TOKEN_BUDGET if total is None else total
+        self.output = output
+        self.output_floor, self.output_cap = output
+        self.used = 0
+        self.parts = {}
+        self.history_kept = 0
+        self.history_condensed = 0
+        self.history_dropped = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.used
+
+    def charge(self, part: str, tokens: int):
+        self.used += tokens
+        self.parts[part] = self.parts.get(part, 0) + tokens
+
+    def add(self, part: str, *texts: str):
+        """Charge fixed prompt text (it is sent whatever the budget says)."""
+        self.charge(part, sum(count_tokens(text) for text in texts if text))
+
+    def add_tools(self, tools: list):
+        self.charge("tools", count_tokens(json.dumps(tools, separators=(",", ":"))))
+
+    def fit_snippets(self, snippets: Optional[List[str]]) -> List[str]:
+        """Keep context snippets in order while they fit their share of the budget."""
+        cleaned = [snippet.strip() for snippet in (snippets or []) if snippet.strip()]
+        allowance = min(self.remaining - self.output_floor, int(self.total * SNIPPETS_MAX_SHARE))
+        kept = []
+        spent = 0
+        for snippet in cleaned:
+            tokens = count_tokens(snippet) + 2
+            if spent + tokens > allowance:
+                break
+            kept.append(snippet)
+            spent += tokens
+        self.charge("context_snippets", spent)
+        return kept
+
+    def fit_history(self, history: Optional[list]) -> list:
+        """
+        Newest turns first, while they fit next to the output floor. Older turns
+        are condensed into one summary message (or dropped past its budget).
+        """
+        history = [message for message in (history or []) if isinstance(message, dict)]
+        allowance = self.remaining - self.output_floor
+        spent = 0
+        index = len(history)
+        while index > 0:
+            tokens = message_tokens(history[index - 1])
+            if spent + tokens > allowance:
+                break
+            spent += tokens
+            index -= 1
+        kept = history[index:]
+        older = history[:index]
+        self.charge("history", spent)
+        self.history_kept = len(kept)
+
+        if older:
+            summary = self._condense(older, min(HISTORY_SUMMARY_TOKENS, allowance - spent))
+            if summary is not None:
+                kept.insert(0, summary)
+                self.charge("history", message_tokens(summary))
+        return kept
+
+    def _condense(self, older: list, allowance: int) -> Optional[dict]:
+        lines = []
+        spent = count_tokens("Earlier conversation (condensed):") + MESSAGE_OVERHEAD_TOKENS
+        for message in reversed(older):
+            line = f"- {message.get('role', 'user')}: {_clip(message.get('content') or '', SUMMARY_TURN_CHARS)}"
+            tokens = count_tokens(line) + 1
+            if spent + tokens > allowance:
+                break
+            lines.append(line)
+            spent += tokens
+        self.history_condensed = len(lines)
+        self.history_dropped = len(older) - len(lines)
+        if not lines:
+            return None
+        lines.reverse()
+        return {"role": "system", "content": "Earlier conversation (condensed):\n" + "\n".join(lines)}
+
+    def limit_output(self, cap: int):
+        """Use a smaller (or larger) completion cap, e.g. the one a route picked."""
+        self.output_cap = cap
+        self.output_floor = min(self.output[0], cap)
+
+    def max_tokens(self) -> int:
+        """Completion budget: what is left, within the endpoint's floor and cap."""
+        return max(self.output_floor, min(self.output_cap, self.remaining))
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.total,
+            "prompt_tokens": self.used,
+            "max_tokens": self.max_tokens(),
+            "over_budget": self.used + self.output_floor > self.total,
+            "parts": dict(self.parts),
+            "history_kept": self.history_kept,
+            "history_condensed": self.history_condensed,
+            "history_dropped": self.history_dropped,
+            "tokenizer": tokenizer_name(),
+        }
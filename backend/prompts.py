@@ -0,0 +1,377 @@
+from typing import List
+
+from edit_summary import with_summary_fields
+
+# ============== Prompt layout ==============
+# Providers cache prompts by exact prefix (tools, then messages in order), so
+# every call is laid out as:
+#   1. static system prompt(s)   byte-identical across requests of a kind
+#   2. the document              identical while the document doesn't change
+#   3. conversation history
+#   4. volatile parts            snippets, notes, instruction
+# Nothing request-specific may be placed in (1), and the tool list passed for
+# a kind of call must always be the same objects in the same order.
+
+# ============== System prompts for AI agent ==============
+EDITOR_SYSTEM_PROMPT = """You are a professional document editing agent. Your role is to apply precise edits to documents efficiently.
+
+CRITICAL RULES:
+1. NO conversational fluff (no "Certainly!", "I'd be happy to", etc.)
+2. Documents are provided in MARKDOWN format
+3. Use the replace_text tool to make changes
+4. ALWAYS use markdown syntax for formatting: **bold**, *italic*, # headings
+5. Be surgical and precise - change only what's necessary
+
+MARKDOWN FORMAT:
+The document uses markdown formatting:
+- **bold text** for bold
+- *italic text* for italic
+- # Heading 1, ## Heading 2, ### Heading 3 for headings
+- Blank lines separate paragraphs
+
+HOW TO USE replace_text TOOL:
+- Find the EXACT text that needs to be changed (old_text including markdown syntax)
+- Specify what it should be replaced with (new_text with proper markdown)
+- The tool will find and replace the text automatically
+- You can call the tool multiple times for multiple changes
+
+EXAMPLES:
+- To make "Education" bold: replace_text("Education", "**Education**")
+- To change "WORK EXPERIENCE" to bold heading: replace_text("WORK EXPERIENCE", "## Work Experience")
+- To italicize a book title: replace_text("The Great Gatsby", "*The Great Gatsby*")
+- To fix capitalization AND make bold: replace_text("education", "**Education**")
+
+EDITING PRINCIPLES:
+- Preserve the author's voice and style
+- Make minimal necessary changes
+- Maintain existing markdown formatting unless explicitly asked to change
+- Preserve paragraph breaks (double newlines)
+
+AFTER using tools, provide:
+- "reasoning": Brief analysis of what changes were made and why (1-3 sentences)
+- "summary": Concise statement of what was changed (no pleasantries)
+"""
+
+FORMATTING_STANDARDS = """
+APA 7th: Title page (bold title), running head, Level 1-2 headings (centered/left bold), double-space, 0.5" indent
+MLA 9th: Header (last name + page), first page heading, centered title, double-space, 0.5" indent
+Chicago 17th: Title page (title 1/3 down), footnotes/endnotes, bibliography hanging indent
+IEEE: Section numbering, column format, citation brackets
+"""
+
+# ============== V2 System Prompt (Lexical JSON) ==============
+
+EDITOR_SYSTEM_PROMPT_V2 = """Document editing assistant. Use edit_document tool for ALL changes.
+
+RULES:
+- Be surgical - only change what's requested
+- One block = one paragraph/heading/list-item
+- NEVER use markdown (**, *) - use format bitmask
+- For new content: insert_block for EACH block separately
+
+FORMAT: {"blocks":[{"id":"block-0","type":"paragraph","segments":[{"text":"Hello","format":0}]}]}
+Types: paragraph, heading (tag:h1/h2/h3), list-item (listType:bullet/number)
+Format: 0=normal, 1=bold, 2=italic, 3=bold+italic
+
+OPERATIONS:
+- modify_segments: Edit text/format in block
+- replace_block: Change block type
+- insert_block: Add block (afterBlockId=null for start)
+- delete_block: Remove block
+
+LISTS: type="list-item" + listType. NEVER put "1." or "-" in text.
+
+EDITING PRINCIPLES:
+- Preserve the author's voice and style
+- Make minimal necessary changes
+- Only modify blocks that actually need changing
+- Do NOT regenerate unchanged content
+
+AFTER using tools, provide:
+- "reasoning": Brief analysis of what changes were made and why (1-3 sentences)
+- "summary": Concise statement of what was changed (no pleasantries)"""
+
+# ============== V2 Tool Definition ==============
+
+EDIT_DOCUMENT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "edit_document",
+        "description": """Edit the document using block-level operations. Each block has an 'id' for reference.
+
+Operations:
+- replace_block: Replace entire block with new content/type
+- insert_block: Insert new block (use afterBlockId=null for start of document)
+- delete_block: Remove a block
+- modify_segments: Change text/formatting within a block
+
+Format bitmask: 0=normal, 1=bold, 2=italic, 3=bold+italic, 4=underline""",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "changes": {
+                    "type": "array",
+                    "description": "List of changes to apply to the document",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "operation": {
+                                "type": "string",
+                                "enum": ["replace_block", "insert_block", "delete_block", "modify_segments"],
+                                "description": "The type of operation to perform"
+                            },
+                            "blockId": {
+                                "type": "string",
+                                "description": "ID of the block to modify (for replace/delete/modify operations)"
+                            },
+                            "afterBlockId": {
+                                "type": ["string", "null"],
+                                "description": "ID of block to insert after. Use null to insert at the beginning (for insert_block only)"
+                            },
+                            "newBlock": {
+                                "type": "object",
+                                "description": "The new block content (for replace_block and insert_block)",
+                                "properties": {
+                                    "id": {"type": "string", "description": "Unique ID for the block"},
+                                    "type": {"type": "string", "enum": ["paragraph", "heading", "list-item"]},
+                                    "tag": {"type": "string", "enum": ["h1", "h2", "h3"], "description": "Heading level (for headings only)"},
+                                    "listType": {"type": "string", "enum": ["bullet", "number"], "description": "List type (for list-items only)"},
+                                    "segments": {
+                                        "type": "array",
+                                        "items": {
+                                            "type": "object",
+                                            "properties": {
+                                                "text": {"type": "string"},
+                                                "format": {"type": "integer", "description": "Format bitmask: 0=normal, 1=bold, 2=italic, 4=underline"}
+                                            },
+                                            "required": ["text", "format"]
+                                        }
+                                    }
+                                },
+                                "required": ["id", "type", "segments"]
+                            },
+                            "newSegments": {
+                                "type": "array",
+                                "description": "New text segments (for modify_segments only)",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "text": {"type": "string"},
+                                        "format": {"type": "integer"}
+                                    },
+                                    "required": ["text", "format"]
+                                }
+                            }
+                        },
+                        "required": ["operation"]
+                    }
+                }
+            },
+            "required": ["changes"]
+        }
+    }
+}
+
+
+EDIT_DOCUMENT_TOOL_SINGLE_PASS = with_summary_fields(EDIT_DOCUMENT_TOOL)
+
+# Define tools for OpenAI function calling
+REPLACE_TEXT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "replace_text",
+        "description": "Replace exact text in the document. Call this multiple times for multiple changes.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "old_text": {
+                    "type": "string",
+                    "description": "The exact text to find and replace in the document"
+                },
+                "new_text": {
+                    "type": "string",
+                    "description": "The replacement text"
+                }
+            },
+            "required": ["old_text", "new_text"]
+        }
+    }
+}
+
+APPLY_BOLD_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "apply_bold",
+        "description": "Make text bold in the document. Use this instead of markdown **text**.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "text": {
+                    "type": "string",
+                    "description": "The exact text to make bold"
+                }
+            },
+            "required": ["text"]
+        }
+    }
+}
+
+APPLY_ITALIC_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "apply_italic",
+        "description": "Make text italic in the document. Use this instead of markdown *text*.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "text": {
+                    "type": "string",
+                    "description": "The exact text to make italic"
+                }
+            },
+            "required": ["text"]
+        }
+    }
+}
+
+APPLY_HEADING_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "apply_heading",
+        "description": "Convert text to a heading with the specified level (1, 2, or 3).",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "text": {
+                    "type": "string",
+                    "description": "The exact text to convert to a heading"
+                },
+                "level": {
+                    "type": "integer",
+                    "description": "Heading level: 1 (largest), 2 (medium), or 3 (smallest)",
+                    "enum": [1, 2, 3]
+                }
+            },
+            "required": ["text", "level"]
+        }
+    }
+}
+
+# All available tools
+ALL_FORMATTING_TOOLS = [
+    REPLACE_TEXT_TOOL,
+    APPLY_BOLD_TOOL,
+    APPLY_ITALIC_TOOL,
+    APPLY_HEADING_TOOL
+]
+
+# Formatting standards knowledge for tools
+FORMATTING_TOOLS = {
+    "apa": {
+        "type": "function",
+        "function": {
+            "name": "apply_apa_heading",
+            "description": "Apply APA 7th Edition heading format. Level 1: Centered Bold Title Case. Level 2: Left Aligned Bold Title Case.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "old_heading": {"type": "string", "description": "Current heading text"},
+                    "new_heading": {"type": "string", "description": "Heading with proper APA capitalization"},
+                    "level": {"type": "integer", "description": "Heading level (1 or 2)"}
+                },
+                "required": ["old_heading", "new_heading", "level"]
+            }
+        }
+    },
+    "mla": {
+        "type": "function",
+        "function": {
+            "name": "apply_mla_format",
+            "description": "Apply MLA 9th Edition formatting. Title: centered, standard capitalization. First page: Name, Instructor, Course, Date (top left, double-spaced).",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "old_text": {"type": "string"},
+                    "new_text": {"type": "string"}
+                },
+                "required": ["old_text", "new_text"]
+            }
+        }
+    },
+    "chicago": {
+        "type": "function",
+        "function": {
+            "name": "apply_chicago_format",
+            "description": "Apply Chicago 17th Edition formatting. Title page: title centered 1/3 down, author and course info bottom third.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "old_text": {"type": "string"},
+                    "new_text": {"type": "string"}
+                },
+                "required": ["old_text", "new_text"]
+            }
+        }
+    }
+}
+
+# Style-specific formatting instructions (per format_type)
+FORMAT_INSTRUCTIONS = {
+    "APA": """Apply APA 7th Edition formatting using MARKDOWN:
+- Title: Use **Title** for bold title (Title Case)
+- Headings: ## Level 1 Heading (Bold Title Case), ### Level 2 Heading
+- References: Use "## References" for the heading
+- Emphasis: Use **bold** for emphasis
+
+Examples:
+- Title: replace_text("my document title", "**My Document Title**")
+- Section heading: replace_text("EDUCATION", "## Education")
+- Bold text: replace_text("Bachelor of Science", "**Bachelor of Science**")
+
+Use replace_text tool with proper markdown syntax.""",
+
+    "MLA": """Apply MLA 9th Edition formatting using MARKDOWN:
+- Title: Use # Title (standard capitalization, not bold)
+- Works Cited: Use "# Works Cited" for the heading
+- No bold/italic in title
+- Book titles in text: Use *italic* for book titles
+
+Examples:
+- Title: replace_text("the great gatsby", "# The Great Gatsby")
+- Works Cited heading: replace_text("works cited", "# Works Cited")
+- Book title in text: replace_text("The Great Gatsby", "*The Great Gatsby*")
+
+Use replace_text tool with proper markdown syntax.""",
+
+    "Chicago": """Apply Chicago 17th Edition formatting using MARKDOWN:
+- Title: Use # Title for title page
+- Bibliography: Use "# Bibliography" for the heading
+- Book titles in text: Use *italic* for book titles
+- Emphasis: Use *italic* for foreign phrases
+
+Examples:
+- Title: replace_text("my thesis", "# My Thesis")
+- Bibliography heading: replace_text("bibliography", "# Bibliography")
+- Book title in text: replace_text("The Great Gatsby", "*The Great Gatsby*")
+
+Use replace_text tool with proper markdown syntax."""
+}
+
+
+
+# ============== Static prefixes ==============
+
+# Shared by /api/command and /api/format
+V1_SYSTEM_PROMPT = EDITOR_SYSTEM_PROMPT + "\n\n" + FORMATTING_STANDARDS
+V1_TOOLS = [REPLACE_TEXT_TOOL]
+V2_TOOLS = [EDIT_DOCUMENT_TOOL]
+V2_TOOLS_SINGLE_PASS = [EDIT_DOCUMENT_TOOL_SINGLE_PASS]
+
+
+def layout_messages(system: List[str], document: str, history: list, volatile: str) -> list:
+    """Messages in prefix-stable order (see the note at the top of this module)."""
+    messages = [{"role": "system", "content": content} for content in system]
+    messages.append({"role": "user", "content": document})
+    messages.extend(history)
+    messages.append({"role": "user", "content": volatile})
+    return messages
@@ -0,0 +1,459 @@
+import asyncio
+import ipaddress
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from starlette.routing import Match
+
+from config import env_float, env_int
+from tokens import estimate_tokens
+
+# ============== Rate limiting and admission control ==============
+# In-process replacement for the check_rate_limit round trip to Postgres,
+# applied to the endpoints that call the model (POST only):
+#   - Token buckets per user and per (user, endpoint group), refilled
+#     continuously; a limit of 0 turns that bucket off. A request costs its
+#     estimated prompt tokens (request body size) plus RATE_LIMIT_REQUEST_COST
+#     for instructions and output, so one 500-page command weighs what it
+#     costs upstream. An empty bucket answers 429 at once with Retry-After
+#     (when it will hold enough tokens).
+#   - Global admission: at most RATE_LIMIT_MAX_CONCURRENT limited requests run
+#     at once (streams until their last byte). Up to RATE_LIMIT_MAX_QUEUE more
+#     wait in FIFO order for at most RATE_LIMIT_QUEUE_TIMEOUT seconds; beyond
+#     that the answer is 503 with Retry-After.
+#   - /api/batch is weighed per item instead (ITEM_LIMITED_ROUTES): the
+#     middleware lets it through, and each item takes its own estimated prompt
+#     tokens from the user's buckets for its endpoint's group, and an admission
+#     slot, just before it runs. A refused item fails with 429/503 in its
+#     `item` event; the rest of the batch goes on.
+#
+# Users are keyed like jobs: by client address, or by the X-User-ID header
+# when the request comes from a proxy listed in RATE_LIMIT_TRUSTED_PROXIES
+# (the app server that authenticated the user); anyone else could pick a new
+# id per request, so their header is ignored.
+# Buckets live in process memory, so each uvicorn worker enforces the limits
+# on its own. With RATE_LIMIT_DB set, buckets are kept in a SQLite file that
+# all workers on the host share (one short transaction per request).
+# Counters are served by /api/stats/ratelimit.
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_USER_TPM = env_int("RATE_LIMIT_USER_TPM", 400000)    # tokens per minute per user, all endpoints
+RATE_LIMIT_REQUEST_COST = env_int("RATE_LIMIT_REQUEST_COST", 200)  # tokens added to every request
+RATE_LIMIT_MAX_CONCURRENT = env_int("RATE_LIMIT_MAX_CONCURRENT", 64)
+RATE_LIMIT_MAX_QUEUE = env_int("RATE_LIMIT_MAX_QUEUE", 128)
+RATE_LIMIT_QUEUE_TIMEOUT = env_float("RATE_LIMIT_QUEUE_TIMEOUT", 10.0)
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB") or None
+# Addresses or networks (comma-separated) whose X-User-ID header is believed
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+REFILL_SECONDS = 60.0  # a bucket holds one minute's worth: idle this long, it is full and can be forgotten
+PRUNE_EVERY = 1000     # takes between sweeps of idle buckets
+
+# Endpoint groups (route template -> group) and their per-user budgets in
+# tokens per minute; a bucket holds one minute's worth, so that is also the burst
+GROUP_TPM = {
+    "autocomplete": env_int("RATE_LIMIT_TPM_AUTOCOMPLETE", 60000),
+    "enhance": env_int("RATE_LIMIT_TPM_ENHANCE", 60000),
+    "format": env_int("RATE_LIMIT_TPM_FORMAT", 250000),
+    "command": env_int("RATE_LIMIT_TPM_COMMAND", 250000),
+}
+LIMITED_ROUTES = {
+    "/api/autocomplete": "autocomplete",
+    "/api/enhance": "enhance",
+    "/api/enhance/stream": "enhance",
+    "/api/format": "format",
+    "/api/format/v2": "format",
+    "/api/jobs/format": "format",
+    "/api/command": "command",
+    "/api/command/v2": "command",
+    "/api/command/v2/stream": "command",
+    "/api/jobs/command/v2": "command",
+    "/api/sessions/{session_id}/command": "command",
+    "/api/batch": "command",
+}
+# Routes that charge and admit each model call themselves (RateLimiter.admitted)
+ITEM_LIMITED_ROUTES = {"/api/batch"}
+
+
+def trusted_proxy(host: Optional[str]) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False  # no address, or a test client's name
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def user_key(scope: dict) -> str:
+    """X-User-ID from a trusted proxy, else the client address."""
+    client = scope.get("client")
+    host = client[0] if client else None
+    if trusted_proxy(host):
+        user = dict(scope.get("headers") or []).get(b"x-user-id", b"").decode("latin-1")
+        if user:
+            return user
+    return host or "anonymous"
+
+
+def request_cost(body: bytes) -> int:
+    return estimate_tokens(body.decode("utf-8", errors="replace")) + RATE_LIMIT_REQUEST_COST
+
+
+class Bucket:
+    """Capacity in tokens, refilled at capacity per minute."""
+
+    def __init__(self, key: str, tokens_per_minute: int):
+        self.key = key
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / REFILL_SECONDS
+
+    def level(self, tokens: float, updated: float, now: float) -> float:
+        return min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+
+    def charge(self, cost: float) -> float:
+        # A request bigger than the whole bucket waits for a full bucket instead of never passing
+        return min(cost, self.capacity)
+
+
+def _wait(levels: list, cost: float) -> float:
+    """Seconds until every (bucket, tokens) in `levels` holds `cost`; 0 if they all do now."""
+    return max(
+        ((bucket.charge(cost) - tokens) / bucket.rate for bucket, tokens in levels if tokens < bucket.charge(cost)),
+        default=0.0,
+    )
+
+
+class MemoryBuckets:
+    def __init__(self):
+        self._levels = {}  # key -> (tokens, updated)
+        self._takes = 0
+
+    def _level(self, bucket: Bucket, now: float) -> float:
+        tokens, updated = self._levels.get(bucket.key, (bucket.capacity, now))
+        return bucket.level(tokens, updated, now)
+
+    def take(self, buckets: list, cost: float) -> float:
+        """Take `cost` from every bucket if all of them hold it; else seconds until they do."""
+        now = time.monotonic()
+        self._takes += 1
+        if self._takes % PRUNE_EVERY == 0:
+            self._levels = {key: level for key, level in self._levels.items() if now - level[1] < REFILL_SECONDS}
+        levels = [(bucket, self._level(bucket, now)) for bucket in buckets]
+        wait = _wait(levels, cost)
+        if wait > 0:
+            return wait
+        for bucket, tokens in levels:
+            self._levels[bucket.key] = (tokens - bucket.charge(cost), now)
+        return 0.0
+
+    def give_back(self, buckets: list, cost: float):
+        now = time.monotonic()
+        for bucket in buckets:
+            self._levels[bucket.key] = (min(bucket.capacity, self._level(bucket, now) + bucket.charge(cost)), now)
+
+    def __len__(self):
+        return len(self._levels)
+
+
+class SQLiteBuckets:
+    """Buckets shared by the workers on one host; blocking, called through asyncio.to_thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._takes = 0
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")  # the read-modify-write below is atomic across workers
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def _levels(self, conn, buckets: list, now: float) -> list:
+        levels = []
+        for bucket in buckets:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (bucket.key,)).fetchone()
+            tokens, updated = row if row else (bucket.capacity, now)
+            levels.append((bucket, bucket.level(tokens, updated, now)))
+        return levels
+
+    def take(self, buckets: list, cost: float) -> float:
+        now = time.time()
+        self._takes += 1
+        with self._connect() as conn:
+            if self._takes % PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - REFILL_SECONDS,))
+            levels = self._levels(conn, buckets, now)
+            wait = _wait(levels, cost)
+            if wait > 0:
+                return wait
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [(bucket.key, tokens - bucket.charge(cost), now) for bucket, tokens in levels],
+            )
+            return 0.0
+
+    def give_back(self, buckets: list, cost: float):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [(bucket.key, min(bucket.capacity, tokens + bucket.charge(cost)), now)
+                 for bucket, tokens in self._levels(conn, buckets, now)],
+            )
+
+
+class Busy(Exception):
+    """No admission slot: the wait queue is full or the wait timed out."""
+
+
+class Rejected(Exception):
+    """Turned away: 429 (bucket empty) or 503 (no admission slot), with seconds for Retry-After."""
+
+    def __init__(self, status: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    """At most `max_concurrent` holders; up to `max_queue` waiters, each for at most `timeout` seconds."""
+
+    def __init__(self, max_concurrent: int, max_queue: int, timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters = deque()  # futures, first come first served
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Busy("queue full")
+        self.queued += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            raise Busy("queue timeout") from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # handed a slot just as we were cancelled
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self):
+        # Hand the slot straight to the next waiter, so newcomers can't overtake the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        enabled: bool = RATE_LIMIT_ENABLED,
+        user_tpm: int = RATE_LIMIT_USER_TPM,
+        group_tpm: Optional[dict] = None,
+        max_concurrent: int = RATE_LIMIT_MAX_CONCURRENT,
+        max_queue: int = RATE_LIMIT_MAX_QUEUE,
+        queue_timeout: float = RATE_LIMIT_QUEUE_TIMEOUT,
+        db_path: Optional[str] = RATE_LIMIT_DB_PATH,
+    ):
+        self.enabled = enabled
+        self.user_tpm = user_tpm
+        self.group_tpm = group_tpm or GROUP_TPM
+        self.memory = MemoryBuckets()
+        self.disk = SQLiteBuckets(db_path) if (enabled and db_path) else None
+        self.gate = AdmissionGate(max_concurrent, max_queue, queue_timeout)
+        self.counters = {"admitted": 0, "limited": 0, "rejected_busy": 0, "disk_errors": 0}
+        self.limited_by_group = {group: 0 for group in self.group_tpm}
+        self.tokens_admitted = 0
+
+    def buckets(self, user: str, group: str) -> list:
+        """The user's overall bucket and their bucket for the group; a limit of 0 means none."""
+        limits = ((f"user:{user}", self.user_tpm), (f"{group}:{user}", self.group_tpm[group]))
+        return [Bucket(key, tpm) for key, tpm in limits if tpm > 0]
+
+    async def _call(self, method: str, buckets: list, cost: float):
+        if self.disk is not None:
+            try:
+                return await asyncio.to_thread(getattr(self.disk, method), buckets, cost)
+            except sqlite3.Error as e:
+                self.counters["disk_errors"] += 1
+                print(f"Rate limit store failed, using this worker's buckets: {e}")
+        return getattr(self.memory, method)(buckets, cost)
+
+    async def take(self, user: str, group: str, cost: int) -> float:
+        """0 if the request may go ahead (tokens taken), else seconds until it may."""
+        wait = await self._call("take", self.buckets(user, group), cost)
+        if wait > 0:
+            self.counters["limited"] += 1
+            self.limited_by_group[group] += 1
+        return wait
+
+    async def give_back(self, user: str, group: str, cost: int):
+        await self._call("give_back", self.buckets(user, group), cost)
+
+    async def acquire(self, user: str, group: str, cost: int):
+        """Take the tokens, then an admission slot (release with gate.release()); Rejected if either is refused."""
+        wait = await self.take(user, group, cost)
+        if wait > 0:
+            raise Rejected(429, f"Rate limit exceeded for {group}; retry in {wait:.1f}s", wait)
+        try:
+            await self.gate.acquire()
+        except Busy as e:
+            await self.give_back(user, group, cost)
+            self.counters["rejected_busy"] += 1
+            raise Rejected(503, f"Server busy ({e}); retry shortly", 1) from None
+        self.counters["admitted"] += 1
+        self.tokens_admitted += cost
+
+    @asynccontextmanager
+    async def admitted(self, user: str, group: str, cost: int):
+        """One model call made by an ITEM_LIMITED_ROUTES handler; does nothing when limiting is off."""
+        if not self.enabled:
+            yield
+            return
+        await self.acquire(user, group, cost)
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            **self.counters,
+            "queued": self.gate.queued,
+            "limited_by_group": dict(self.limited_by_group),
+            "tokens_admitted": self.tokens_admitted,
+            "in_flight": self.gate.in_flight,
+            "waiting": self.gate.waiting,
+            "buckets": len(self.memory),
+            "shared": self.disk is not None,
+            "limits": {"user_tpm": self.user_tpm, "group_tpm": self.group_tpm, "max_concurrent": self.gate.max_concurrent,
+                       "max_queue": self.gate.max_queue, "queue_timeout": self.gate.timeout},
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+def _match_route(scope: dict):
+    """The route the router will pick, as (route, child scope), or (None, None)."""
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route, child_scope
+    return None, None
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return None  # disconnected before sending the body
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"retry-after", str(max(1, int(retry_after + 0.999))).encode("latin-1")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware in front of the router: limited requests have their body
+    read (to weigh them), pass the user and group buckets, then wait for an
+    admission slot, which is held until the response is fully sent.
+    """
+
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiter
+        if scope["type"] != "http" or scope["method"] != "POST" or not limiter.enabled:
+            await self.app(scope, receive, send)
+            return
+        route, child_scope = _match_route(scope)
+        path = getattr(route, "path", None)
+        group = LIMITED_ROUTES.get(path)
+        if group is None or path in ITEM_LIMITED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        if body is None:
+            return
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        user = user_key(scope)
+        cost = request_cost(body)
+        try:
+            await limiter.acquire(user, group, cost)
+        except Rejected as e:
+            # Rejections never reach the router; label them with their route for /metrics
+            scope.update(child_scope)
+            await _reject(send, e.status, e.detail, e.retry_after)
+            return
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            limiter.gate.release()
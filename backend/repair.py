@@ -0,0 +1,469 @@
+import difflib
+import json
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import llm
+from config import env_float, env_int
+from models import SimplifiedDocument
+from doc_encoding import minimal_block_dict
+from edit_summary import UsageTally
+from metrics import record_repair_follow_up, stage
+from routing import choose_route
+
+# ============== Repair of edits that failed validation ==============
+# A replace_text old_text that doesn't occur verbatim, or an edit_document op on
+# a block id that doesn't exist, would otherwise be lost. Repair runs in two
+# stages:
+#   1. Local: a fuzzy index (trigram votes + bounded edit distance for text,
+#      normalized ids and trigram similarity for blocks) fixes high-confidence
+#      cases without a model call.
+#   2. Follow-up: the remaining failures go to the model in ONE small json_object
+#      call with only the failing edits and the passages/blocks around their
+#      closest candidates, never the whole document.
+
+REPAIR_DEFAULT = os.getenv("EDIT_REPAIR", "true").lower() in ("1", "true", "yes")
+REPAIR_AUTO_FIX_SCORE = env_float("EDIT_REPAIR_AUTO_FIX_SCORE", 0.85)  # similarity needed to fix without the model
+REPAIR_MAX_FOLLOW_UP = env_int("EDIT_REPAIR_MAX_FOLLOW_UP", 8)           # failed edits sent in the follow-up call
+REPAIR_MIN_CHARS = 8              # shorter old_text values are too ambiguous to fix locally
+REPAIR_MAX_PATTERN_CHARS = 400    # longer ones skip the edit-distance pass and go to the model
+REPAIR_MIN_CANDIDATE_SCORE = 0.4  # weaker candidates aren't worth showing the model
+REPAIR_MARGIN = 0.1               # best candidate must beat the runner-up by this much
+REPAIR_CONTEXT_CHARS = 300        # text shown around a candidate in the follow-up
+REPAIR_CONTEXT_BLOCKS = 24        # blocks shown per follow-up, across all failed ops
+
+
+def use_repair(flag: Optional[bool]) -> bool:
+    return REPAIR_DEFAULT if flag is None else flag
+
+
+# Same-length folding, so positions in the folded text are positions in the original
+_FOLD = str.maketrans({
+    "\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"',
+    "\u2013": "-", "\u2014": "-", "\u00a0": " ", "\t": " ", "\n": " ",
+})
+
+
+def fold(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) != len(text):  # a few characters change length when lowercased
+        lowered = text
+    return lowered.translate(_FOLD)
+
+
+def align(pattern: str, text: str) -> Tuple[int, int, int]:
+    """
+    Semi-global edit distance: the substring of `text` closest to `pattern`.
+    Returns (distance, start, end).
+    """
+    m = len(pattern)
+    prev = list(range(m + 1))
+    prev_start = [0] * (m + 1)
+    best = (prev[m], 0, 0)
+    for j, ch in enumerate(text, 1):
+        cur = [0] * (m + 1)
+        cur_start = [j] * (m + 1)
+        for i in range(1, m + 1):
+            cost = prev[i - 1] + (pattern[i - 1] != ch)
+            start = prev_start[i - 1]
+            if prev[i] + 1 < cost:
+                cost, start = prev[i] + 1, prev_start[i]
+            if cur[i - 1] + 1 < cost:
+                cost, start = cur[i - 1] + 1, cur_start[i - 1]
+            cur[i] = cost
+            cur_start[i] = start
+        if cur[m] < best[0]:
+            best = (cur[m], cur_start[m], j)
+        prev, prev_start = cur, cur_start
+    return best
+
+
+class FuzzyTextIndex:
+    """
+    Approximate locator for strings that don't occur verbatim. Every trigram of
+    the pattern votes for the offset the pattern would start at; the best
+    offsets are then scored with a bounded edit-distance alignment.
+    Only trigrams that appear in looked-up patterns are ever indexed.
+    """
+
+    N = 3
+    BUCKET = 8                  # votes are grouped so small insertions/deletions still agree
+    CANDIDATES = 3
+    MAX_GRAM_OCCURRENCES = 2000  # trigrams this common carry no signal
+    MAX_VOTING_GRAMS = 48
+
+    def __init__(self, text: str):
+        self.text = text
+        self.folded = fold(text)
+        self._positions = {}
+
+    def _gram_positions(self, gram: str) -> List[int]:
+        hits = self._positions.get(gram)
+        if hits is None:
+            hits = []
+            start = self.folded.find(gram)
+            while start != -1 and len(hits) <= self.MAX_GRAM_OCCURRENCES:
+                hits.append(start)
+                start = self.folded.find(gram, start + 1)
+            if len(hits) > self.MAX_GRAM_OCCURRENCES:
+                hits = []
+            self._positions[gram] = hits
+        return hits
+
+    def locate(self, pattern: str) -> List[dict]:
+        """Best candidate spans, highest score first: [{"start", "end", "score"}]."""
+        folded = fold(pattern)
+        m = len(folded)
+        if m < self.N:
+            return []
+
+        exact = self.folded.find(folded)
+        if exact != -1:
+            # Differs only in case, quotes, dashes or whitespace kind
+            second = self.folded.find(folded, exact + 1)
+            candidates = [{"start": exact, "end": exact + m, "score": 1.0}]
+            if second != -1:
+                candidates.append({"start": second, "end": second + m, "score": 1.0})
+            return candidates
+
+        # Long patterns vote with a sample of their trigrams; a few dozen are plenty
+        offsets = range(0, m - self.N + 1, max(1, (m - self.N + 1) // self.MAX_VOTING_GRAMS))
+        votes = Counter()
+        for offset in offsets:
+            for position in self._gram_positions(folded[offset:offset + self.N]):
+                votes[(position - offset) // self.BUCKET] += 1
+        if not votes:
+            return []
+
+        # Neighboring buckets are the same candidate; align only the strongest few regions
+        min_votes = max(2, len(offsets) // 5)
+        reach = m // self.BUCKET + 1
+        buckets = []
+        for bucket, count in votes.most_common():
+            if count < min_votes or len(buckets) == self.CANDIDATES:
+                break
+            if all(abs(bucket - other) > reach for other in buckets):
+                buckets.append(bucket)
+        slack = m // 8 + self.BUCKET
+
+        candidates = []
+        for bucket in buckets:
+            origin = max(0, bucket * self.BUCKET - slack)
+            window = self.folded[origin:bucket * self.BUCKET + m + slack]
+            if m <= REPAIR_MAX_PATTERN_CHARS:
+                distance, start, end = align(folded, window)
+                score = 1 - distance / m
+            else:
+                # Too long for the edit-distance pass: use the vote share as the score
+                start, end = bucket * self.BUCKET - origin, min(len(window), bucket * self.BUCKET - origin + m)
+                score = votes[bucket] / len(offsets)
+            start, end = self._snap(origin + start, origin + end)
+            if any(c["start"] < end and start < c["end"] for c in candidates):
+                continue
+            candidates.append({"start": start, "end": end, "score": round(score, 3)})
+        candidates.sort(key=lambda c: c["score"], reverse=True)
+        return candidates[:self.CANDIDATES]
+
+    def _snap(self, start: int, end: int) -> Tuple[int, int]:
+        # Alignments can stop inside a word ("ches" for "cheese" in "chess"); widen to whole words
+        text = self.text
+        while 0 < start < len(text) and text[start - 1].isalnum() and text[start].isalnum():
+            start -= 1
+        while 0 < end < len(text) and text[end - 1].isalnum() and text[end].isalnum():
+            end += 1
+        return start, end
+
+    def context(self, start: int, end: int, chars: int = REPAIR_CONTEXT_CHARS) -> str:
+        """The text around [start, end), cut at whitespace."""
+        left = max(0, start - chars)
+        right = min(len(self.text), end + chars)
+        if left:
+            space = self.text.find(" ", left, start)
+            left = space + 1 if space != -1 else left
+        if right < len(self.text):
+            space = self.text.rfind(" ", end, right)
+            right = space if space != -1 else right
+        return self.text[left:right]
+
+
+def _confident(candidates: List[dict]) -> bool:
+    if not candidates or candidates[0]["score"] < REPAIR_AUTO_FIX_SCORE:
+        return False
+    return len(candidates) == 1 or candidates[1]["score"] <= candidates[0]["score"] - REPAIR_MARGIN
+
+
+# ============== replace_text (V1) ==============
+
+REPAIR_SYSTEM_PROMPT = "You repair document edits that could not be applied. Respond with a JSON object only."
+
+REPAIR_TEXT_PROMPT = """These replace_text edits could not be applied because old_text does not occur in the document exactly.
+For each edit, the closest passages of the document are shown.
+
+{items}
+
+Return {{"fixes": [{{"edit": <edit number>, "old_text": "...", "new_text": "..."}}]}}.
+old_text must be copied character for character from one of the edit's passages. Leave out edits that don't match any passage."""
+
+
+def _fixed_new_text(old_text: str, new_text: str, actual: str) -> str:
+    # Wrapping edits (formatting, headings) repeat old_text inside new_text
+    return new_text.replace(old_text, actual, 1) if old_text and old_text in new_text else new_text
+
+
+async def repair_text_changes(content: str, changes: List[dict], issues: List[dict], tally: UsageTally) -> Tuple[List[dict], dict]:
+    """
+    Repair replace_text changes whose old_text is missing from `content`.
+    Returns (changes, report); repaired changes are marked with "repaired".
+    """
+    changes = [dict(change) for change in changes]
+    report = {"failed": 0, "auto_fixed": 0, "model_fixed": 0, "follow_up_calls": 0}
+    index = FuzzyTextIndex(content)
+    unresolved = []
+
+    for issue in issues:
+        if issue["status"] != "missing":
+            continue
+        report["failed"] += 1
+        change = changes[issue["index"]]
+        old_text = change.get("old_text", "")
+        candidates = index.locate(old_text)
+        if len(old_text) >= REPAIR_MIN_CHARS and _confident(candidates):
+            actual = content[candidates[0]["start"]:candidates[0]["end"]]
+            change["new_text"] = _fixed_new_text(old_text, change.get("new_text", ""), actual)
+            change["old_text"] = actual
+            change["repaired"] = "fuzzy"
+            report["auto_fixed"] += 1
+            continue
+        candidates = [c for c in candidates if c["score"] >= REPAIR_MIN_CANDIDATE_SCORE]
+        if candidates:
+            unresolved.append((issue["index"], [index.context(c["start"], c["end"]) for c in candidates]))
+
+    unresolved = unresolved[:REPAIR_MAX_FOLLOW_UP]
+    if not unresolved:
+        return changes, report
+
+    items = []
+    for edit, passages in unresolved:
+        change = changes[edit]
+        shown = "\n".join(f"<<<{passage}>>>" for passage in passages)
+        items.append(
+            f"Edit {edit}\nold_text: {json.dumps(change.get('old_text', ''), ensure_ascii=False)}\n"
+            f"new_text: {json.dumps(change.get('new_text', ''), ensure_ascii=False)}\nPassages:\n{shown}"
+        )
+    fixes = await _follow_up(REPAIR_TEXT_PROMPT.format(items="\n\n".join(items)), tally, report)
+
+    allowed = {edit for edit, _ in unresolved}
+    for fix in fixes:
+        edit = fix.get("edit")
+        old_text = fix.get("old_text")
+        if edit not in allowed or not isinstance(old_text, str) or old_text not in content:
+            continue
+        change = changes[edit]
+        new_text = fix.get("new_text")
+        change["old_text"] = old_text
+        change["new_text"] = new_text if isinstance(new_text, str) else change.get("new_text", "")
+        change["repaired"] = "model"
+        report["model_fixed"] += 1
+        allowed.discard(edit)
+    return changes, report
+
+
+# ============== edit_document (V2) ==============
+
+REPAIR_BLOCKS_PROMPT = """These edit_document operations could not be applied because they reference block ids that do not exist.
+The blocks closest to each operation are shown with their real ids.
+
+{items}
+
+Blocks:
+{blocks}
+
+Return {{"fixes": [{{"edit": <edit number>, "change": <the corrected operation>}}]}}.
+Use only block ids listed above. Leave out operations that don't fit any of these blocks."""
+
+
+def _normalize_id(block_id) -> str:
+    return re.sub(r"[^0-9a-z]", "", str(block_id).lower())
+
+
+def _change_text(change: dict) -> str:
+    if change.get("operation") == "modify_segments":
+        segments = change.get("newSegments")
+    else:
+        segments = (change.get("newBlock") or {}).get("segments")
+    if not isinstance(segments, list):
+        return ""
+    return "".join(segment.get("text", "") for segment in segments if isinstance(segment, dict))
+
+
+def _grams(text: str, n: int = 3) -> set:
+    folded = " ".join(fold(text).split())
+    return {folded[i:i + n] for i in range(len(folded) - n + 1)}
+
+
+class BlockRepairer:
+    """Maps the unknown block ids in rejected edit_document ops back to real blocks."""
+
+    SIMILARITY = 0.6  # trigram overlap needed to retarget an op by its content
+
+    def __init__(self, document: SimplifiedDocument):
+        self.blocks = document.blocks
+        self.ids = [block.id for block in document.blocks]
+        self.positions = {block_id: i for i, block_id in enumerate(self.ids)}
+        normalized = {}
+        for block_id in self.ids:
+            normalized.setdefault(_normalize_id(block_id), []).append(block_id)
+        self.normalized = {key: ids[0] for key, ids in normalized.items() if len(ids) == 1}
+        self._block_grams = None
+        self._postings = None
+
+    def _ensure_index(self):
+        if self._block_grams is None:
+            self._block_grams = [_grams("".join(s.text for s in block.segments)) for block in self.blocks]
+            self._postings = {}
+            for i, grams in enumerate(self._block_grams):
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(i)
+
+    def similar_blocks(self, text: str) -> List[Tuple[float, int]]:
+        """(dice similarity, block position) for blocks sharing trigrams with `text`, best first."""
+        query = _grams(text)
+        if not query:
+            return []
+        self._ensure_index()
+        shared = Counter()
+        for gram in query:
+            for i in self._postings.get(gram, ()):
+                shared[i] += 1
+        scored = [
+            (2 * count / (len(query) + len(self._block_grams[i])), i)
+            for i, count in shared.items()
+        ]
+        scored.sort(reverse=True)
+        return scored[:3]
+
+    def unknown_field(self, change: dict) -> Optional[str]:
+        if not isinstance(change, dict):
+            return None
+        if change.get("operation") == "insert_block":
+            after = change.get("afterBlockId")
+            return "afterBlockId" if after is not None and after not in self.positions else None
+        if change.get("operation") in ("modify_segments", "replace_block", "delete_block"):
+            return "blockId" if change.get("blockId") not in self.positions else None
+        return None
+
+    def auto_fix(self, change: dict) -> Optional[dict]:
+        """A corrected copy of `change`, or None when there is no confident fix."""
+        field = self.unknown_field(change)
+        if field is None:
+            return None
+        target = self.normalized.get(_normalize_id(change.get(field)))
+        if target is None and field == "blockId" and change.get("operation") != "delete_block":
+            scored = self.similar_blocks(_change_text(change))
+            if scored and scored[0][0] >= self.SIMILARITY and (
+                len(scored) == 1 or scored[1][0] <= scored[0][0] - REPAIR_MARGIN
+            ):
+                target = self.ids[scored[0][1]]
+        if target is None:
+            return None
+        fixed = dict(change)
+        fixed[field] = target
+        if field == "blockId" and isinstance(fixed.get("newBlock"), dict) and fixed["newBlock"].get("id") == change.get(field):
+            fixed["newBlock"] = {**fixed["newBlock"], "id": target}
+        return fixed
+
+    def context_positions(self, change: dict) -> List[int]:
+        """Block positions worth showing the model for a failed op."""
+        field = self.unknown_field(change)
+        if field is None:
+            return []
+        positions = [i for score, i in self.similar_blocks(_change_text(change)) if score >= REPAIR_MIN_CANDIDATE_SCORE]
+        if not positions:
+            close = difflib.get_close_matches(str(change.get(field)), self.ids, n=3, cutoff=0.5)
+            positions = [self.positions[block_id] for block_id in close]
+        around = set()
+        for i in positions:
+            around.update(j for j in (i - 1, i, i + 1) if 0 <= j < len(self.ids))
+        return sorted(around)
+
+
+async def repair_block_changes(document: SimplifiedDocument, changes: List[dict], rejected: List[dict], tally: UsageTally) -> Tuple[List[dict], dict]:
+    """
+    Retarget rejected edit_document ops (by index into `changes`) that point
+    at nonexistent blocks. Returns (changes, report).
+    """
+    changes = list(changes)
+    report = {"failed": 0, "auto_fixed": 0, "model_fixed": 0, "follow_up_calls": 0}
+    repairer = BlockRepairer(document)
+    unresolved = []
+    for entry in rejected:
+        change = changes[entry["index"]]
+        if repairer.unknown_field(change) is None:
+            continue
+        report["failed"] += 1
+        fixed = repairer.auto_fix(change)
+        if fixed is not None:
+            changes[entry["index"]] = fixed
+            report["auto_fixed"] += 1
+        else:
+            unresolved.append(entry["index"])
+
+    fixes = await follow_up_block_fixes(repairer, {i: changes[i] for i in unresolved[:REPAIR_MAX_FOLLOW_UP]}, tally, report)
+    for edit, fixed in fixes.items():
+        changes[edit] = fixed
+        report["model_fixed"] += 1
+    return changes, report
+
+
+async def follow_up_block_fixes(repairer: BlockRepairer, failed: Dict[int, dict], tally: UsageTally, report: dict) -> Dict[int, dict]:
+    """Ask the model to retarget `failed` ops ({edit number: op}) using only nearby blocks."""
+    positions = set()
+    for change in failed.values():
+        positions.update(repairer.context_positions(change))
+    if not positions:
+        return {}
+    positions = sorted(positions)[:REPAIR_CONTEXT_BLOCKS]
+
+    items = "\n".join(f"Edit {edit}: {json.dumps(change, ensure_ascii=False)}" for edit, change in failed.items())
+    blocks = "\n".join(json.dumps(minimal_block_dict(repairer.blocks[i]), ensure_ascii=False) for i in positions)
+    fixes = await _follow_up(REPAIR_BLOCKS_PROMPT.format(items=items, blocks=blocks), tally, report)
+
+    result = {}
+    for fix in fixes:
+        edit, change = fix.get("edit"), fix.get("change")
+        if edit in failed and edit not in result and isinstance(change, dict) and repairer.unknown_field(change) is None:
+            result[edit] = change
+    return result
+
+
+async def _follow_up(prompt: str, tally: UsageTally, report: dict) -> List[dict]:
+    """One small json_object completion; repair is best-effort, so failures just leave edits unrepaired."""
+    with stage("repair_follow_up") as span:
+        try:
+            route = choose_route("json", fixed="repair")
+            response = await llm.chat_completion(
+                model=route.model,
+                messages=[
+                    {"role": "system", "content": REPAIR_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                response_format={"type": "json_object"}
+            )
+        except Exception as e:
+            record_repair_follow_up("failed")
+            span["failed"] = f"{type(e).__name__}: {str(e)[:200]}"
+            return []
+        tally.add(response)
+        report["follow_up_calls"] += 1
+        try:
+            fixes = json.loads(response.choices[0].message.content or "{}").get("fixes", [])
+        except (json.JSONDecodeError, AttributeError):
+            record_repair_follow_up("unparsable")
+            return []
+        record_repair_follow_up("ok")
+        span["fixes"] = len(fixes) if isinstance(fixes, list) else 0
+        return [fix for fix in fixes if isinstance(fix, dict)] if isinstance(fixes, list) else []
@@ -0,0 +1,292 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import openai
+
+from config import env_float, env_int
+
+# ============== Resilient upstream calls ==============
+# Every chat completion goes through call_resilient():
+#   - Deadlines: each attempt gets UPSTREAM_ATTEMPT_TIMEOUT, and the whole call
+#     (retries included) stays within the request timeout.
+#   - Retries: timeouts, connection errors, 429 and 5xx are retried with
+#     jittered exponential backoff (full jitter; Retry-After is honoured).
+#   - Hedging (UPSTREAM_HEDGE): if an attempt is still running after the
+#     recent p95 latency, a second identical request is fired and the first
+#     answer wins; the loser is cancelled.
+#   - Circuit breaker: after UPSTREAM_BREAKER_FAILURES consecutive failed
+#     attempts calls fail fast with CircuitOpen for UPSTREAM_BREAKER_COOLDOWN
+#     seconds, then one probe call decides whether to close it again.
+# Counters for all of it are served by /api/stats/upstream.
+
+UPSTREAM_ATTEMPT_TIMEOUT = env_float("UPSTREAM_ATTEMPT_TIMEOUT", 60.0)    # seconds per attempt
+UPSTREAM_RETRIES = env_int("UPSTREAM_RETRIES", 2)                         # extra attempts after the first
+UPSTREAM_BACKOFF_BASE = env_float("UPSTREAM_BACKOFF_BASE", 0.25)          # first retry waits up to this
+UPSTREAM_BACKOFF_MAX = env_float("UPSTREAM_BACKOFF_MAX", 8.0)
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "false").lower() in ("1", "true", "yes")
+UPSTREAM_HEDGE_QUANTILE = env_float("UPSTREAM_HEDGE_QUANTILE", 0.95)
+UPSTREAM_HEDGE_MIN_DELAY = env_float("UPSTREAM_HEDGE_MIN_DELAY", 0.5)     # never hedge sooner than this
+UPSTREAM_HEDGE_MIN_SAMPLES = env_int("UPSTREAM_HEDGE_MIN_SAMPLES", 20)    # latencies needed before hedging
+UPSTREAM_BREAKER_FAILURES = env_int("UPSTREAM_BREAKER_FAILURES", 5)
+UPSTREAM_BREAKER_COOLDOWN = env_float("UPSTREAM_BREAKER_COOLDOWN", 30.0)
+LATENCY_WINDOW = 200  # successful attempts kept per model for the p95
+
+
+class UpstreamError(Exception):
+    """The upstream could not produce an answer; `status` is what the API should return."""
+
+    status = 502
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamError):
+    status = 503
+
+
+class UpstreamTimeout(UpstreamError):
+    status = 504
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _error_name(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return "deadline"
+    if isinstance(error, openai.APIStatusError):
+        return f"http_{error.status_code}"
+    return type(error).__name__
+
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half_open after the cooldown (one probe)."""
+
+    def __init__(self, failures: int = UPSTREAM_BREAKER_FAILURES, cooldown: float = UPSTREAM_BREAKER_COOLDOWN):
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {"opened": 0, "short_circuited": 0}
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go upstream now."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "closed" or (self.state == "half_open" and not self.probing):
+            self.probing = self.state == "half_open"
+            return
+        self.counters["short_circuited"] += 1
+        retry_after = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+        raise CircuitOpen("Upstream model API is unavailable (circuit open)", retry_after=round(retry_after, 1) or 1.0)
+
+    def success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.counters["opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, **self.counters}
+
+
+class LatencyWindow:
+    """Recent successful attempt latencies per model, for hedge delays and stats."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self.size = size
+        self._samples = {}
+
+    def add(self, model: str, seconds: float):
+        self._samples.setdefault(model, deque(maxlen=self.size)).append(seconds)
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        samples = self._samples.get(model)
+        if not samples or len(samples) < UPSTREAM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(UPSTREAM_HEDGE_MIN_DELAY, self.quantile(model, UPSTREAM_HEDGE_QUANTILE))
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "samples": len(samples),
+                "p50_ms": round(self.quantile(model, 0.5) * 1000, 1),
+                "p95_ms": round(self.quantile(model, 0.95) * 1000, 1),
+                "p99_ms": round(self.quantile(model, 0.99) * 1000, 1),
+            }
+            for model, samples in self._samples.items()
+        }
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.counters = {
+            "calls": 0, "succeeded": 0, "failed": 0, "attempts": 0, "retries": 0,
+            "deadline_exceeded": 0, "hedges_fired": 0, "hedge_wins": 0,
+        }
+        self.errors = {}
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def error(self, error: BaseException):
+        name = _error_name(error)
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if name == "deadline":
+            self.counters["deadline_exceeded"] += 1
+
+
+breaker = CircuitBreaker()
+latencies = LatencyWindow()
+upstream_stats = UpstreamStats()
+
+
+def stats() -> dict:
+    return {
+        **upstream_stats.counters,
+        "errors": dict(upstream_stats.errors),
+        "breaker": breaker.stats(),
+        "latency": latencies.stats(),
+        "hedging": UPSTREAM_HEDGE,
+    }
+
+
+def backoff_delay(retry: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff; a Retry-After from the upstream is a floor."""
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** retry)))
+    return max(delay, retry_after or 0.0)
+
+
+async def _attempt(send: Callable[[float], Awaitable], model: str, deadline: float):
+    """One upstream attempt under `deadline` seconds; records latency, feeds the breaker."""
+    upstream_stats.count("attempts")
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(send(deadline), deadline)
+    except asyncio.CancelledError:
+        breaker.probing = False  # a cancelled probe doesn't decide anything
+        raise
+    except Exception as e:
+        upstream_stats.error(e)
+        if is_retryable(e):
+            breaker.failure()
+        else:
+            breaker.success()  # the upstream answered; the request itself was bad
+        raise
+    latencies.add(model, time.perf_counter() - started)
+    breaker.success()
+    return result
+
+
+async def _hedged(send: Callable[[float], Awaitable], model: str, deadline: float):
+    """Run an attempt; if it outlives the p95, race a second one against it."""
+    delay = latencies.hedge_delay(model) if UPSTREAM_HEDGE else None
+    first = asyncio.ensure_future(_attempt(send, model, deadline))
+    if delay is None or delay >= deadline:
+        return await first
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and breaker.state == "closed":
+            upstream_stats.count("hedges_fired")
+            hedge = asyncio.ensure_future(_attempt(send, model, max(0.001, deadline - delay)))
+            pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        upstream_stats.count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_resilient(
+    send: Callable[[float], Awaitable], model: str, total_timeout: float, hedge: bool = True, span: Optional[dict] = None
+):
+    """
+    Call `send(attempt_timeout)` (one upstream request) with deadlines, retries,
+    optional hedging and the circuit breaker. Non-retryable errors (e.g. 400)
+    are raised as they are; exhausted retries raise UpstreamError. Retries
+    are noted on `span`, the caller's stage, when given.
+    """
+    upstream_stats.count("calls")
+    started = time.monotonic()
+    retry = 0
+    while True:
+        breaker.allow()
+        remaining = total_timeout - (time.monotonic() - started)
+        deadline = min(UPSTREAM_ATTEMPT_TIMEOUT, remaining)
+        try:
+            if deadline <= 0:
+                raise asyncio.TimeoutError()
+            if hedge:
+                result = await _hedged(send, model, deadline)
+            else:
+                result = await _attempt(send, model, deadline)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                upstream_stats.count("failed")
+                raise
+            delay = backoff_delay(retry, _retry_after(e))
+            out_of_time = time.monotonic() - started + delay >= total_timeout
+            if retry >= UPSTREAM_RETRIES or out_of_time:
+                upstream_stats.count("failed")
+                if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+                    raise UpstreamTimeout(f"Upstream model API timed out after {retry + 1} attempt(s)") from e
+                raise UpstreamError(
+                    f"Upstream model API failed after {retry + 1} attempt(s): {_error_name(e)}", retry_after=_retry_after(e)
+                ) from e
+            retry += 1
+            upstream_stats.count("retries")
+            if span is not None:
+                span["retries"] = retry
+                span.setdefault("retry_errors", []).append(f"{_error_name(e)}, retried in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        upstream_stats.count("succeeded")
+        return result
@@ -0,0 +1,279 @@
+import math
+import os
+import re
+from collections import Counter
+from typing import List, Optional
+
+from config import env_int
+from models import SimplifiedBlock, SimplifiedDocument
+from tokens import count_tokens
+
+# ============== Relevance-windowed context ==============
+# A local, offline selection stage in front of the model call: a BM25 index over
+# block text picks the blocks an instruction needs, plus their neighbors, the
+# section they belong to and the document outline (all headings). Block IDs are
+# kept as-is, so IDs returned by the model refer to the full document.
+
+WINDOW_ENABLED_DEFAULT = os.getenv("CONTEXT_WINDOW_ENABLED", "true").lower() in ("1", "true", "yes")
+WINDOW_MIN_DOC_TOKENS = env_int("CONTEXT_WINDOW_MIN_DOC_TOKENS", 3000)    # smaller docs are always sent whole
+WINDOW_MAX_TOKENS = env_int("CONTEXT_WINDOW_MAX_TOKENS", 6000)            # budget for the selected window
+WINDOW_TOP_K = env_int("CONTEXT_WINDOW_TOP_K", 8)
+WINDOW_NEIGHBORS = env_int("CONTEXT_WINDOW_NEIGHBORS", 1)
+WINDOW_MIN_SCORE_RATIO = 0.25   # ignore matches scoring below this fraction of the best one
+WINDOW_MAX_FRACTION = 0.8       # if the window is this close to the whole doc, just send the doc
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in into is it its of on or that the this to was were will with
+i me my we our you your he she they them his her their please make change can could would should
+""".split())
+
+# Instructions that are about the whole document, where a window would hide what needs editing
+WHOLE_DOCUMENT_PATTERNS = [
+    r"\b(entire|whole|full|complete)\s+(document|doc|text|paper|essay|file|thing)\b",
+    r"\b(throughout|everywhere|all\s+(sections|paragraphs|headings|text|the\s+text))\b",
+    r"\b(apa|mla|chicago|ieee)\b",
+    r"\b(proofread|spell[- ]?check|grammar\s+check|summari[sz]e|translate|outline)\b",
+    r"\b(reformat|restructure|reorganize|format)\s+(the\s+|this\s+|my\s+)?(document|doc|paper|essay|text)\b",
+    r"\b(every|each)\s+(paragraph|heading|section|sentence|line|list)\b",
+    r"\b(fix|improve|polish|rewrite|edit|shorten|expand)\s+(it|everything|the\s+document|this\s+document|my\s+(essay|paper|document))\b",
+]
+_WHOLE_DOCUMENT_RE = re.compile("|".join(WHOLE_DOCUMENT_PATTERNS), re.IGNORECASE)
+
+
+def tokenize(text: str) -> List[str]:
+    return [word for word in _WORD_RE.findall(text.lower()) if word not in STOPWORDS]
+
+
+def is_whole_document_instruction(instruction: str) -> bool:
+    return bool(_WHOLE_DOCUMENT_RE.search(instruction or ""))
+
+
+class BM25Index:
+    """Okapi BM25 over a list of short texts (one per block)."""
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = [Counter(tokenize(text)) for text in texts]
+        self.doc_lengths = [sum(terms.values()) for terms in self.doc_terms]
+        self.avg_length = (sum(self.doc_lengths) / len(texts)) if texts else 0.0
+        document_frequency = Counter()
+        for terms in self.doc_terms:
+            document_frequency.update(terms.keys())
+        n = len(texts)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+        # Inverted index so scoring only touches blocks that contain a query term
+        self.postings = {}
+        for i, terms in enumerate(self.doc_terms):
+            for term in terms:
+                self.postings.setdefault(term, []).append(i)
+
+    def scores(self, query: str) -> List[float]:
+        result = [0.0] * len(self.doc_terms)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i in self.postings[term]:
+                tf = self.doc_terms[i][term]
+                norm = 1 - self.b + self.b * (self.doc_lengths[i] / self.avg_length if self.avg_length else 0)
+                result[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return result
+
+
+class ContextWindow:
+    def __init__(self, indices: List[int], total: int, mode: str, reason: str, tokens: int, total_tokens: int):
+        self.indices = indices  # selected block positions, in document order
+        self.total = total
+        self.mode = mode        # "window" | "full"
+        self.reason = reason
+        self.tokens = tokens
+        self.total_tokens = total_tokens
+
+    @property
+    def is_full(self) -> bool:
+        return self.mode == "full"
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "reason": self.reason,
+            "blocks_sent": len(self.indices),
+            "blocks_total": self.total,
+            "tokens_sent": self.tokens,
+            "tokens_total": self.total_tokens,
+        }
+
+
+def _full(total: int, reason: str, total_tokens: int) -> ContextWindow:
+    return ContextWindow(list(range(total)), total, "full", reason, total_tokens, total_tokens)
+
+
+def select_window(
+    texts: List[str],
+    heading_levels: List[Optional[int]],
+    instruction: str,
+    context_snippets: Optional[List[str]] = None,
+    enabled: Optional[bool] = None,
+    max_tokens: int = None,
+    min_doc_tokens: int = None,
+) -> ContextWindow:
+    """
+    Pick the blocks relevant to `instruction`.
+    `heading_levels[i]` is 1-3 for heading blocks and None otherwise.
+    """
+    enabled = WINDOW_ENABLED_DEFAULT if enabled is None else enabled
+    max_tokens = WINDOW_MAX_TOKENS if max_tokens is None else max_tokens
+    min_doc_tokens = WINDOW_MIN_DOC_TOKENS if min_doc_tokens is None else min_doc_tokens
+
+    total = len(texts)
+    block_tokens = [count_tokens(text) for text in texts]
+    total_tokens = sum(block_tokens)
+
+    if not enabled:
+        return _full(total, "disabled", total_tokens)
+    if total_tokens <= min_doc_tokens:
+        return _full(total, "small_document", total_tokens)
+    if is_whole_document_instruction(instruction):
+        return _full(total, "whole_document_instruction", total_tokens)
+
+    query = " ".join([instruction] + [s for s in (context_snippets or []) if s.strip()])
+    scores = BM25Index(texts).scores(query)
+    best = max(scores) if scores else 0.0
+    if best <= 0:
+        return _full(total, "no_lexical_match", total_tokens)
+
+    # Section membership: owner heading and section end for every block
+    section_heading = [None] * total
+    open_headings = []  # stack of (level, index)
+    for i, level in enumerate(heading_levels):
+        if level is not None:
+            while open_headings and open_headings[-1][0] >= level:
+                open_headings.pop()
+            open_headings.append((level, i))
+        section_heading[i] = open_headings[-1][1] if open_headings else None
+
+    def section_range(heading_index: int) -> range:
+        level = heading_levels[heading_index]
+        end = heading_index + 1
+        while end < total and (heading_levels[end] is None or heading_levels[end] > level):
+            end += 1
+        return range(heading_index, end)
+
+    ranked = sorted(
+        (i for i in range(total) if scores[i] >= best * WINDOW_MIN_SCORE_RATIO),
+        key=lambda i: scores[i], reverse=True,
+    )[:WINDOW_TOP_K]
+
+    selected = set()
+    used = 0
+
+    def add(i: int) -> bool:
+        nonlocal used
+        if i in selected:
+            return True
+        if used + block_tokens[i] > max_tokens:
+            return False
+        selected.add(i)
+        used += block_tokens[i]
+        return True
+
+    # Priority: direct matches, whole sections of matching headings, neighbors,
+    # the heading of each match's section, then the rest of the outline.
+    for i in ranked:
+        add(i)
+    for i in ranked:
+        if heading_levels[i] is not None:
+            for j in section_range(i):
+                if not add(j):
+                    break
+    for i in ranked:
+        for offset in range(1, WINDOW_NEIGHBORS + 1):
+            for j in (i - offset, i + offset):
+                if 0 <= j < total:
+                    add(j)
+        if section_heading[i] is not None:
+            add(section_heading[i])
+    for i, level in enumerate(heading_levels):
+        if level is not None:
+            add(i)
+
+    if used >= total_tokens * WINDOW_MAX_FRACTION:
+        return _full(total, "window_not_smaller", total_tokens)
+    return ContextWindow(sorted(selected), total, "window", "relevance", used, total_tokens)
+
+
+# ============== V2 documents ==============
+
+_HEADING_LEVELS = {"h1": 1, "h2": 2, "h3": 3}
+
+
+def block_text(block: SimplifiedBlock) -> str:
+    return "".join(segment.text for segment in block.segments)
+
+
+def window_document(
+    document: SimplifiedDocument,
+    instruction: str,
+    context_snippets: Optional[List[str]] = None,
+    enabled: Optional[bool] = None,
+):
+    """Returns (document_to_send, ContextWindow)."""
+    texts = [block_text(block) for block in document.blocks]
+    levels = [
+        _HEADING_LEVELS.get(block.tag, 1) if block.type == "heading" else None
+        for block in document.blocks
+    ]
+    window = select_window(texts, levels, instruction, context_snippets, enabled)
+    if window.is_full:
+        return document, window
+    return SimplifiedDocument(blocks=[document.blocks[i] for i in window.indices]), window
+
+
+# ============== Markdown (V1) ==============
+
+_PARAGRAPH_SPLIT_RE = re.compile(r"\n[ \t]*\n")
+_MD_HEADING_RE = re.compile(r"^(#{1,6})\s")
+
+OMITTED_MARKER = "[...]"
+
+
+def window_markdown(
+    content: str,
+    instruction: str,
+    context_snippets: Optional[List[str]] = None,
+    enabled: Optional[bool] = None,
+):
+    """
+    Returns (content_to_send, ContextWindow). Paragraphs not selected are
+    collapsed into an OMITTED_MARKER line; replace_text old_text values still
+    match the full document because selected paragraphs are sent verbatim.
+    """
+    paragraphs = _PARAGRAPH_SPLIT_RE.split(content)
+    levels = []
+    for paragraph in paragraphs:
+        match = _MD_HEADING_RE.match(paragraph.lstrip())
+        levels.append(min(len(match.group(1)), 3) if match else None)
+    window = select_window(paragraphs, levels, instruction, context_snippets, enabled)
+    if window.is_full:
+        return content, window
+    parts = []
+    previous = -1
+    for i in window.indices:
+        if i != previous + 1:
+            parts.append(OMITTED_MARKER)
+        parts.append(paragraphs[i])
+        previous = i
+    if previous != len(paragraphs) - 1:
+        parts.append(OMITTED_MARKER)
+    return "\n\n".join(parts), window
+
+
+WINDOW_NOTE_V1 = f"""NOTE: This is an EXCERPT of a longer document, selected for this instruction. "{OMITTED_MARKER}" marks omitted text. Only edit text shown here."""
+
+WINDOW_NOTE_V2 = """NOTE: This is an EXCERPT of a longer document ({sent} of {total} blocks, selected for this instruction). Block ids are the real ids; only reference blocks shown here."""
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+from typing import Awaitable, Callable, Optional, Tuple
+
+from config import env_int
+from metrics import record_escalation, stage
+from retrieval import is_whole_document_instruction
+
+# ============== Instruction-aware model routing ==============
+# Every model call is classified locally (instruction type, document size,
+# blank document) into a route, and the route table picks the model tier,
+# max_tokens cap and temperature. "Bold the word Education" goes to the small
+# tier with a small completion budget; "rewrite this thesis" gets the medium
+# tier and the full budget.
+#
+# A truncated or unparseable answer is retried one tier up with twice the
+# max_tokens cap (up to ROUTE_MAX_ESCALATIONS times). Every attempt is recorded
+# per route and tier: latency, success, truncation, invalid output
+# (/api/stats/routes).
+
+ROUTING_ENABLED = os.getenv("ROUTING", "true").lower() in ("1", "true", "yes")
+ROUTE_MAX_ESCALATIONS = env_int("ROUTE_MAX_ESCALATIONS", 2)
+ROUTE_LARGE_DOCUMENT_CHARS = env_int("ROUTE_LARGE_DOCUMENT_CHARS", 48000)  # ~12k tokens: no small tier
+ROUTE_SHORT_INSTRUCTION_WORDS = 12
+
+TIERS = ("small", "medium", "large")
+MODEL_TIERS = {
+    "small": os.getenv("ROUTE_MODEL_SMALL", "gpt-5-nano"),
+    "medium": os.getenv("ROUTE_MODEL_MEDIUM", "gpt-5-mini"),
+    "large": os.getenv("ROUTE_MODEL_LARGE", "gpt-5"),
+}
+
+# Hard ceiling on max_tokens per kind of call, whatever the escalation
+KIND_MAX_TOKENS = {
+    "replace_text": env_int("ROUTE_MAX_TOKENS_REPLACE_TEXT", 4000),
+    "edit_document": env_int("ROUTE_MAX_TOKENS_EDIT_DOCUMENT", 32768),
+    "text": env_int("ROUTE_MAX_TOKENS_TEXT", 4000),
+    "json": 2000,
+}
+
+# route -> tier, max_tokens per kind of call, temperature (None: the caller's)
+ROUTES = {
+    # Classified command routes
+    "format":   {"tier": "small",  "max_tokens": {"replace_text": 600,  "edit_document": 2048,  "text": 400},  "temperature": 0.1},
+    "edit":     {"tier": "small",  "max_tokens": {"replace_text": 1200, "edit_document": 4096,  "text": 800},  "temperature": 0.3},
+    "rewrite":  {"tier": "medium", "max_tokens": {"replace_text": 2000, "edit_document": 16384, "text": 1500}, "temperature": 0.3},
+    "generate": {"tier": "medium", "max_tokens": {"replace_text": 2000, "edit_document": 16384, "text": 1500}, "temperature": 0.7},
+    # Used when ROUTING is off: the previous fixed settings
+    "command":  {"tier": "medium", "max_tokens": {"replace_text": 2000, "edit_document": 16384, "text": 1500}, "temperature": 0.3},
+    # Fixed routes picked by the endpoint
+    "style":    {"tier": "medium", "max_tokens": {"replace_text": 2000, "edit_document": 16384}, "temperature": 0.1},
+    "summary":  {"tier": "small",  "max_tokens": {"json": 500},  "temperature": None},
+    "repair":   {"tier": "medium", "max_tokens": {"json": 2000}, "temperature": 0},
+    "autocomplete": {"tier": "small", "max_tokens": {"text": 100}, "temperature": 0.7},
+}
+
+_FORMAT_RE = re.compile(
+    r"\b(bold|italic|italici[sz]e|underline|strike ?through|capitali[sz]e|uppercase|lowercase|"
+    r"heading|title case|bullet(ed)?|numbered list|indent|highlight)\b",
+    re.IGNORECASE,
+)
+_REWRITE_RE = re.compile(
+    r"\b(rewrite|rephrase|paraphrase|improve|polish|restructure|reorgani[sz]e|expand|elaborate|shorten|"
+    r"condense|summari[sz]e|translate|simplify|tone|flow|clarity|proofread)\b",
+    re.IGNORECASE,
+)
+_GENERATE_RE = re.compile(
+    r"\b(write|draft|generate|compose|create|outline|brainstorm|continue)\b|"
+    r"\badd (a|an|some|another) (paragraph|section|conclusion|introduction|summary|list)\b",
+    re.IGNORECASE,
+)
+
+
+class TruncatedResponse(ValueError):
+    """finish_reason == "length": the answer hit max_tokens."""
+
+
+class InvalidOutput(ValueError):
+    """The model's tool arguments or JSON could not be parsed."""
+
+
+class Route:
+    def __init__(self, name: str, kind: str, tier: str, max_tokens: int, temperature: Optional[float], escalations: int = 0):
+        self.name = name
+        self.kind = kind
+        self.tier = tier
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.escalations = escalations
+
+    @property
+    def model(self) -> str:
+        return MODEL_TIERS[self.tier]
+
+    @property
+    def can_escalate(self) -> bool:
+        return self.escalations < ROUTE_MAX_ESCALATIONS and (
+            self.tier != TIERS[-1] or self.max_tokens < KIND_MAX_TOKENS[self.kind]
+        )
+
+    def escalate(self) -> Optional["Route"]:
+        """The same route one tier up with twice the max_tokens (None when exhausted)."""
+        if not self.can_escalate:
+            return None
+        tier = TIERS[min(TIERS.index(self.tier) + 1, len(TIERS) - 1)]
+        max_tokens = min(self.max_tokens * 2, KIND_MAX_TOKENS[self.kind])
+        return Route(self.name, self.kind, tier, max_tokens, self.temperature, self.escalations + 1)
+
+    def describe(self) -> dict:
+        return {
+            "route": self.name,
+            "tier": self.tier,
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "escalations": self.escalations,
+        }
+
+
+def classify(instruction: str, is_blank: bool = False) -> str:
+    instruction = instruction or ""
+    if is_blank or (_GENERATE_RE.search(instruction) and not _FORMAT_RE.search(instruction)):
+        return "generate"
+    if _REWRITE_RE.search(instruction) or is_whole_document_instruction(instruction):
+        return "rewrite"
+    if _FORMAT_RE.search(instruction) and len(instruction.split()) <= ROUTE_SHORT_INSTRUCTION_WORDS:
+        return "format"
+    return "edit"
+
+
+def choose_route(kind: str, instruction: str = "", document_chars: int = 0, is_blank: bool = False, fixed: Optional[str] = None) -> Route:
+    """
+    Route for one call. `kind` is the shape of the answer ("replace_text",
+    "edit_document", "text" or "json"); `fixed` names a route directly.
+    """
+    if fixed is not None:
+        name = fixed
+    elif ROUTING_ENABLED:
+        name = classify(instruction, is_blank)
+    else:
+        name = "generate" if kind == "text" else "command"
+    config = ROUTES[name]
+    tier = config["tier"]
+    if tier == "small" and fixed is None and document_chars > ROUTE_LARGE_DOCUMENT_CHARS:
+        tier = "medium"  # long documents need the bigger context and attention
+    if not ROUTING_ENABLED:
+        tier = "medium"
+    return Route(name, kind, tier, config["max_tokens"][kind], config["temperature"])
+
+
+def routing_signature() -> dict:
+    """What the route table depends on, for response cache keys."""
+    return {"enabled": ROUTING_ENABLED, "tiers": MODEL_TIERS}
+
+
+# ============== Escalation and per-route stats ==============
+
+class RouteStats:
+    """Attempts per (route, tier): outcome counts and latency, served by /api/stats/routes."""
+
+    OUTCOMES = ("ok", "truncated", "invalid", "error")
+
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, route: Route, latency: float, outcome: str):
+        entry = self._stats.setdefault((route.name, route.tier), {
+            "attempts": 0,
+            "escalated_attempts": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            **{outcome_name: 0 for outcome_name in self.OUTCOMES},
+        })
+        entry["attempts"] += 1
+        entry[outcome] += 1
+        if route.escalations:
+            entry["escalated_attempts"] += 1
+        entry["latency_total"] += latency
+        entry["latency_max"] = max(entry["latency_max"], latency)
+
+    def snapshot(self) -> list:
+        rows = []
+        for (name, tier), entry in sorted(self._stats.items()):
+            n = entry["attempts"]
+            rows.append({
+                "route": name,
+                "tier": tier,
+                "model": MODEL_TIERS[tier],
+                "attempts": n,
+                "succeeded": entry["ok"],
+                "truncated": entry["truncated"],
+                "invalid": entry["invalid"],
+                "errors": entry["error"],
+                "escalated_attempts": entry["escalated_attempts"],
+                "success_rate": round(entry["ok"] / n, 3),
+                "avg_latency_ms": round(entry["latency_total"] / n * 1000, 1),
+                "max_latency_ms": round(entry["latency_max"] * 1000, 1),
+            })
+        return rows
+
+
+ROUTE_STATS = RouteStats()
+
+
+async def call_routed(route: Route, attempt: Callable[[Route], Awaitable]) -> Tuple[object, Route]:
+    """
+    Run `attempt(route)`, escalating on TruncatedResponse / InvalidOutput.
+    Returns (result, route that produced it); re-raises once escalation is
+    exhausted.
+    """
+    with stage("route", route=route.name) as span:
+        while True:
+            started = time.perf_counter()
+            try:
+                result = await attempt(route)
+            except (TruncatedResponse, InvalidOutput) as e:
+                ROUTE_STATS.record(route, time.perf_counter() - started, "truncated" if isinstance(e, TruncatedResponse) else "invalid")
+                next_route = route.escalate()
+                if next_route is None:
+                    raise
+                record_escalation(route.name, type(e).__name__)
+                span.setdefault("escalations", []).append(
+                    f"{type(e).__name__} on {route.model}, to {next_route.model} (max_tokens={next_route.max_tokens})"
+                )
+                route = next_route
+                continue
+            except Exception:
+                ROUTE_STATS.record(route, time.perf_counter() - started, "error")
+                raise
+            ROUTE_STATS.record(route, time.perf_counter() - started, "ok")
+            span["model"] = route.model
+            return result, route
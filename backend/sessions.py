@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import env_int
+from models import SimplifiedDocument
+from cache import canonical_json
+from doc_encoding import minimal_block_dict
+from edit_engine import validate_block_changes
+
+# ============== Server-side editing sessions ==============
+# A session holds the current document and conversation history, so after
+# creating it a client only sends block-level patches (edit_document ops) and
+# instructions. Every state carries a document hash; a client whose copy has
+# diverged gets a 409 and re-uploads the document (resync). A patch applies
+# whole or not at all: if any of its ops is rejected the session keeps its
+# document and the client gets a 409 as well, since its copy already has the
+# edit the server could not follow.
+#
+# document_hash = sha256(canonical JSON of the blocks in minimal form: keys
+# sorted, no whitespace, format omitted when 0, adjacent same-format segments
+# merged, empty segments dropped).
+#
+# The store is in-process, bounded by session count and total document size,
+# with an idle TTL; least recently used sessions are evicted first.
+
+SESSION_TTL_SECONDS = env_int("SESSION_TTL", 3600)
+SESSION_MAX_SESSIONS = env_int("SESSION_MAX_SESSIONS", 1000)
+SESSION_MAX_BYTES = env_int("SESSION_MAX_BYTES", 256 * 1024 * 1024)
+SESSION_MAX_HISTORY = env_int("SESSION_MAX_HISTORY", 50)    # messages kept; prompt budgets trim further
+
+
+def document_hash(document: SimplifiedDocument) -> str:
+    blocks = [minimal_block_dict(block) for block in document.blocks]
+    return hashlib.sha256(canonical_json(blocks).encode("utf-8")).hexdigest()
+
+
+class SessionConflict(Exception):
+    """The client's base hash doesn't match the session's document."""
+
+    def __init__(self, session: "EditSession"):
+        super().__init__("document_hash_mismatch")
+        self.session = session
+
+
+class PatchRejected(Exception):
+    """A client patch has ops the session's document can't take; nothing was applied."""
+
+    def __init__(self, session: "EditSession", rejected: list):
+        super().__init__("patch_rejected")
+        self.session = session
+        self.rejected = rejected
+
+
+class EditSession:
+    def __init__(self, session_id: str, document: SimplifiedDocument):
+        self.id = session_id
+        self.history = []
+        self.version = 0
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()  # patches and command results apply one at a time
+        self._set_document(document)
+
+    def _set_document(self, document: SimplifiedDocument):
+        self.document = document
+        self.hash = document_hash(document)
+        self.size = len(canonical_json([minimal_block_dict(block) for block in document.blocks]))
+        self.version += 1
+
+    def check_base(self, base_hash: Optional[str]):
+        if base_hash is not None and base_hash != self.hash:
+            raise SessionConflict(self)
+
+    def replace_document(self, document: SimplifiedDocument):
+        self._set_document(document)
+
+    def apply(self, changes: list) -> list:
+        """Apply edit_document ops; returns the rejected ones (the rest are applied)."""
+        validation = validate_block_changes(self.document, changes, apply=True)
+        if len(validation["rejected"]) < len(changes):
+            self._set_document(SimplifiedDocument.model_validate(validation["applied_document"]))
+        return validation["rejected"]
+
+    def apply_patch(self, changes: list):
+        """Apply a client patch in full; PatchRejected (document unchanged) if any op is rejected."""
+        validation = validate_block_changes(self.document, changes, apply=True)
+        if validation["rejected"]:
+            raise PatchRejected(self, validation["rejected"])
+        if changes:
+            self._set_document(SimplifiedDocument.model_validate(validation["applied_document"]))
+
+    def add_turn(self, instruction: str, summary: str):
+        self.history.append({"role": "user", "content": instruction})
+        self.history.append({"role": "assistant", "content": summary})
+        del self.history[:-SESSION_MAX_HISTORY]
+
+    def state(self, include_document: bool = False) -> dict:
+        state = {
+            "session_id": self.id,
+            "version": self.version,
+            "document_hash": self.hash,
+            "blocks": len(self.document.blocks),
+            "history_messages": len(self.history),
+        }
+        if include_document:
+            state["document"] = self.document.model_dump(exclude_none=True)
+        return state
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS, max_bytes: int = SESSION_MAX_BYTES, ttl: float = SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self.counters = {"created": 0, "evicted": 0, "expired": 0, "conflicts": 0, "rejected_patches": 0}
+
+    def create(self, document: SimplifiedDocument) -> EditSession:
+        session = EditSession(secrets.token_urlsafe(16), document)
+        self._sessions[session.id] = session
+        self.counters["created"] += 1
+        self._evict()
+        return session
+
+    def get(self, session_id: str) -> Optional[EditSession]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.last_used > self.ttl:
+            del self._sessions[session_id]
+            self.counters["expired"] += 1
+            return None
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def touch(self, session: EditSession):
+        """Re-check bounds after a session's document grew."""
+        self._evict(keep=session.id)
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    @property
+    def bytes(self) -> int:
+        return sum(session.size for session in self._sessions.values())
+
+    def _evict(self, keep: Optional[str] = None):
+        now = time.monotonic()
+        for session_id in [sid for sid, s in self._sessions.items() if now - s.last_used > self.ttl]:
+            del self._sessions[session_id]
+            self.counters["expired"] += 1
+        total = self.bytes
+        while self._sessions and (len(self._sessions) > self.max_sessions or total > self.max_bytes):
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                if len(self._sessions) == 1:
+                    break
+                self._sessions.move_to_end(oldest)
+                continue
+            total -= self._sessions.pop(oldest).size
+            self.counters["evicted"] += 1
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+        }
+
+
+session_store = SessionStore()
@@ -0,0 +1,64 @@
+import asyncio
+import copy
+
+# ============== In-flight request coalescing ==============
+# Concurrent requests with the same canonical key share one upstream call.
+# The shared call runs in its own task: a waiter that is cancelled (client went
+# away) only stops waiting. The task is cancelled only once no waiter is left.
+# Followers get a shallow copy of the leader's result, so a caller may set
+# top-level keys on what it gets back without touching anyone else's.
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.counters = {"leaders": 0, "deduplicated": 0, "abandoned": 0}
+
+    async def do(self, key: str, fn):
+        """Run `fn()` once per key at a time; concurrent callers await the same result."""
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task, key=key, call=call: self._forget(key, call))
+            self.counters["leaders"] += 1
+        else:
+            self.counters["deduplicated"] += 1
+
+        call.waiters += 1
+        try:
+            result = await asyncio.shield(call.task)
+            return result if leader else copy.copy(result)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # Last waiter gone: nobody will read the result
+                call.task.cancel()
+                self.counters["abandoned"] += 1
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key: str, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled():
+            call.task.exception()  # mark as retrieved even if every waiter left
+
+    def stats(self) -> dict:
+        total = self.counters["leaders"] + self.counters["deduplicated"]
+        return {
+            **self.counters,
+            "in_flight": len(self._calls),
+            "waiting": sum(call.waiters for call in self._calls.values()),
+            "upstream_calls_saved_pct": round(100 * self.counters["deduplicated"] / total, 1) if total else 0.0,
+        }
+
+
+inflight = SingleFlight()
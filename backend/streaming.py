@@ -0,0 +1,111 @@
+import json
+from typing import List, Optional
+
+# ============== Incremental edit_document parsing ==============
+
+class ChangeStreamParser:
+    """
+    Incremental parser for streamed edit_document arguments.
+
+    Feed it argument fragments as they arrive; it returns every element of the
+    top-level "changes" array whose JSON object has closed since the last call.
+    Each character is scanned once, and fragments are kept in a list (joined
+    only for `buffer`), so total work is linear in the argument size.
+    """
+
+    def __init__(self, array_key: str = "changes"):
+        self.array_key = array_key
+        self._parts = []          # fragments received
+        self._stack = []          # open containers: '{' or '['
+        self._in_string = False
+        self._escape = False
+        self._held = None         # pieces of the top-level string or change item being read
+        self._last_string = None  # last complete string at top-level object depth
+        self._current_key = None  # key whose value is being parsed at top level
+        self._in_changes = False
+        self.emitted = 0
+
+    @property
+    def buffer(self) -> str:
+        """The arguments received so far."""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, fragment: str) -> List[dict]:
+        self._parts.append(fragment)
+        completed = []
+        stack = self._stack
+        held = self._held
+        start = 0  # where this fragment's share of `held` begins
+        for i, ch in enumerate(fragment):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(stack) == 1:
+                        held.append(fragment[start:i])
+                        self._last_string = "".join(held)[1:]  # without the opening quote
+                        held = None
+                continue
+            if ch == '"':
+                self._in_string = True
+                if len(stack) == 1:
+                    held, start = [], i
+            elif ch == ":":
+                if len(stack) == 1:
+                    self._current_key = self._last_string
+            elif ch == "{" or ch == "[":
+                if ch == "[" and len(stack) == 1 and self._current_key == self.array_key:
+                    self._in_changes = True
+                elif ch == "{" and self._in_changes and len(stack) == 2:
+                    held, start = [], i
+                stack.append(ch)
+            elif ch == "}" or ch == "]":
+                if stack:
+                    stack.pop()
+                if ch == "}" and self._in_changes and len(stack) == 2 and held is not None:
+                    held.append(fragment[start:i + 1])
+                    item = self._decode("".join(held))
+                    if item is not None:
+                        completed.append(item)
+                    held = None
+                elif ch == "]" and self._in_changes and len(stack) == 1:
+                    self._in_changes = False
+        if held is not None:
+            held.append(fragment[start:])
+        self._held = held
+        self.emitted += len(completed)
+        return completed
+
+    @staticmethod
+    def _decode(text: str) -> Optional[dict]:
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return item if isinstance(item, dict) else None
+
+    def final_arguments(self) -> dict:
+        """Full decoded arguments once the stream has finished ({} if incomplete)."""
+        try:
+            args = json.loads(self.buffer)
+        except json.JSONDecodeError:
+            return {}
+        return args if isinstance(args, dict) else {}
+
+
+# ============== Server-sent events ==============
+
+def sse_event(event: str, data) -> str:
+    payload = json.dumps(data, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # disable proxy buffering (nginx)
+}
@@ -0,0 +1,17 @@
+from models import SimplifiedDocument
+
+
+def block(block_id: str, text: str, type: str = "paragraph", **fields) -> dict:
+    return {"id": block_id, "type": type, "segments": [{"text": text, "format": 0}], **fields}
+
+
+def document(*blocks: dict) -> SimplifiedDocument:
+    return SimplifiedDocument.model_validate({"blocks": list(blocks)})
+
+
+def insert(after, new_block: dict) -> dict:
+    return {"operation": "insert_block", "afterBlockId": after, "newBlock": new_block}
+
+
+def texts(doc: SimplifiedDocument) -> list:
+    return ["".join(segment.text for segment in b.segments) for b in doc.blocks]
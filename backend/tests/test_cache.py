@@ -0,0 +1,50 @@
+from fastapi.testclient import TestClient
+
+from app import app
+from cache import format_key, response_cache
+from models import FormatRequest
+
+client = TestClient(app)
+
+
+def format_rules(content: str) -> dict:
+    response = client.post("/api/format", json={"content": content, "format_type": "APA", "format_mode": "rules", "apply_changes": True})
+    assert response.status_code == 200
+    return response.json()
+
+
+def assert_positions_match(content: str, result: dict):
+    for change in result["changes"]:
+        assert content[change["position"]:change["position"] + len(change["old_text"])] == change["old_text"]
+
+
+def test_key_is_the_markdown_as_sent():
+    lf = FormatRequest(content="a study\n\nMETHODS\n", format_type="APA")
+    crlf = FormatRequest(content="a study\r\n\r\nMETHODS\r\n", format_type="APA")
+    spaces = FormatRequest(content="a study  \n\nMETHODS\n", format_type="APA")
+    assert len({format_key(request, {}) for request in (lf, crlf, spaces)}) == 3
+    assert format_key(lf, {}) == format_key(FormatRequest(content=lf.content, format_type="APA"), {})
+
+
+def test_variants_get_positions_in_their_own_content():
+    lf = "results of the study\n\nINTRODUCTION\n"
+    crlf = "results of the study  \r\n\r\nINTRODUCTION\r\n"
+    first = format_rules(lf)
+    assert_positions_match(lf, first)
+    assert first["applied_content"] == "results of the study\n\n## Introduction\n"
+
+    hits = response_cache.counters["hits_memory"]
+    second = format_rules(crlf)
+    assert response_cache.counters["hits_memory"] == hits
+    assert_positions_match(crlf, second)
+    assert second["applied_content"] == "results of the study  \r\n\r\n## Introduction\r\n"
+
+
+def test_same_content_is_served_from_the_cache():
+    content = "cached paper\n\nDISCUSSION\n"
+    first = format_rules(content)
+    hits = response_cache.counters["hits_memory"]
+    again = format_rules(content)
+    assert response_cache.counters["hits_memory"] == hits + 1
+    assert again["changes"] == first["changes"]
+    assert_positions_match(content, again)
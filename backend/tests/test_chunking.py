@@ -0,0 +1,38 @@
+from chunking import merge_chunk_changes
+from edit_engine import apply_block_changes
+
+from tests.helpers import block, document, insert, texts
+
+DOC = document(block("a", "A"), block("b", "B"), block("c", "C"), block("d", "D"))
+CHUNKS = [DOC.blocks[:2], DOC.blocks[2:]]
+
+
+def item(block_id: str, text: str) -> dict:
+    return block(block_id, text, type="list-item", listType="bullet")
+
+
+def test_chunk_may_edit_a_block_it_inserted():
+    second = [
+        insert("c", block("n1", "N1")),
+        {"operation": "modify_segments", "blockId": "n1", "newSegments": [{"text": "N1!", "format": 0}]},
+        insert("n1", block("n2", "N2")),
+        {"operation": "delete_block", "blockId": "n2"},
+    ]
+    merged, dropped = merge_chunk_changes(CHUNKS, [[], second])
+    assert dropped == []
+    assert texts(apply_block_changes(DOC, merged)) == ["A", "B", "C", "N1!", "D"]
+
+
+def test_boundary_inserts_follow_the_previous_chunk():
+    first = [insert("b", block("p1", "P1")), insert("p1", block("p2", "P2"))]
+    second = [insert(None, block("q1", "Q1")), insert("q1", block("q2", "Q2"))]
+    merged, dropped = merge_chunk_changes(CHUNKS, [first, second])
+    assert dropped == []
+    assert texts(apply_block_changes(DOC, merged)) == ["A", "B", "P1", "P2", "Q1", "Q2", "C", "D"]
+
+
+def test_boundary_list_does_not_join_the_previous_chunk_list():
+    first = [insert("b", item("p1", "P1")), insert("b", item("p2", "P2"))]
+    second = [insert(None, item("q1", "Q1")), insert(None, item("q2", "Q2"))]
+    merged, _ = merge_chunk_changes(CHUNKS, [first, second])
+    assert texts(apply_block_changes(DOC, merged)) == ["A", "B", "P1", "P2", "Q1", "Q2", "C", "D"]
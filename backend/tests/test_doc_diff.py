@@ -0,0 +1,53 @@
+from bench.diff import check_diffs
+from doc_diff import diff_documents, text_diff, word_diff
+from edit_engine import apply_block_changes, apply_editor_changes, validate_block_changes
+from tests.helpers import block, document, texts
+
+
+def bullet(block_id: str, text: str) -> dict:
+    return block(block_id, text, "list-item", listType="bullet")
+
+
+def test_inserted_list_items_are_sent_in_document_order():
+    old = document(block("a", "A"))
+    new = document(block("a", "A"), bullet("x0", "one"), bullet("x1", "two"), bullet("x2", "three"))
+    changes = diff_documents(old, new)
+    assert [change["newBlock"]["segments"][0]["text"] for change in changes] == ["one", "two", "three"]
+    assert {change["afterBlockId"] for change in changes} == {"a"}
+    assert texts(apply_editor_changes(old, changes)) == ["A", "one", "two", "three"]
+    assert texts(apply_block_changes(old, changes)) == ["A", "one", "two", "three"]
+
+
+def test_inserted_paragraphs_land_in_order():
+    old = document(block("a", "A"), block("b", "B"))
+    new = document(block("n1", "N1"), block("a", "A"), block("n2", "N2"), block("n3", "N3"), block("b", "B"), block("n4", "N4"))
+    changes = diff_documents(old, new)
+    assert validate_block_changes(old, changes)["rejected"] == []
+    assert texts(apply_editor_changes(old, changes)) == ["N1", "A", "N2", "N3", "B", "N4"]
+
+
+def test_list_runs_on_different_anchors_stay_apart():
+    old = document(block("a", "A"), block("b", "B"))
+    for new in (
+        document(block("a", "A"), bullet("x", "1"), block("b", "B"), bullet("y", "2")),
+        document(block("a", "A changed"), bullet("x", "1"), block("b", "B"), bullet("y", "2")),
+    ):
+        changes = diff_documents(old, new)
+        assert texts(apply_editor_changes(old, changes)) == texts(new)
+
+
+def test_unchanged_document_gives_no_changes():
+    doc = document(block("a", "A"), bullet("b", "B"))
+    assert diff_documents(doc, doc) == []
+
+
+def test_random_documents_round_trip():
+    # Valid against the old document; the model's and the editor's application both give the new one
+    assert check_diffs(500, seed=7) == 0
+
+
+def test_word_diff_rebuilds_both_texts():
+    for diff in (word_diff, text_diff):
+        chunks = diff("the big dog ran", "the small dog ran fast")
+        assert "".join(text for op, text in chunks if op <= 0) == "the big dog ran"
+        assert "".join(text for op, text in chunks if op >= 0) == "the small dog ran fast"
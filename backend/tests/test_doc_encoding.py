@@ -0,0 +1,25 @@
+import doc_encoding
+from doc_encoding import encoding_stats, get_encoder
+
+from tests.helpers import block, document
+
+DOC = document(*(block(f"b{i}", f"Paragraph {i} of the results section." * (1 + i % 4)) for i in range(400)))
+
+
+def test_sampled_baseline_is_close_to_the_exact_one(monkeypatch):
+    encoder = get_encoder("compact")
+    encoded = encoder.encode(DOC)
+    estimate = encoding_stats(DOC, encoder, encoded)
+    monkeypatch.setattr(doc_encoding, "ENCODING_STATS_EXACT", True)
+    exact = encoding_stats(DOC, encoder, encoded)
+
+    assert not estimate["baseline_exact"] and exact["baseline_exact"]
+    assert estimate["tokens"] == exact["tokens"]
+    assert abs(estimate["baseline_chars"] - exact["baseline_chars"]) < 0.05 * exact["baseline_chars"]
+    assert abs(estimate["tokens_saved_pct"] - exact["tokens_saved_pct"]) < 5
+
+
+def test_json_encoding_is_its_own_baseline():
+    encoder = get_encoder("json")
+    stats = encoding_stats(DOC, encoder, encoder.encode(DOC))
+    assert stats["baseline_exact"] and stats["tokens_saved_pct"] == 0.0
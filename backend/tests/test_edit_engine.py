@@ -0,0 +1,73 @@
+from edit_engine import (
+    BlockValidator, apply_block_changes, apply_editor_changes, editor_block_changes, validate_block_changes,
+)
+from tests.helpers import block, document, insert, texts
+
+
+def test_insert_may_anchor_on_a_block_created_earlier():
+    doc = document(block("a", "A"))
+    changes = [insert("a", block("n1", "N1")), insert("n1", block("n2", "N2")), insert("n2", block("n3", "N3"))]
+    assert validate_block_changes(doc, changes)["rejected"] == []
+    assert texts(apply_block_changes(doc, changes)) == ["A", "N1", "N2", "N3"]
+
+
+def test_essay_on_a_blank_document():
+    blank = document()
+    essay = [insert(None if i == 0 else f"new-{i}", block(f"new-{i + 1}", f"P{i + 1}")) for i in range(3)]
+    validation = validate_block_changes(blank, essay)
+    assert validation["rejected"] == []
+    assert texts(apply_editor_changes(blank, editor_block_changes(blank, validation["changes"]))) == ["P1", "P2", "P3"]
+
+
+def test_rejects_unknown_and_removed_anchors():
+    validator = BlockValidator(document(block("a", "A"), block("b", "B")))
+    assert validator.check(insert("zz", block("n1", "N1"))) == "unknown afterBlockId: zz"
+    assert validator.check({"operation": "delete_block", "blockId": "a"}) is None
+    assert "deleted or replaced" in validator.check(insert("a", block("n2", "N2")))
+    assert validator.check(insert("b", block("n3", "N3"))) is None
+
+
+def test_rejects_duplicate_block_ids():
+    validator = BlockValidator(document(block("a", "A")))
+    assert validator.check(insert("a", block("a", "again"))) == "duplicate block id: a"
+    assert validator.check(insert("a", block("n1", "N1"))) is None
+    assert validator.check(insert("n1", block("n1", "N1 again"))) == "duplicate block id: n1"
+
+
+def test_rejects_edits_of_removed_blocks():
+    validator = BlockValidator(document(block("a", "A")))
+    assert validator.check({"operation": "replace_block", "blockId": "a", "newBlock": block("a2", "A2")}) is None
+    assert validator.check({"operation": "modify_segments", "blockId": "a", "newSegments": [{"text": "x"}]}) \
+        == "block a was already deleted or replaced"
+    assert validator.check({"operation": "delete_block", "blockId": "a2"}) == "unknown blockId: a2"
+
+
+def test_list_items_on_one_anchor_keep_their_order():
+    doc = document(block("a", "A"), block("b", "B"))
+    items = [insert("a", block(f"l{i}", text, "list-item", listType="bullet")) for i, text in enumerate(["one", "two", "three"])]
+    assert texts(apply_block_changes(doc, items)) == ["A", "one", "two", "three", "B"]
+    assert texts(apply_editor_changes(doc, editor_block_changes(doc, items))) == ["A", "one", "two", "three", "B"]
+
+
+def test_editor_order_matches_the_model_for_chains_and_edits():
+    doc = document(block("a", "A"), block("b", "B"), block("c", "C"))
+    changes = [
+        insert("a", block("n1", "N1")),
+        {"operation": "replace_block", "blockId": "b", "newBlock": block("b2", "B2")},
+        insert("b2", block("n2", "N2")),
+        insert("n2", block("n3", "N3", "list-item", listType="number")),
+        {"operation": "delete_block", "blockId": "c"},
+        insert(None, block("n0", "N0")),
+    ]
+    assert validate_block_changes(doc, changes)["rejected"] == []
+    expected = texts(apply_block_changes(doc, changes))
+    assert expected == ["N0", "A", "N1", "B2", "N2", "N3"]
+    ordered = editor_block_changes(doc, changes)
+    assert validate_block_changes(doc, ordered)["rejected"] == []
+    assert texts(apply_editor_changes(doc, ordered)) == expected
+
+
+def test_changes_without_inserts_are_left_as_they_are():
+    doc = document(block("a", "A"), block("b", "B"))
+    changes = [{"operation": "delete_block", "blockId": "b"}, {"operation": "modify_segments", "blockId": "a", "newSegments": [{"text": "x"}]}]
+    assert editor_block_changes(doc, changes) is changes
@@ -0,0 +1,59 @@
+from edit_engine import validate_text_changes
+from format_rules import (
+    _classify, block_rule_changes, markdown_rule_changes, markdown_title_missing, model_instruction, style_rules,
+)
+from markdown_blocks import markdown_to_document
+
+MLA_PAPER = "Jane Smith\n\nProfessor Jones\n\nEnglish 101\n\n12 March 2024\n\nthe great gatsby and the american dream\n\nINTRODUCTION\n\nText here."
+
+
+def rules(content: str, format_type: str) -> list:
+    return [(change["rule"], change["new_text"].strip()) for change in markdown_rule_changes(content, format_type)]
+
+
+def test_classify():
+    assert _classify("# a paper", True) == ("title", 1, "a paper")
+    assert _classify("## Methods", False) == ("heading", 2, "Methods")
+    assert _classify("METHODS AND RESULTS", False) == ("heading", 0, "METHODS AND RESULTS")
+    for section in ("METHOD", "NOTES", "RESULTS", "DISCUSSION", "INTRODUCTION"):
+        assert _classify(section, False) == ("heading", 0, section)
+    assert _classify("**Background**", False) == ("heading", 0, "Background")
+    assert _classify("References", False) == ("references", 0, "References")
+    assert _classify("Just a sentence of body text.", False)[0] is None
+
+
+def test_acronyms_are_not_headings():
+    for acronym in ("NASA", "UNICEF", "AI", "UNCTAD", "OECD"):
+        assert _classify(acronym, False)[0] is None
+    assert rules("Some text.\n\nNASA\n\nMore text.", "APA") == []
+
+
+def test_mla_header_is_left_alone_and_the_title_follows_it():
+    assert not markdown_title_missing(MLA_PAPER)
+    assert rules(MLA_PAPER, "MLA") == [("title", "# The Great Gatsby and the American Dream"), ("heading", "## Introduction")]
+    changes = markdown_rule_changes(MLA_PAPER, "MLA")
+    applied = validate_text_changes(MLA_PAPER, changes, apply=True)["applied_content"]
+    assert applied.startswith("Jane Smith\n\nProfessor Jones\n\nEnglish 101\n\n12 March 2024\n\n# The Great Gatsby")
+
+
+def test_plain_first_line_is_not_taken_for_the_title():
+    content = "the great gatsby and the american dream\n\nSome text.\n\nMETHODS AND RESULTS\n"
+    assert markdown_title_missing(content)
+    assert rules(content, "APA") == [("heading", "## Methods and Results")]
+
+
+def test_marked_titles():
+    assert rules("# the great gatsby\n\nJane Smith\n", "APA") == [("title", "**The Great Gatsby**")]
+    assert rules("**my paper title**\n\ntext", "MLA") == [("title", "# My Paper Title")]
+
+
+def test_blocks_follow_the_markdown_rules():
+    changes = block_rule_changes(markdown_to_document(MLA_PAPER), "MLA")
+    assert [(change["rule"], change["newBlock"]["type"]) for change in changes] == [("title", "heading"), ("heading", "heading")]
+
+
+def test_model_is_told_about_the_title_only_when_the_rules_left_it():
+    apa = style_rules("APA")
+    assert "Title:" in model_instruction(apa, title=False)
+    assert "Title:" not in (model_instruction(apa) or "")
+    assert "Title:" not in model_instruction(style_rules("MLA"), blocks=True)
@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+
+import jobs
+from app import app, job_queue
+
+client = TestClient(app)
+
+
+def test_both_job_kinds_store_the_request_without_unset_fields(monkeypatch):
+    payloads = []
+
+    async def submit(kind, user, payload):
+        payloads.append(payload)
+        return jobs.Job(f"job-{len(payloads)}", kind, user, payload)
+
+    monkeypatch.setattr(job_queue, "submit", submit)
+    client.post("/api/jobs/format", json={"content": "METHODS\n", "format_type": "APA"})
+    client.post("/api/jobs/command/v2", json={"instruction": "tidy", "document": {"blocks": []}})
+    assert len(payloads) == 2
+    assert all(None not in payload.values() for payload in payloads)
@@ -0,0 +1,45 @@
+from bench.convert import check_round_trips
+from markdown_blocks import document_to_markdown, markdown_to_document
+
+
+def blocks(markdown: str) -> list:
+    return [
+        (b.type, b.tag, b.listType, b.indent, [(segment.text, segment.format) for segment in b.segments])
+        for b in markdown_to_document(markdown).blocks
+    ]
+
+
+def test_random_round_trips():
+    assert check_round_trips(300, seed=7) == 0
+
+
+def test_nested_lists():
+    markdown = "- one\n    - two\n        1. three\n        2. four\n- five"
+    assert blocks(markdown) == [
+        ("list-item", None, "bullet", 0, [("one", 0)]),
+        ("list-item", None, "bullet", 1, [("two", 0)]),
+        ("list-item", None, "number", 2, [("three", 0)]),
+        ("list-item", None, "number", 2, [("four", 0)]),
+        ("list-item", None, "bullet", 0, [("five", 0)]),
+    ]
+    assert document_to_markdown(markdown_to_document(markdown)) == markdown
+
+
+def test_bold_italic():
+    markdown = "***bold italic*** and **bold** *it*"
+    assert blocks(markdown) == [
+        ("paragraph", None, None, None, [("bold italic", 3), (" and ", 0), ("bold", 1), (" ", 0), ("it", 2)]),
+    ]
+    assert document_to_markdown(markdown_to_document(markdown)) == markdown
+
+
+def test_escaped_asterisks_stay_text():
+    markdown = "2\\*3 is \\*not\\* italic"
+    assert blocks(markdown) == [("paragraph", None, None, None, [("2*3 is *not* italic", 0)])]
+    assert document_to_markdown(markdown_to_document(markdown)) == markdown
+
+
+def test_crlf_reads_like_lf():
+    lf = "# Title\n\nSome *text*\nnext line\n\n- item"
+    assert blocks(lf.replace("\n", "\r\n")) == blocks(lf)
+    assert blocks(lf)[1] == ("paragraph", None, None, None, [("Some ", 0), ("text", 2), ("\nnext line", 0)])
@@ -0,0 +1,24 @@
+import asyncio
+
+import llm
+from edit_summary import UsageTally
+from metrics import REPAIR_FOLLOW_UPS
+from repair import BlockRepairer, follow_up_block_fixes
+
+from tests.helpers import block, document
+
+
+def test_failed_follow_up_is_counted_and_leaves_edits_unrepaired(monkeypatch):
+    async def unavailable(**kwargs):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(llm, "chat_completion", unavailable)
+    report = {"failed": 1, "auto_fixed": 0, "model_fixed": 0, "follow_up_calls": 0}
+    failed = sum(value for key, value in REPAIR_FOLLOW_UPS._values.items() if key[1] == "failed")
+
+    repairer = BlockRepairer(document(block("intro-1", "The study began in May."), block("intro-2", "It ended in June.")))
+    failed_op = {"operation": "delete_block", "blockId": "intro-3"}
+    fixes = asyncio.run(follow_up_block_fixes(repairer, {1: failed_op}, UsageTally(), report))
+
+    assert fixes == {} and report["follow_up_calls"] == 0
+    assert sum(value for key, value in REPAIR_FOLLOW_UPS._values.items() if key[1] == "failed") == failed + 1
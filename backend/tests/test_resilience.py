@@ -0,0 +1,21 @@
+import asyncio
+
+import resilience
+from resilience import call_resilient, upstream_stats
+
+
+def test_retries_are_counted_and_noted_on_the_span(monkeypatch):
+    monkeypatch.setattr(resilience, "backoff_delay", lambda retry, retry_after=None: 0.0)
+    attempts = []
+
+    async def send(deadline):
+        attempts.append(deadline)
+        if len(attempts) == 1:
+            raise asyncio.TimeoutError()
+        return "ok"
+
+    span = {}
+    retries = upstream_stats.counters["retries"]
+    assert asyncio.run(call_resilient(send, "test-model", 10.0, hedge=False, span=span)) == "ok"
+    assert upstream_stats.counters["retries"] == retries + 1
+    assert span["retries"] == 1 and len(span["retry_errors"]) == 1
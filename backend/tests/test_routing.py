@@ -0,0 +1,26 @@
+import asyncio
+
+from metrics import ROUTE_ESCALATIONS
+from routing import TruncatedResponse, call_routed, choose_route
+
+
+def escalations() -> float:
+    return sum(ROUTE_ESCALATIONS._values.values())
+
+
+def test_truncated_output_escalates_and_is_counted():
+    route = choose_route("edit_document", "fix the typos")
+    seen = []
+
+    async def attempt(current):
+        seen.append(current)
+        if len(seen) == 1:
+            raise TruncatedResponse("cut off")
+        return "done"
+
+    before = escalations()
+    result, final = asyncio.run(call_routed(route, attempt))
+
+    assert result == "done" and final is seen[1]
+    assert final.max_tokens > route.max_tokens
+    assert escalations() == before + 1
@@ -0,0 +1,73 @@
+from fastapi.testclient import TestClient
+
+from app import app
+from tests.helpers import block, insert
+
+client = TestClient(app)
+
+
+def create_session() -> dict:
+    response = client.post("/api/sessions", json={"document": {"blocks": [block("a", "A"), block("b", "B")]}})
+    assert response.status_code == 200
+    return response.json()
+
+
+def blocks(session_id: str) -> list:
+    state = client.get(f"/api/sessions/{session_id}", params={"include_document": True}).json()
+    return [b["id"] for b in state["document"]["blocks"]]
+
+
+def test_patch_may_chain_inserts():
+    session = create_session()
+    response = client.post(f"/api/sessions/{session['session_id']}/patch", json={
+        "changes": [insert("a", block("n1", "N1")), insert("n1", block("n2", "N2"))],
+        "base_hash": session["document_hash"],
+    })
+    assert response.status_code == 200
+    assert response.json()["rejected"] == []
+    assert blocks(session["session_id"]) == ["a", "n1", "n2", "b"]
+
+
+def test_patch_with_a_rejected_op_applies_nothing():
+    session = create_session()
+    response = client.post(f"/api/sessions/{session['session_id']}/patch", json={
+        "changes": [{"operation": "delete_block", "blockId": "b"}, {"operation": "delete_block", "blockId": "zz"}],
+    })
+    assert response.status_code == 409
+    detail = response.json()["detail"]
+    assert detail["error"] == "patch_rejected"
+    assert [rejected["index"] for rejected in detail["rejected"]] == [1]
+    assert detail["document_hash"] == session["document_hash"]
+    assert blocks(session["session_id"]) == ["a", "b"]
+
+
+def test_stale_base_hash_is_a_conflict():
+    session = create_session()
+    response = client.post(f"/api/sessions/{session['session_id']}/patch", json={"changes": [], "base_hash": "stale"})
+    assert response.status_code == 409
+    assert response.json()["detail"]["error"] == "document_hash_mismatch"
+
+
+def test_patch_during_the_model_call_is_not_overwritten(monkeypatch):
+    import app as app_module
+    from sessions import session_store
+
+    session = create_session()
+    session_id = session["session_id"]
+
+    async def command_v2(request):
+        # A client patch lands while the model is still running
+        live = session_store.get(session_id)
+        async with live.lock:
+            live.apply_patch([{"operation": "modify_segments", "blockId": "b", "newSegments": [{"text": "user edit"}]}])
+        return {"changes": [{"operation": "modify_segments", "blockId": "b", "newSegments": [{"text": "model edit"}]}], "summary": "s"}
+
+    monkeypatch.setattr(app_module, "process_ai_command_v2", command_v2)
+    response = client.post(f"/api/sessions/{session_id}/command", json={"instruction": "rewrite b", "base_hash": session["document_hash"]})
+    assert response.status_code == 200
+    state = response.json()["session"]
+    assert state["applied"] is False
+    assert state["reason"] == "document_changed"
+    assert state["base_hash"] == session["document_hash"]
+    document = client.get(f"/api/sessions/{session_id}", params={"include_document": True}).json()["document"]
+    assert document["blocks"][1]["segments"][0]["text"] == "user edit"
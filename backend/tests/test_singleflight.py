@@ -0,0 +1,42 @@
+import asyncio
+
+import app as app_module
+from singleflight import SingleFlight
+
+
+def test_followers_get_their_own_copy():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return {"summary": "done"}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", compute) for _ in range(3)))
+
+    results = asyncio.run(run())
+    results[1]["session"] = {"applied": True}
+
+    assert flight.counters["leaders"] == 1
+    assert "session" not in results[0] and "session" not in results[2]
+
+
+def test_bypass_request_does_not_join_a_cached_lookup(monkeypatch):
+    calls = []
+
+    def get_or_compute(key, compute, bypass=False):
+        calls.append(bypass)
+        return asyncio.sleep(0.01, result={"bypass": bypass})
+
+    monkeypatch.setattr(app_module.response_cache, "get_or_compute", get_or_compute)
+
+    async def run():
+        return await asyncio.gather(
+            app_module.cached_call("k", None),
+            app_module.cached_call("k", None, bypass=True),
+        )
+
+    normal, bypassed = asyncio.run(run())
+
+    assert sorted(calls) == [False, True]
+    assert normal == {"bypass": False} and bypassed == {"bypass": True}
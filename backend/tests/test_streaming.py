@@ -0,0 +1,42 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app import InvalidOutput, parse_edit_tool_calls
+from metrics import ERRORS
+from streaming import ChangeStreamParser
+
+ARGUMENTS = json.dumps({
+    "summary": 'quotes " and braces { [',
+    "changes": [
+        {"operation": "delete_block", "blockId": "a"},
+        {"operation": "modify_segments", "blockId": "b", "newSegments": [{"text": "x } ] \\ y"}]},
+    ],
+    "reasoning": "done",
+})
+
+
+def test_changes_come_out_as_their_objects_close():
+    for size in (1, 3, 7, len(ARGUMENTS)):
+        parser = ChangeStreamParser()
+        emitted = []
+        for start in range(0, len(ARGUMENTS), size):
+            emitted.extend(parser.feed(ARGUMENTS[start:start + size]))
+        assert emitted == json.loads(ARGUMENTS)["changes"]
+        assert parser.buffer == ARGUMENTS
+        assert parser.final_arguments() == json.loads(ARGUMENTS)
+
+
+def test_only_the_top_level_changes_array_counts():
+    parser = ChangeStreamParser()
+    assert parser.feed('{"other": [{"a": 1}], "nested": {"changes": [{"b": 2}]}, "changes": [{"c": 3}') == [{"c": 3}]
+    assert parser.final_arguments() == {}
+
+
+def test_malformed_tool_arguments_are_counted():
+    call = SimpleNamespace(function=SimpleNamespace(name="edit_document", arguments=ARGUMENTS[:40]))
+    before = sum(value for key, value in ERRORS._values.items() if key[1] == "JSONDecodeError")
+    with pytest.raises(InvalidOutput):
+        parse_edit_tool_calls([call])
+    assert sum(value for key, value in ERRORS._values.items() if key[1] == "JSONDecodeError") == before + 1
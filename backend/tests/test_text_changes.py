@@ -0,0 +1,28 @@
+from edit_engine import validate_text_changes
+
+
+def test_every_repeated_occurrence_resolves():
+    content = "a. " * 40
+    changes = [{"old_text": "a.", "new_text": "b."} for _ in range(40)]
+    result = validate_text_changes(content, changes, apply=True)
+    assert result["issues"] == []
+    assert [change["position"] for change in result["changes"]] == list(range(0, 120, 3))
+    assert result["applied_content"] == "b. " * 40
+
+
+def test_kth_change_takes_the_kth_free_occurrence():
+    content = "x aaaa y"
+    result = validate_text_changes(content, [{"old_text": "aa", "new_text": "b"}, {"old_text": "aa", "new_text": "c"}], apply=True)
+    assert [change["position"] for change in result["changes"]] == [2, 4]
+    assert result["applied_content"] == "x bc y"
+
+
+def test_statuses():
+    content = "one two one"
+    result = validate_text_changes(content, [
+        {"old_text": "one", "new_text": "1"},
+        {"old_text": "three", "new_text": "3"},
+        {"old_text": "ne tw", "new_text": "?"},
+        {"old_text": "", "new_text": "x"},
+    ])
+    assert [change["status"] for change in result["changes"]] == ["ambiguous", "missing", "conflict", "empty"]
@@ -0,0 +1,44 @@
+import math
+
+# ============== Local token counting ==============
+# Uses tiktoken when it is installed (offline once its encoding files are
+# cached); otherwise falls back to a character-based estimate.
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency
+    tiktoken = None
+
+TOKENIZER_ENCODING = "o200k_base"
+CHARS_PER_TOKEN = 4.0
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception:
+            # Encoding files not cached and no network: stay on the estimator
+            _encoding_failed = True
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def tokenizer_name() -> str:
+    return TOKENIZER_ENCODING if _get_encoding() is not None else "estimate"